@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+"""
+Measures how long it takes to start sporestackv2 for a read-only command.
+
+Usage: python3 benchmarks/startup.py [runs]
+
+Times `import sporestackv2.client` in a fresh interpreter against a bare
+interpreter, and lists which heavy dependencies got imported on the way.
+"""
+
+import subprocess
+import sys
+from statistics import median
+from time import perf_counter
+
+HEAVY_MODULES = ['aaargh', 'paramiko', 'pyqrcode', 'sshpubkeys',
+                 'walkingliberty']
+
+STARTUP = '''
+import sys
+import sporestackv2.client
+print(' '.join(sorted(name for name in {}
+                      if name in sys.modules)))
+'''.format(HEAVY_MODULES)
+
+
+def time_once(code):
+    started = perf_counter()
+    output = subprocess.run([sys.executable, '-c', code],
+                            check=True,
+                            stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    return perf_counter() - started, output.strip()
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    baseline = median(time_once('pass')[0] for _ in range(runs))
+    timings = []
+    for _ in range(runs):
+        seconds, imported = time_once(STARTUP)
+        timings.append(seconds)
+    startup = median(timings)
+    print('Interpreter alone:      {:.1f}ms'.format(baseline * 1000))
+    print('import sporestackv2:    {:.1f}ms'.format(startup * 1000))
+    print('sporestackv2 overhead:  {:.1f}ms'.format((startup - baseline) *
+                                                    1000))
+    print('Heavy modules imported: {}'.format(imported or 'none'))
+
+
+if __name__ == '__main__':
+    main()
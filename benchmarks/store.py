@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Compares the flat and sharded JSON machine store layouts.
+
+Usage: python3 benchmarks/store.py [count ...]
+
+For each count (1000, 10000 and 100000 by default) and layout, saves that
+many machines in a temporary directory, then times looking up machines
+that exist, checking for ones that don't, and listing every machine.
+The record cache is kept out of it, so every lookup reads its file.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from sporestackv2 import store  # noqa: E402
+
+LOOKUPS = 1000
+
+
+def populate(directory, layout, count):
+    machines = store.JSONStore(directory)
+    machines.migrate_layout(layout)
+    started = perf_counter()
+    for number in range(count):
+        machines.save({'vm_hostname': 'vm{}'.format(number),
+                       'machine_id': '{:064x}'.format(number),
+                       'host': 'host{}.example'.format(number % 100),
+                       'api_endpoint': 'https://api.sporestack.com',
+                       'expiration': 1600000000 + number})
+    return perf_counter() - started
+
+
+def per_call(function, arguments):
+    started = perf_counter()
+    for argument in arguments:
+        function(argument)
+    return (perf_counter() - started) / len(arguments)
+
+
+def run(layout, count):
+    directory = tempfile.mkdtemp(prefix='sporestackv2-bench-')
+    try:
+        save = populate(directory, layout, count)
+        # A fresh store, as a new process would have.
+        machines = store.JSONStore(directory, record_cache_size=1)
+        present = ['vm{}'.format(random.randrange(count))
+                   for _ in range(LOOKUPS)]
+        missing = ['missing{}'.format(number) for number in range(LOOKUPS)]
+        get = per_call(machines.get, present)
+        exists = per_call(machines.exists, missing)
+        started = perf_counter()
+        listed = sum(1 for _ in machines.hostnames())
+        enumerate_all = perf_counter() - started
+        assert listed == count
+    finally:
+        shutil.rmtree(directory)
+    return save / count, get, exists, enumerate_all
+
+
+def main():
+    counts = [int(count) for count in sys.argv[1:]] or [1000, 10000, 100000]
+    header = '{:>8} {:>8} {:>10} {:>10} {:>12} {:>12}'
+    row = '{:>8} {:>8} {:>8.1f}us {:>8.1f}us {:>10.1f}us {:>10.1f}ms'
+    print(header.format('count', 'layout', 'save', 'get', 'exists (no)',
+                        'list all'))
+    for count in counts:
+        for layout in store.LAYOUTS:
+            save, get, exists, enumerate_all = run(layout, count)
+            print(row.format(count, layout, save * 1e6, get * 1e6,
+                             exists * 1e6, enumerate_all * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -35,6 +35,10 @@ setup(
         'paramiko',
         'sshpubkeys'
     ],
+    extras_require={
+        'async': ['aiohttp'],
+        'fast': ['orjson']
+    },
     entry_points={
         'console_scripts': [
             'sporestackv2 = sporestackv2.client:main'
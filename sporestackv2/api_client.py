@@ -2,59 +2,469 @@
 
 import logging
 import sys
-from time import sleep
+import threading
+from collections import namedtuple
+from time import monotonic, sleep, time
+from urllib.parse import urlsplit
 
-import aaargh
 import requests
+from requests.adapters import HTTPAdapter
 
-from . import ssh
+from . import codec
+from . import commands
 from . import validate
+from .circuit import CircuitBreaker, CircuitOpenError
+from .retry import get_policy, retry_after_seconds
 
-cli = aaargh.App()
+cli = commands.App()
 
 LATEST_API_VERSION = 2
 
+# Connections to each endpoint are kept alive and reused between calls.
+SESSION_POOL_SIZE = 10
+# Seconds a pooled session may sit unused before it is thrown away.
+SESSION_IDLE_TIMEOUT = 60
+
+# target -> (connect, read) timeouts in seconds. Anything not listed
+# gets DEFAULT_TIMEOUT.
+TIMEOUTS = {'launch': (10, 330),
+            'topup': (10, 330),
+            'exists': (5, 30),
+            'status': (5, 30),
+            'start': (5, 60),
+            'stop': (5, 60),
+            'sshhostname': (5, 30),
+            'info': (5, 30),
+            'ipxescript': (5, 60),
+            'host_info': (5, 30)}
+DEFAULT_TIMEOUT = (10, 330)
+
+# For json_params that are already encoded.
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Endpoints that keep failing are cut off for a while.
+_circuit_breaker = CircuitBreaker()
+
+# cache.ResponseCache for read-only calls, if any.
+_response_cache = None
+
+# (url, get_params) -> _Flight, for GETs being made right now.
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_coalesce_stats = {'requests': 0, 'coalesced': 0}
+
+# session_key -> [session, last_used, managed]
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def session_key(url):
+    """
+    Returns the scheme://host[:port] part of url, which is what
+    sessions are pooled by.
+    """
+    parts = urlsplit(url)
+    if parts.scheme == '' or parts.netloc == '':
+        raise ValueError('url must be absolute: {}'.format(url))
+    return '{}://{}'.format(parts.scheme, parts.netloc)
+
+
+def _new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SESSION_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def configure_sessions(pool_size=None, idle_timeout=None):
+    """
+    Sets the pool size and idle timeout for pooled sessions.
+
+    Sessions we created are closed so the new settings take effect.
+    Injected sessions are left alone.
+    """
+    global SESSION_POOL_SIZE
+    global SESSION_IDLE_TIMEOUT
+    if pool_size is not None:
+        if not isinstance(pool_size, int) or pool_size < 1:
+            raise ValueError('pool_size must be a positive integer.')
+        SESSION_POOL_SIZE = pool_size
+    if idle_timeout is not None:
+        if idle_timeout < 0:
+            raise ValueError('idle_timeout must not be negative.')
+        SESSION_IDLE_TIMEOUT = idle_timeout
+    with _sessions_lock:
+        for key, entry in list(_sessions.items()):
+            if entry[2] is True:
+                entry[0].close()
+                del _sessions[key]
+
+
+def get_session(url):
+    """
+    Returns a keep-alive session for url's endpoint, making one if needed.
+    """
+    key = session_key(url)
+    now = time()
+    with _sessions_lock:
+        entry = _sessions.get(key)
+        if entry is not None and entry[2] is True:
+            if now - entry[1] > SESSION_IDLE_TIMEOUT:
+                entry[0].close()
+                entry = None
+        if entry is None:
+            entry = [_new_session(), now, True]
+            _sessions[key] = entry
+        entry[1] = now
+        return entry[0]
+
+
+def set_session(url, session):
+    """
+    Use session (a requests.Session or compatible) for url's endpoint.
+
+    Injected sessions are never expired or closed by us, except through
+    close_sessions().
+    """
+    key = session_key(url)
+    with _sessions_lock:
+        old = _sessions.get(key)
+        if old is not None and old[2] is True and old[0] is not session:
+            old[0].close()
+        _sessions[key] = [session, time(), False]
+
+
+def close_sessions():
+    """
+    Closes and forgets every pooled session.
+    """
+    with _sessions_lock:
+        for entry in _sessions.values():
+            entry[0].close()
+        _sessions.clear()
 
-def api_request(url, json_params=None, get_params=None, retry=False):
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when the caller's deadline passes before we have an answer.
+    """
+
+
+def deadline_in(seconds):
+    """
+    Returns a deadline seconds from now, for the deadline arguments.
+
+    Deadlines are Unix timestamps, so they can be passed between
+    processes and on the command line.
+    """
+    return time() + seconds
+
+
+def remaining(deadline):
+    """
+    Seconds left before deadline, or None if there is no deadline.
+
+    Raises DeadlineExceeded if it has already passed.
+    """
+    if deadline is None:
+        return None
+    seconds = deadline - time()
+    if seconds <= 0:
+        raise DeadlineExceeded('Deadline exceeded.')
+    return seconds
+
+
+def get_timeout(url, deadline=None):
+    """
+    Returns the (connect, read) timeout for url's target, shortened to fit
+    in what is left before deadline.
+    """
+    target = urlsplit(url).path.rsplit('/', 1)[-1]
+    connect, read = TIMEOUTS.get(target, DEFAULT_TIMEOUT)
+    seconds = remaining(deadline)
+    if seconds is not None:
+        connect = min(connect, seconds)
+        read = min(read, seconds)
+    return connect, read
+
+
+def check_api_version(request_dict):
+    """
+    Warns if the API tells us it has a newer version than we speak.
+    """
+    if 'latest_api_version' in request_dict:
+        if request_dict['latest_api_version'] > LATEST_API_VERSION:
+            logging.warning('New API version may be available.')
+
+
+def decode_response(content_type, content):
+    """
+    Returns the decoded JSON of a successful response, or the raw content
+    if it isn't JSON.
+    """
+    if not codec.is_json(content_type):
+        return content
+    try:
+        request_dict = codec.loads(content)
+    except ValueError:
+        return content
+    if isinstance(request_dict, dict):
+        check_api_version(request_dict)
+    return request_dict
+
+
+def set_circuit_breaker(breaker):
+    """
+    Use breaker (a circuit.CircuitBreaker) in front of every request, or
+    None to turn circuit breaking off.
+    """
+    global _circuit_breaker
+    _circuit_breaker = breaker
+
+
+def get_circuit_breaker():
+    return _circuit_breaker
+
+
+def set_response_cache(cache):
+    """
+    Use cache (a cache.ResponseCache) for read-only calls, or None to
+    stop caching.
+    """
+    global _response_cache
+    _response_cache = cache
+
+
+def get_response_cache():
+    return _response_cache
+
+
+def _cached_request(target, url, get_params, host, machine_id, api_endpoint,
+                    deadline=None):
+    """
+    api_request() for read-only calls, going through the response cache.
+    """
+    cache = _response_cache
+    if cache is None:
+        return api_request(url, get_params=get_params, deadline=deadline)
+    if host is None:
+        host = api_endpoint
+    hit, output = cache.get(target, host, machine_id)
+    if hit is True:
+        return output
+    output = api_request(url, get_params=get_params, deadline=deadline)
+    cache.set(target, host, machine_id, output)
+    return output
+
+
+def _invalidating_request(url, json_params, host, machine_id, api_endpoint,
+                          retry=False, deadline=None):
+    """
+    api_request() for calls that change a VM. Cached responses about it
+    are dropped whether it worked or not, since it may have half worked.
+    """
     try:
+        return api_request(url,
+                           json_params=json_params,
+                           retry=retry,
+                           deadline=deadline)
+    finally:
+        cache = _response_cache
+        if cache is not None:
+            if host is None:
+                host = api_endpoint
+            cache.invalidate(machine_id, host=host)
+
+
+def http_error(status_code, content):
+    """
+    Returns (exception, retryable) for a response that was not a 2xx.
+    """
+    status_code_first_digit = status_code // 100
+    if status_code == 429:
+        return ValueError(content), True
+    elif status_code_first_digit == 4:
+        return ValueError(content), False
+    elif status_code_first_digit == 5:
+        return Exception(content), True
+    else:
+        # Not sure why we'd get this.
+        message = 'Stuff broke strangely, status code: {}'
+        return Exception(message.format(status_code)), False
+
+
+class _Flight:
+    """
+    A GET in progress that other callers can wait on.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+
+def coalesce_stats():
+    """
+    Returns how many GETs went out ('requests') and how many were
+    answered by sharing one already in flight ('coalesced').
+    """
+    with _in_flight_lock:
+        return dict(_coalesce_stats)
+
+
+def reset_coalesce_stats():
+    with _in_flight_lock:
+        for key in _coalesce_stats:
+            _coalesce_stats[key] = 0
+
+
+def api_request(url,
+                json_params=None,
+                get_params=None,
+                retry=False,
+                deadline=None):
+    """
+    retry can be False, True or a retry.RetryPolicy.
+
+    True uses retry.DEFAULT_RETRY_POLICY.
+
+    deadline is a Unix timestamp (see deadline_in()) after which we give
+    up with DeadlineExceeded, no matter what retry says. Each attempt only
+    waits for the time that is left.
+
+    json_params can be a dict, or JSON already encoded to bytes.
+
+    Identical GETs made at the same time share one request, so callers
+    get the same output object (or exception) and should not modify it.
+    """
+    if json_params is not None:
+        return _api_request(url,
+                            json_params=json_params,
+                            retry=retry,
+                            deadline=deadline)
+
+    if get_params is None:
+        key = (url, ())
+    else:
+        key = (url, tuple(sorted(get_params.items())))
+    with _in_flight_lock:
+        flight = _in_flight.get(key)
+        if flight is None:
+            leader = True
+            flight = _Flight()
+            _in_flight[key] = flight
+            _coalesce_stats['requests'] = _coalesce_stats['requests'] + 1
+        else:
+            leader = False
+            _coalesce_stats['coalesced'] = _coalesce_stats['coalesced'] + 1
+
+    if leader is False:
+        if not flight.done.wait(remaining(deadline)):
+            raise DeadlineExceeded('Deadline exceeded.')
+        if flight.error is not None:
+            raise flight.error
+        return flight.output
+
+    try:
+        flight.output = _api_request(url,
+                                     get_params=get_params,
+                                     retry=retry,
+                                     deadline=deadline)
+        return flight.output
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+        flight.done.set()
+
+
+def _attempt(url, json_params, get_params, timeout, breaker, key, policy):
+    """
+    Makes one request. Returns (error, retryable, retry_after, output),
+    where error is None if it worked.
+    """
+    try:
+        session = get_session(url)
         if json_params is None:
-            request = requests.get(url, params=get_params, timeout=330)
+            request = session.get(url,
+                                  params=get_params,
+                                  timeout=timeout)
+        elif isinstance(json_params, bytes):
+            request = session.post(url,
+                                   data=json_params,
+                                   headers=JSON_HEADERS,
+                                   timeout=timeout)
         else:
-            request = requests.post(url, json=json_params, timeout=330)
+            request = session.post(url,
+                                   json=json_params,
+                                   timeout=timeout)
     except Exception as e:
-        if retry is True:
-            logging.warning('Got an error, but retrying: {}'.format(e))
-            sleep(5)
-            # Try again.
-            return api_request(url, json_params, retry=retry)
+        if breaker is not None:
+            breaker.failure(key)
+        return e, True, None, None
+    except BaseException:
+        # Interrupted, so we don't know how the endpoint is doing.
+        if breaker is not None:
+            breaker.release(key)
+        raise
+    if breaker is not None:
+        if request.status_code // 100 == 5:
+            breaker.failure(key)
         else:
-            raise
-
-    status_code_first_digit = request.status_code // 100
-    if status_code_first_digit == 2:
+            breaker.success(key)
+    if request.status_code // 100 == 2:
+        policy.success(key)
+        output = decode_response(request.headers.get('Content-Type'),
+                                 request.content)
+        return None, None, None, output
+    error, retryable = http_error(request.status_code, request.content)
+    retry_after = retry_after_seconds(request.headers.get('Retry-After'))
+    return error, retryable, retry_after, None
+
+
+def _api_request(url,
+                 json_params=None,
+                 get_params=None,
+                 retry=False,
+                 deadline=None):
+    policy = get_policy(retry)
+    key = session_key(url)
+    started = monotonic()
+    attempt = 0
+    while True:
+        attempt = attempt + 1
+        breaker = _circuit_breaker
+        # Before before_call(), which can take a half-open trial call.
+        timeout = get_timeout(url, deadline)
         try:
-            request_dict = request.json()
-            if 'latest_api_version' in request_dict:
-                if request_dict['latest_api_version'] > LATEST_API_VERSION:
-                    logging.warning('New API version may be available.')
-            return request_dict
-        except Exception:
-            return request.content
-    elif status_code_first_digit == 4:
-        raise ValueError(request.content)
-    elif status_code_first_digit == 5:
-        if retry is True:
-            logging.warning(request.content)
-            logging.warning('Got a 500, retrying in 5 seconds...')
-            sleep(5)
-            # Try again if we get a 500
-            return api_request(url, json_params, retry=retry)
+            if breaker is not None:
+                breaker.before_call(key)
+        except CircuitOpenError as e:
+            # Waited out like a Retry-After, if the policy lets us.
+            error = e
+            retryable = True
+            retry_after = e.retry_in
         else:
-            raise Exception(request.content)
-    else:
-        # Not sure why we'd get this.
-        request.raise_for_status()
-        raise Exception('Stuff broke strangely.')
+            error, retryable, retry_after, output = _attempt(
+                url, json_params, get_params, timeout, breaker, key, policy)
+            if error is None:
+                return output
+
+        delay = None
+        if retryable is True:
+            delay = policy.next_delay(key, attempt, started, retry_after)
+        if delay is not None and deadline is not None:
+            if time() + delay >= deadline:
+                delay = None
+        if delay is None:
+            raise error
+        message = 'Got an error, retrying in {:.1f} seconds: {}'
+        logging.warning(message.format(delay, error))
+        sleep(delay)
 
 
 def normalize_argument(argument):
@@ -77,6 +487,168 @@ def get_url(api_endpoint, host, target):
     return '{}/v{}/{}'.format(api_endpoint, LATEST_API_VERSION, target)
 
 
+def _launch_request(machine_id,
+                    days,
+                    disk,
+                    memory,
+                    ipv4,
+                    ipv6,
+                    bandwidth,
+                    currency,
+                    region=None,
+                    ipxescript=None,
+                    operating_system=None,
+                    ssh_key=None,
+                    organization=None,
+                    refund_address=None,
+                    cores=1,
+                    managed=False,
+                    override_code=None,
+                    settlement_token=None,
+                    qemuopts=None,
+                    hostaccess=False,
+                    api_endpoint=None,
+                    host=None,
+                    want_topup=False):
+    """
+    Validates launch arguments and returns (url, json_params).
+    """
+    ipv4 = normalize_argument(ipv4)
+    ipv6 = normalize_argument(ipv6)
+    bandwidth = normalize_argument(bandwidth)
+
+    validate.ipv4(ipv4)
+    validate.ipv6(ipv6)
+    validate.bandwidth(bandwidth)
+    validate.cores(cores)
+    validate.disk(disk)
+    validate.memory(memory)
+    validate.organization(organization)
+    validate.machine_id(machine_id)
+    validate.ipxescript(ipxescript)
+    validate.operating_system(operating_system)
+    validate.ssh_key(ssh_key)
+
+    json_params = {'machine_id': machine_id,
+                   'days': days,
+                   'disk': disk,
+                   'memory': memory,
+                   'refund_address': refund_address,
+                   'cores': cores,
+                   'managed': managed,
+                   'currency': currency,
+                   'region': region,
+                   'organization': organization,
+                   'bandwidth': bandwidth,
+                   'ipv4': ipv4,
+                   'ipv6': ipv6,
+                   'override_code': override_code,
+                   'settlement_token': settlement_token,
+                   'qemuopts': qemuopts,
+                   'hostaccess': hostaccess,
+                   'ipxescript': ipxescript,
+                   'operating_system': operating_system,
+                   'ssh_key': ssh_key,
+                   'want_topup': want_topup,
+                   'host': host}
+
+    url = get_url(api_endpoint=api_endpoint, host=host, target='launch')
+    return url, json_params
+
+
+def _topup_request(machine_id,
+                   days,
+                   currency,
+                   settlement_token=None,
+                   refund_address=None,
+                   override_code=None,
+                   api_endpoint=None,
+                   host=None):
+    validate.machine_id(machine_id)
+
+    json_params = {'machine_id': machine_id,
+                   'days': days,
+                   'refund_address': refund_address,
+                   'settlement_token': settlement_token,
+                   'currency': currency,
+                   'host': host,
+                   'override_code': override_code}
+    url = get_url(api_endpoint=api_endpoint, host=host, target='topup')
+    return url, json_params
+
+
+def _machine_request(target, host, machine_id, api_endpoint=None):
+    """
+    For the simple calls that only take host and machine_id.
+
+    Returns (url, params).
+    """
+    validate.machine_id(machine_id)
+
+    url = get_url(api_endpoint=api_endpoint, host=host, target=target)
+    params = {'machine_id': machine_id, 'host': host}
+    return url, params
+
+
+def _ipxescript_request(host, machine_id, ipxescript, api_endpoint=None):
+    validate.machine_id(machine_id)
+
+    if ipxescript is None:
+        raise ValueError('ipxescript must be set.')
+
+    url = get_url(api_endpoint=api_endpoint, host=host, target='ipxescript')
+    json_params = {'machine_id': machine_id,
+                   'host': host,
+                   'ipxescript': ipxescript}
+    return url, json_params
+
+
+def _bootorder_request(host, machine_id, bootorder, api_endpoint=None):
+    validate.machine_id(machine_id)
+    validate.bootorder(bootorder)
+
+    url = get_url(api_endpoint=api_endpoint, host=host, target='ipxescript')
+    json_params = {'machine_id': machine_id,
+                   'host': host,
+                   'bootorder': bootorder}
+    return url, json_params
+
+
+PreparedLaunch = namedtuple('PreparedLaunch',
+                            ['url', 'body', 'machine_id', 'host',
+                             'api_endpoint'])
+
+
+def prepare_launch(**arguments):
+    """
+    Validates launch arguments once, returning a PreparedLaunch with the
+    request body already encoded. Pass it to send_launch() as many times
+    as needed, which is much cheaper than calling launch() each time.
+
+    Takes the same keyword arguments as launch(), minus retry and deadline.
+    """
+    url, json_params = _launch_request(**arguments)
+    body = codec.dumps(json_params).encode('utf-8')
+    return PreparedLaunch(url=url,
+                          body=body,
+                          machine_id=json_params['machine_id'],
+                          host=json_params['host'],
+                          api_endpoint=arguments.get('api_endpoint'))
+
+
+def send_launch(prepared, retry=False, deadline=None):
+    """
+    Sends a launch made with prepare_launch().
+    """
+    return _invalidating_request(prepared.url,
+                                 prepared.body,
+                                 prepared.host,
+                                 prepared.machine_id,
+                                 prepared.api_endpoint,
+                                 retry=retry,
+                                 deadline=deadline)
+
+
 # FIXME: ordering
 @cli.cmd
 @cli.cmd_arg('machine_id')
@@ -125,51 +697,35 @@ def launch(machine_id,
            api_endpoint=None,
            host=None,
            want_topup=False,
-           retry=False):
+           retry=False,
+           deadline=None):
     """
     Only ipxescript or operating_system + ssh_key can be None.
     """
-    ipv4 = normalize_argument(ipv4)
-    ipv6 = normalize_argument(ipv6)
-    bandwidth = normalize_argument(bandwidth)
-
-    validate.ipv4(ipv4)
-    validate.ipv6(ipv6)
-    validate.bandwidth(bandwidth)
-    validate.cores(cores)
-    validate.disk(disk)
-    validate.memory(memory)
-    validate.organization(organization)
-    validate.machine_id(machine_id)
-    validate.ipxescript(ipxescript)
-    validate.operating_system(operating_system)
-    validate.ssh_key(ssh_key)
-
-    json_params = {'machine_id': machine_id,
-                   'days': days,
-                   'disk': disk,
-                   'memory': memory,
-                   'refund_address': refund_address,
-                   'cores': cores,
-                   'managed': managed,
-                   'currency': currency,
-                   'region': region,
-                   'organization': organization,
-                   'bandwidth': bandwidth,
-                   'ipv4': ipv4,
-                   'ipv6': ipv6,
-                   'override_code': override_code,
-                   'settlement_token': settlement_token,
-                   'qemuopts': qemuopts,
-                   'hostaccess': hostaccess,
-                   'ipxescript': ipxescript,
-                   'operating_system': operating_system,
-                   'ssh_key': ssh_key,
-                   'want_topup': want_topup,
-                   'host': host}
-
-    url = get_url(api_endpoint=api_endpoint, host=host, target='launch')
-    return api_request(url=url, json_params=json_params, retry=retry)
+    prepared = prepare_launch(machine_id=machine_id,
+                              days=days,
+                              disk=disk,
+                              memory=memory,
+                              ipv4=ipv4,
+                              ipv6=ipv6,
+                              bandwidth=bandwidth,
+                              currency=currency,
+                              region=region,
+                              ipxescript=ipxescript,
+                              operating_system=operating_system,
+                              ssh_key=ssh_key,
+                              organization=organization,
+                              refund_address=refund_address,
+                              cores=cores,
+                              managed=managed,
+                              override_code=override_code,
+                              settlement_token=settlement_token,
+                              qemuopts=qemuopts,
+                              hostaccess=hostaccess,
+                              api_endpoint=api_endpoint,
+                              host=host,
+                              want_topup=want_topup)
+    return send_launch(prepared, retry=retry, deadline=deadline)
 
 
 @cli.cmd
@@ -189,33 +745,32 @@ def topup(machine_id,
           override_code=None,
           api_endpoint=None,
           host=None,
-          retry=False):
-    validate.machine_id(machine_id)
-
-    json_params = {'machine_id': machine_id,
-                   'days': days,
-                   'refund_address': refund_address,
-                   'settlement_token': settlement_token,
-                   'currency': currency,
-                   'host': host,
-                   'override_code': override_code}
-    url = get_url(api_endpoint=api_endpoint, host=host, target='topup')
-    return api_request(url=url, json_params=json_params, retry=retry)
+          retry=False,
+          deadline=None):
+    url, json_params = _topup_request(machine_id=machine_id,
+                                      days=days,
+                                      currency=currency,
+                                      settlement_token=settlement_token,
+                                      refund_address=refund_address,
+                                      override_code=override_code,
+                                      api_endpoint=api_endpoint,
+                                      host=host)
+    return _invalidating_request(url, json_params, host, machine_id,
+                                 api_endpoint, retry=retry, deadline=deadline)
 
 
 @cli.cmd
 @cli.cmd_arg('machine_id')
 @cli.cmd_arg('--api_endpoint', type=str, default=None)
 @cli.cmd_arg('--host', type=str, default=None)
-def exists(machine_id, api_endpoint=None, host=None):
+def exists(machine_id, api_endpoint=None, host=None, deadline=None):
     """
     Checks if the VM exists.
     """
-    validate.machine_id(machine_id)
-
-    url = get_url(api_endpoint=api_endpoint, host=host, target='exists')
-    get_params = {'machine_id': machine_id, 'host': host}
-    output = api_request(url, get_params=get_params)
+    url, get_params = _machine_request('exists', host, machine_id,
+                                       api_endpoint=api_endpoint)
+    output = _cached_request('exists', url, get_params, host, machine_id,
+                             api_endpoint, deadline=deadline)
     return output['result']
 
 
@@ -223,15 +778,14 @@ def exists(machine_id, api_endpoint=None, host=None):
 @cli.cmd_arg('host')
 @cli.cmd_arg('machine_id')
 @cli.cmd_arg('--api_endpoint', type=str, default=None)
-def status(host, machine_id, api_endpoint=None):
+def status(host, machine_id, api_endpoint=None, deadline=None):
     """
     Checks if the VM is started or stopped.
     """
-    validate.machine_id(machine_id)
-
-    url = get_url(api_endpoint=api_endpoint, host=host, target='status')
-    get_params = {'machine_id': machine_id, 'host': host}
-    output = api_request(url, get_params=get_params)
+    url, get_params = _machine_request('status', host, machine_id,
+                                       api_endpoint=api_endpoint)
+    output = _cached_request('status', url, get_params, host, machine_id,
+                             api_endpoint, deadline=deadline)
     return output['result']
 
 
@@ -239,15 +793,14 @@ def status(host, machine_id, api_endpoint=None):
 @cli.cmd_arg('host')
 @cli.cmd_arg('machine_id')
 @cli.cmd_arg('--api_endpoint', type=str, default=None)
-def start(host, machine_id, api_endpoint=None):
+def start(host, machine_id, api_endpoint=None, deadline=None):
     """
     Boots the VM.
     """
-    validate.machine_id(machine_id)
-
-    url = get_url(api_endpoint=api_endpoint, host=host, target='start')
-    json_params = {'machine_id': machine_id, 'host': host}
-    api_request(url, json_params=json_params)
+    url, json_params = _machine_request('start', host, machine_id,
+                                        api_endpoint=api_endpoint)
+    _invalidating_request(url, json_params, host, machine_id, api_endpoint,
+                          deadline=deadline)
     return True
 
 
@@ -255,15 +808,14 @@ def start(host, machine_id, api_endpoint=None):
 @cli.cmd_arg('host')
 @cli.cmd_arg('machine_id')
 @cli.cmd_arg('--api_endpoint', type=str, default=None)
-def stop(host, machine_id, api_endpoint=None):
+def stop(host, machine_id, api_endpoint=None, deadline=None):
     """
     Immediately kills the VM.
     """
-    validate.machine_id(machine_id)
-
-    url = get_url(api_endpoint=api_endpoint, host=host, target='stop')
-    json_params = {'machine_id': machine_id, 'host': host}
-    api_request(url, json_params=json_params)
+    url, json_params = _machine_request('stop', host, machine_id,
+                                        api_endpoint=api_endpoint)
+    _invalidating_request(url, json_params, host, machine_id, api_endpoint,
+                          deadline=deadline)
     return True
 
 
@@ -271,55 +823,52 @@ def stop(host, machine_id, api_endpoint=None):
 @cli.cmd_arg('host')
 @cli.cmd_arg('machine_id')
 @cli.cmd_arg('--api_endpoint', type=str, default=None)
-def sshhostname(host, machine_id, api_endpoint=None):
+def sshhostname(host, machine_id, api_endpoint=None, deadline=None):
     """
     Returns a hostname that we can SSH into to reach
     port 22 on the VM.
     """
-    validate.machine_id(machine_id)
-
-    url = get_url(api_endpoint=api_endpoint, host=host, target='sshhostname')
-    get_params = {'machine_id': machine_id, 'host': host}
-    return api_request(url, get_params=get_params)
+    url, get_params = _machine_request('sshhostname', host, machine_id,
+                                       api_endpoint=api_endpoint)
+    return _cached_request('sshhostname', url, get_params, host, machine_id,
+                           api_endpoint, deadline=deadline)
 
 
 @cli.cmd
 @cli.cmd_arg('host')
 @cli.cmd_arg('machine_id')
 @cli.cmd_arg('--api_endpoint', type=str, default=None)
-def info(host, machine_id, api_endpoint=None):
+def info(host, machine_id, api_endpoint=None, deadline=None):
     """
     Returns info about the VM.
     """
-    validate.machine_id(machine_id)
-
-    url = get_url(api_endpoint=api_endpoint, host=host, target='info')
-    get_params = {'machine_id': machine_id, 'host': host}
-    return api_request(url, get_params=get_params)
+    url, get_params = _machine_request('info', host, machine_id,
+                                       api_endpoint=api_endpoint)
+    return _cached_request('info', url, get_params, host, machine_id,
+                           api_endpoint, deadline=deadline)
 
 
 @cli.cmd
 @cli.cmd_arg('host')
 @cli.cmd_arg('machine_id')
 @cli.cmd_arg('--api_endpoint', type=str, default=None)
-def ipxescript(host, machine_id, ipxescript=None, api_endpoint=None):
+def ipxescript(host,
+               machine_id,
+               ipxescript=None,
+               api_endpoint=None,
+               deadline=None):
     """
     Trying to make this both useful as a CLI tool and
     as a library. Not really sure how to do that best.
     """
-    validate.machine_id(machine_id)
-
     if ipxescript is None:
         if __name__ == '__main__':
             ipxescript = sys.stdin.read()
-        else:
-            raise ValueError('ipxescript must be set.')
 
-    url = get_url(api_endpoint=api_endpoint, host=host, target='ipxescript')
-    json_params = {'machine_id': machine_id,
-                   'host': host,
-                   'ipxescript': ipxescript}
-    return api_request(url, json_params=json_params)
+    url, json_params = _ipxescript_request(host, machine_id, ipxescript,
+                                           api_endpoint=api_endpoint)
+    return _invalidating_request(url, json_params, host, machine_id,
+                                 api_endpoint, deadline=deadline)
 
 
 @cli.cmd
@@ -327,31 +876,32 @@ def ipxescript(host, machine_id, ipxescript=None, api_endpoint=None):
 @cli.cmd_arg('machine_id')
 @cli.cmd_arg('bootorder')
 @cli.cmd_arg('--api_endpoint', type=str, default=None)
-def bootorder(host, machine_id, bootorder, api_endpoint=None):
+def bootorder(host,
+              machine_id,
+              bootorder,
+              api_endpoint=None,
+              deadline=None):
     """
     Updates the boot order for a VM.
     """
-    validate.machine_id(machine_id)
-    validate.bootorder(bootorder)
-
-    url = get_url(api_endpoint=api_endpoint, host=host, target='ipxescript')
-    json_params = {'machine_id': machine_id,
-                   'host': host,
-                   'bootorder': bootorder}
-    return api_request(url, json_params=json_params)
+    url, json_params = _bootorder_request(host, machine_id, bootorder,
+                                          api_endpoint=api_endpoint)
+    return _invalidating_request(url, json_params, host, machine_id,
+                                 api_endpoint, deadline=deadline)
 
 
 @cli.cmd
 @cli.cmd_arg('host')
 @cli.cmd_arg('--api_endpoint', type=str, default=None)
-def host_info(host, api_endpoint=None):
+def host_info(host, api_endpoint=None, deadline=None):
     """
     Returns info about the host.
 
     FIXME: Returns json for now, should return a dict?
     """
     url = get_url(api_endpoint=api_endpoint, host=host, target='host_info')
-    return api_request(url)
+    return _cached_request('host_info', url, None, host, None, api_endpoint,
+                           deadline=deadline)
 
 
 @cli.cmd
@@ -361,6 +911,9 @@ def serialconsole(host, machine_id):
     """
     ctrl + \ to quit.
     """
+    # paramiko is slow to import, so only when we need it.
+    from . import ssh
+
     validate.machine_id(machine_id)
 
     command = 'serialconsole {}'.format(machine_id)
@@ -0,0 +1,295 @@
+"""
+asyncio version of api_client.
+
+Every call here is a coroutine that takes the same arguments as its
+api_client counterpart and shares its validation and URL building. At
+most CONCURRENCY_LIMIT requests are in flight per event loop.
+
+Needs aiohttp: pip install sporestack[async]
+"""
+
+import asyncio
+import logging
+import weakref
+from time import monotonic, time
+
+try:
+    import aiohttp
+except ImportError:
+    raise ImportError('api_client_async needs aiohttp, '
+                      'try: pip install sporestack[async]')
+
+from . import api_client
+from .circuit import CircuitOpenError
+from .retry import get_policy, retry_after_seconds
+
+CONCURRENCY_LIMIT = 100
+
+# event loop -> aiohttp.ClientSession / asyncio.Semaphore
+_sessions = weakref.WeakKeyDictionary()
+_limiters = weakref.WeakKeyDictionary()
+
+
+def set_concurrency(limit):
+    """
+    Sets how many requests can be in flight at once, per event loop.
+
+    Takes effect for event loops that have not made a request yet.
+    """
+    global CONCURRENCY_LIMIT
+    if not isinstance(limit, int) or limit < 1:
+        raise ValueError('limit must be a positive integer.')
+    CONCURRENCY_LIMIT = limit
+
+
+def _limiter():
+    loop = asyncio.get_running_loop()
+    if loop not in _limiters:
+        _limiters[loop] = asyncio.Semaphore(CONCURRENCY_LIMIT)
+    return _limiters[loop]
+
+
+def _get_session():
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=CONCURRENCY_LIMIT)
+        session = aiohttp.ClientSession(connector=connector)
+        _sessions[loop] = session
+    return session
+
+
+async def close():
+    """
+    Closes the running event loop's session. Call before the loop ends.
+    """
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+def _clean_params(params):
+    """
+    requests drops None values from query strings, aiohttp refuses them.
+    """
+    if params is None:
+        return None
+    return {key: value for key, value in params.items() if value is not None}
+
+
+async def _attempt(url, json_params, get_params, deadline, breaker, key,
+                   policy):
+    """
+    Makes one request. Returns (error, retryable, retry_after, output),
+    where error is None if it worked.
+    """
+    async with _limiter():
+        # Before before_call(), which can take a half-open trial call.
+        connect, read = api_client.get_timeout(url, deadline)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect,
+                                        sock_read=read)
+        if breaker is not None:
+            breaker.before_call(key)
+        try:
+            session = _get_session()
+            if json_params is None:
+                request = session.get(url,
+                                      params=_clean_params(get_params),
+                                      timeout=timeout)
+            else:
+                request = session.post(url,
+                                       json=json_params,
+                                       timeout=timeout)
+            async with request as response:
+                status_code = response.status
+                content = await response.read()
+                content_type = response.headers.get('Content-Type')
+                retry_after = response.headers.get('Retry-After')
+        except Exception as e:
+            if breaker is not None:
+                breaker.failure(key)
+            return e, True, None, None
+        except BaseException:
+            # Cancelled, so we don't know how the endpoint is doing.
+            if breaker is not None:
+                breaker.release(key)
+            raise
+
+    if breaker is not None:
+        if status_code // 100 == 5:
+            breaker.failure(key)
+        else:
+            breaker.success(key)
+    if status_code // 100 == 2:
+        policy.success(key)
+        output = api_client.decode_response(content_type, content)
+        return None, None, None, output
+    error, retryable = api_client.http_error(status_code, content)
+    return error, retryable, retry_after_seconds(retry_after), None
+
+
+async def api_request(url,
+                      json_params=None,
+                      get_params=None,
+                      retry=False,
+                      deadline=None):
+    """
+    retry and deadline work as in api_client.api_request.
+    """
+    policy = get_policy(retry)
+    key = api_client.session_key(url)
+    started = monotonic()
+    attempt = 0
+    while True:
+        attempt = attempt + 1
+        breaker = api_client.get_circuit_breaker()
+        try:
+            error, retryable, retry_after, output = await _attempt(
+                url, json_params, get_params, deadline, breaker, key, policy)
+        except CircuitOpenError as e:
+            # Waited out like a Retry-After, if the policy lets us.
+            error = e
+            retryable = True
+            retry_after = e.retry_in
+        else:
+            if error is None:
+                return output
+
+        delay = None
+        if retryable is True:
+            delay = policy.next_delay(key, attempt, started, retry_after)
+        if delay is not None and deadline is not None:
+            if time() + delay >= deadline:
+                delay = None
+        if delay is None:
+            raise error
+        message = 'Got an error, retrying in {:.1f} seconds: {}'
+        logging.warning(message.format(delay, error))
+        await asyncio.sleep(delay)
+
+
+async def launch(machine_id, *args, retry=False, deadline=None, **kwargs):
+    """
+    Takes the same arguments as api_client.launch.
+    """
+    url, json_params = api_client._launch_request(machine_id, *args, **kwargs)
+    return await api_request(url=url,
+                             json_params=json_params,
+                             retry=retry,
+                             deadline=deadline)
+
+
+async def topup(machine_id, *args, retry=False, deadline=None, **kwargs):
+    """
+    Takes the same arguments as api_client.topup.
+    """
+    url, json_params = api_client._topup_request(machine_id, *args, **kwargs)
+    return await api_request(url=url,
+                             json_params=json_params,
+                             retry=retry,
+                             deadline=deadline)
+
+
+async def exists(machine_id, api_endpoint=None, host=None, deadline=None):
+    """
+    Checks if the VM exists.
+    """
+    url, get_params = api_client._machine_request('exists', host, machine_id,
+                                                  api_endpoint=api_endpoint)
+    output = await api_request(url, get_params=get_params,
+                               deadline=deadline)
+    return output['result']
+
+
+async def status(host, machine_id, api_endpoint=None, deadline=None):
+    """
+    Checks if the VM is started or stopped.
+    """
+    url, get_params = api_client._machine_request('status', host, machine_id,
+                                                  api_endpoint=api_endpoint)
+    output = await api_request(url, get_params=get_params,
+                               deadline=deadline)
+    return output['result']
+
+
+async def start(host, machine_id, api_endpoint=None, deadline=None):
+    """
+    Boots the VM.
+    """
+    url, json_params = api_client._machine_request('start', host, machine_id,
+                                                   api_endpoint=api_endpoint)
+    await api_request(url, json_params=json_params,
+                      deadline=deadline)
+    return True
+
+
+async def stop(host, machine_id, api_endpoint=None, deadline=None):
+    """
+    Immediately kills the VM.
+    """
+    url, json_params = api_client._machine_request('stop', host, machine_id,
+                                                   api_endpoint=api_endpoint)
+    await api_request(url, json_params=json_params,
+                      deadline=deadline)
+    return True
+
+
+async def sshhostname(host, machine_id, api_endpoint=None, deadline=None):
+    """
+    Returns a hostname that we can SSH into to reach
+    port 22 on the VM.
+    """
+    url, get_params = api_client._machine_request('sshhostname',
+                                                  host,
+                                                  machine_id,
+                                                  api_endpoint=api_endpoint)
+    return await api_request(url, get_params=get_params,
+                             deadline=deadline)
+
+
+async def info(host, machine_id, api_endpoint=None, deadline=None):
+    """
+    Returns info about the VM.
+    """
+    url, get_params = api_client._machine_request('info', host, machine_id,
+                                                  api_endpoint=api_endpoint)
+    return await api_request(url, get_params=get_params,
+                             deadline=deadline)
+
+
+async def ipxescript(host,
+                     machine_id,
+                     ipxescript,
+                     api_endpoint=None,
+                     deadline=None):
+    """
+    Sets the iPXE script for a VM.
+    """
+    url, json_params = api_client._ipxescript_request(
+        host, machine_id, ipxescript, api_endpoint=api_endpoint)
+    return await api_request(url, json_params=json_params,
+                             deadline=deadline)
+
+
+async def bootorder(host,
+                    machine_id,
+                    bootorder,
+                    api_endpoint=None,
+                    deadline=None):
+    """
+    Updates the boot order for a VM.
+    """
+    url, json_params = api_client._bootorder_request(
+        host, machine_id, bootorder, api_endpoint=api_endpoint)
+    return await api_request(url, json_params=json_params,
+                             deadline=deadline)
+
+
+async def host_info(host, api_endpoint=None, deadline=None):
+    """
+    Returns info about the host.
+    """
+    url = api_client.get_url(api_endpoint=api_endpoint,
+                             host=host,
+                             target='host_info')
+    return await api_request(url, deadline=deadline)
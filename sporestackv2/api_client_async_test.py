@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from . import api_client_async  # noqa: E402
+
+valid_id = '01ba4719c80b6fe911b091a7c05124b64eeece964e09c058ef8f9805daca546b'
+
+
+def test_clean_params():
+    params = {'machine_id': valid_id, 'host': None}
+    assert api_client_async._clean_params(params) == {'machine_id': valid_id}
+    assert api_client_async._clean_params(None) is None
+
+
+def test_validation_is_shared():
+    with pytest.raises(ValueError):
+        asyncio.run(api_client_async.status('foo.bar', 'bad'))
+
+
+def test_requests():
+    in_flight = [0, 0]
+
+    async def exists(request):
+        assert request.query['machine_id'] == valid_id
+        assert 'host' not in request.query
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        return web.json_response({'result': True})
+
+    async def start(request):
+        body = await request.json()
+        assert body['machine_id'] == valid_id
+        return web.json_response({})
+
+    async def bad(request):
+        return web.Response(status=400, body=b'nope')
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/v2/exists', exists)
+        app.router.add_post('/v2/start', start)
+        app.router.add_get('/v2/host_info', bad)
+        async with TestServer(app) as server:
+            endpoint = str(server.make_url('')).rstrip('/')
+            calls = [api_client_async.exists(valid_id, api_endpoint=endpoint)
+                     for _ in range(10)]
+            assert await asyncio.gather(*calls) == [True] * 10
+            assert await api_client_async.start(None,
+                                                valid_id,
+                                                api_endpoint=endpoint)
+            with pytest.raises(ValueError):
+                await api_client_async.host_info(None, api_endpoint=endpoint)
+            await api_client_async.close()
+
+    limit = api_client_async.CONCURRENCY_LIMIT
+    try:
+        api_client_async.set_concurrency(3)
+        asyncio.run(main())
+    finally:
+        api_client_async.set_concurrency(limit)
+    assert in_flight[1] == 3
@@ -0,0 +1,346 @@
+import json
+import threading
+import time
+
+import pytest
+
+from . import api_client
+from . import cache
+from . import circuit
+from . import retry
+
+
+def test_session_key():
+    key = api_client.session_key('https://api.sporestack.com/v2/launch')
+    assert key == 'https://api.sporestack.com'
+    url = api_client.get_url(api_endpoint=None, host='foo.bar:8080',
+                             target='info')
+    assert api_client.session_key(url) == 'http://foo.bar:8080'
+    with pytest.raises(ValueError):
+        api_client.session_key('/v2/launch')
+
+
+def test_get_session_reuse():
+    api_client.close_sessions()
+    first = api_client.get_session('https://foo.bar/v2/info')
+    assert api_client.get_session('https://foo.bar/v2/status') is first
+    assert api_client.get_session('https://baz.bar/v2/info') is not first
+    api_client.close_sessions()
+    assert api_client.get_session('https://foo.bar/v2/info') is not first
+    api_client.close_sessions()
+
+
+def test_get_session_idle_timeout():
+    api_client.close_sessions()
+    idle_timeout = api_client.SESSION_IDLE_TIMEOUT
+    try:
+        api_client.configure_sessions(idle_timeout=0)
+        first = api_client.get_session('https://foo.bar/v2/info')
+        # Can't sleep less than the clock resolution, so fake it.
+        api_client._sessions['https://foo.bar'][1] -= 1
+        assert api_client.get_session('https://foo.bar/v2/info') is not first
+    finally:
+        api_client.configure_sessions(idle_timeout=idle_timeout)
+        api_client.close_sessions()
+
+
+def test_set_session():
+    class FakeSession:
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    api_client.close_sessions()
+    session = FakeSession()
+    api_client.set_session('https://foo.bar', session)
+    assert api_client.get_session('https://foo.bar/v2/info') is session
+    # configure_sessions() leaves injected sessions alone.
+    api_client.configure_sessions(pool_size=api_client.SESSION_POOL_SIZE)
+    assert session.closed is False
+    assert api_client.get_session('https://foo.bar/v2/info') is session
+    api_client.close_sessions()
+    assert session.closed is True
+
+    with pytest.raises(ValueError):
+        api_client.configure_sessions(pool_size=0)
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b'{}', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def get(self, url, params=None, timeout=None):
+        self.calls.append(params)
+        response = self.responses.pop(0)
+        if isinstance(response, BaseException):
+            raise response
+        return response
+
+    def close(self):
+        pass
+
+
+def test_api_request_retries(monkeypatch):
+    monkeypatch.setattr(api_client, 'sleep', lambda seconds: None)
+    policy = retry.RetryPolicy(max_attempts=4, deadline=None)
+    session = FakeSession([ConnectionError('down'),
+                           FakeResponse(503, b'busy'),
+                           FakeResponse(429, b'slow down',
+                                        {'Retry-After': '1'}),
+                           FakeResponse(200, b'{"result": true}')])
+    api_client.set_session('http://foo.bar', session)
+    try:
+        output = api_client.api_request('http://foo.bar/v2/exists',
+                                        get_params={'machine_id': 'a'},
+                                        retry=policy)
+    finally:
+        api_client.close_sessions()
+    assert output == {'result': True}
+    # get_params must survive every retry.
+    assert session.calls == [{'machine_id': 'a'}] * 4
+
+
+def test_api_request_gives_up(monkeypatch):
+    monkeypatch.setattr(api_client, 'sleep', lambda seconds: None)
+    policy = retry.RetryPolicy(max_attempts=2, deadline=None)
+    session = FakeSession([FakeResponse(500, b'broke'),
+                           FakeResponse(500, b'broke again'),
+                           FakeResponse(400, b'bad')])
+    api_client.set_session('http://foo.bar', session)
+    try:
+        with pytest.raises(Exception) as e:
+            api_client.api_request('http://foo.bar/v2/info', retry=policy)
+        assert e.value.args == (b'broke again',)
+        # 4xx are never retried.
+        with pytest.raises(ValueError):
+            api_client.api_request('http://foo.bar/v2/info', retry=policy)
+    finally:
+        api_client.close_sessions()
+    assert session.responses == []
+
+
+def test_response_cache():
+    machine_id = 64 * 'a'
+    session = FakeSession([FakeResponse(200, b'{"result": "started"}'),
+                           FakeResponse(200, b'{"result": "stopped"}')])
+    session.post = lambda url, json=None, timeout=None: FakeResponse(200)
+    api_client.set_session('http://foo.bar', session)
+    api_client.set_response_cache(cache.ResponseCache())
+    try:
+        assert api_client.status('foo.bar', machine_id) == 'started'
+        assert api_client.status('foo.bar', machine_id) == 'started'
+        assert len(session.calls) == 1
+        assert api_client.stop('foo.bar', machine_id) is True
+        assert api_client.status('foo.bar', machine_id) == 'stopped'
+        assert len(session.calls) == 2
+    finally:
+        api_client.set_response_cache(None)
+        api_client.close_sessions()
+
+
+def test_coalescing(monkeypatch):
+    release = threading.Event()
+    calls = []
+
+    def fake_api_request(url, json_params=None, get_params=None,
+                         retry=False, deadline=None):
+        calls.append(url)
+        release.wait(5)
+        if url.endswith('bad'):
+            raise ValueError('bad')
+        return {'url': url}
+
+    monkeypatch.setattr(api_client, '_api_request', fake_api_request)
+    api_client.reset_coalesce_stats()
+    outputs = []
+    errors = []
+
+    def get(url, get_params):
+        try:
+            outputs.append(api_client.api_request(url, get_params=get_params))
+        except ValueError as e:
+            errors.append(e)
+
+    threads = []
+    for url, get_params in [('http://foo.bar/info', {'a': '1', 'b': '2'}),
+                            ('http://foo.bar/info', {'b': '2', 'a': '1'}),
+                            ('http://foo.bar/info', {'a': '1', 'b': '2'}),
+                            ('http://foo.bar/info', {'a': '2'}),
+                            ('http://foo.bar/bad', None),
+                            ('http://foo.bar/bad', None)]:
+        thread = threading.Thread(target=get, args=(url, get_params))
+        thread.start()
+        threads.append(thread)
+    # Let every thread find its flight before any finish.
+    while sum(api_client.coalesce_stats().values()) < 6:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(calls) == ['http://foo.bar/bad',
+                             'http://foo.bar/info',
+                             'http://foo.bar/info']
+    assert api_client.coalesce_stats() == {'requests': 3, 'coalesced': 3}
+    assert len(outputs) == 4
+    assert len(errors) == 2
+    assert errors[0] is errors[1]
+    assert api_client._in_flight == {}
+
+
+def test_circuit_breaker(monkeypatch):
+    now = [1000.0]
+
+    def fake_sleep(seconds):
+        now[0] = now[0] + seconds
+
+    monkeypatch.setattr(circuit, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(api_client, 'sleep', fake_sleep)
+    breaker = circuit.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    session = FakeSession([FakeResponse(500),
+                           FakeResponse(502),
+                           FakeResponse(200, b'{"result": true}'),
+                           FakeResponse(500),
+                           FakeResponse(500)])
+    api_client.set_session('http://foo.bar', session)
+    old_breaker = api_client.get_circuit_breaker()
+    api_client.set_circuit_breaker(breaker)
+    try:
+        # Waits for the circuit to be half-open and tries again.
+        output = api_client.api_request('http://foo.bar/v2/info', retry=True)
+        assert output == {'result': True}
+        assert now[0] >= 1060.0
+        assert breaker.state('http://foo.bar') == circuit.CLOSED
+        with pytest.raises(Exception):
+            api_client.api_request('http://foo.bar/v2/info')
+        with pytest.raises(Exception):
+            api_client.api_request('http://foo.bar/v2/info')
+        # Without retry, fails fast without touching the session again.
+        with pytest.raises(circuit.CircuitOpenError):
+            api_client.api_request('http://foo.bar/v2/info')
+        assert len(session.calls) == 5
+    finally:
+        api_client.set_circuit_breaker(old_breaker)
+        api_client.close_sessions()
+
+
+def test_circuit_breaker_interrupted(monkeypatch):
+    breaker = circuit.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.failure('http://foo.bar')
+    session = FakeSession([KeyboardInterrupt(),
+                           FakeResponse(200, b'{"result": true}')])
+    api_client.set_session('http://foo.bar', session)
+    old_breaker = api_client.get_circuit_breaker()
+    api_client.set_circuit_breaker(breaker)
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            api_client.api_request('http://foo.bar/v2/info')
+        # The half-open trial call was given back.
+        assert api_client.api_request('http://foo.bar/v2/info') == \
+            {'result': True}
+    finally:
+        api_client.set_circuit_breaker(old_breaker)
+        api_client.close_sessions()
+
+
+def test_get_timeout(monkeypatch):
+    assert api_client.get_timeout('http://foo.bar/v2/exists') == (5, 30)
+    assert api_client.get_timeout('http://foo.bar/v2/launch') == (10, 330)
+    assert api_client.get_timeout('http://foo.bar/v2/new') == \
+        api_client.DEFAULT_TIMEOUT
+    monkeypatch.setattr(api_client, 'time', lambda: 1000.0)
+    assert api_client.get_timeout('http://foo.bar/v2/launch',
+                                  deadline=1020.0) == (10, 20)
+    assert api_client.get_timeout('http://foo.bar/v2/launch',
+                                  deadline=1003.0) == (3, 3)
+    with pytest.raises(api_client.DeadlineExceeded):
+        api_client.get_timeout('http://foo.bar/v2/launch', deadline=1000.0)
+    assert api_client.remaining(None) is None
+
+
+def test_api_request_deadline(monkeypatch):
+    now = [1000.0]
+
+    def fake_sleep(seconds):
+        now[0] = now[0] + seconds
+
+    monkeypatch.setattr(api_client, 'time', lambda: now[0])
+    monkeypatch.setattr(api_client, 'sleep', fake_sleep)
+    policy = retry.RetryPolicy(max_attempts=None, deadline=None,
+                               base_delay=4, max_delay=4)
+    session = FakeSession([FakeResponse(503)] * 100)
+    api_client.set_session('http://foo.bar', session)
+    old_breaker = api_client.get_circuit_breaker()
+    api_client.set_circuit_breaker(None)
+    try:
+        with pytest.raises(Exception):
+            api_client.api_request('http://foo.bar/v2/info',
+                                   retry=policy,
+                                   deadline=1010.0)
+    finally:
+        api_client.set_circuit_breaker(old_breaker)
+        api_client.close_sessions()
+    # Never slept past the deadline.
+    assert now[0] < 1010.0
+    assert 1 < len(session.calls) < 100
+
+
+def test_decode_response():
+    assert api_client.decode_response('application/json', b'{"a": 1}') == \
+        {'a': 1}
+    assert api_client.decode_response(None, b'{"a": 1}') == {'a': 1}
+    assert api_client.decode_response(None, b'not json') == b'not json'
+    assert api_client.decode_response('text/plain', b'{"a": 1}') == \
+        b'{"a": 1}'
+    assert api_client.decode_response('application/json', b'[1]') == [1]
+
+
+def test_prepare_launch():
+    machine_id = 64 * 'a'
+    prepared = api_client.prepare_launch(machine_id=machine_id,
+                                         days=1,
+                                         disk=5,
+                                         memory=1,
+                                         ipv4='/32',
+                                         ipv6='/128',
+                                         bandwidth=1,
+                                         currency='bch',
+                                         operating_system='debian-9',
+                                         host='foo.bar')
+    assert prepared.url == 'http://foo.bar/v2/launch'
+    assert json.loads(prepared.body)['machine_id'] == machine_id
+    assert prepared.host == 'foo.bar'
+    with pytest.raises(ValueError):
+        api_client.prepare_launch(machine_id=machine_id,
+                                  days=1,
+                                  disk=5,
+                                  memory=0,
+                                  ipv4='/32',
+                                  ipv6='/128',
+                                  bandwidth=1,
+                                  currency='bch',
+                                  host='foo.bar')
+
+    posts = []
+    session = FakeSession([])
+    session.post = lambda url, data=None, headers=None, timeout=None: \
+        posts.append((data, headers)) or FakeResponse(200, b'{"paid": true}')
+    api_client.set_session('http://foo.bar', session)
+    try:
+        assert api_client.send_launch(prepared) == {'paid': True}
+        assert api_client.send_launch(prepared) == {'paid': True}
+    finally:
+        api_client.close_sessions()
+    assert posts == [(prepared.body, api_client.JSON_HEADERS)] * 2
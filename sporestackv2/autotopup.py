@@ -0,0 +1,214 @@
+"""
+Keeps local machines alive by topping them up before they expire.
+
+Machines are kept in a heap ordered by when they come due (expiration
+minus lead_time), so we only wake up for the next one instead of reading
+every saved machine over and over. Saved machines are only looked at
+again when the machine store changes, and only the ones that changed are
+read: those named in what was appended to the JSON index since last time,
+or for SQLite those whose version moved on.
+"""
+
+import heapq
+import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, time
+
+from . import client
+
+# Top machines up this many seconds before they expire.
+LEAD_TIME = 2 * 24 * 60 * 60
+# Topups in flight at once.
+WORKERS = 4
+# Check the machine store for new or deleted machines this often.
+RESCAN_INTERVAL = 60
+# Seconds to wait before trying a failed topup again.
+RETRY_DELAY = 300
+
+
+class Scheduler:
+    def __init__(self,
+                 topup,
+                 lead_time=LEAD_TIME,
+                 workers=WORKERS,
+                 rescan_interval=RESCAN_INTERVAL,
+                 retry_delay=RETRY_DELAY):
+        """
+        topup(vm_hostname) tops a machine up and returns its new
+        expiration, a Unix timestamp.
+        """
+        if workers < 1:
+            raise ValueError('workers must be at least 1.')
+        self.topup = topup
+        self.lead_time = lead_time
+        self.workers = workers
+        self.rescan_interval = rescan_interval
+        self.retry_delay = retry_delay
+        # (due, vm_hostname), may hold stale entries. _due has the live ones.
+        self._heap = []
+        self._due = {}
+        self._running = set()
+        self._generation = None
+        # vm_hostname -> its store version when we last read it.
+        self._versions = {}
+        # (store name, changes() position) we've read up to.
+        self._position = None
+
+    def schedule(self, vm_hostname, expiration):
+        """
+        Schedules vm_hostname's next topup from its expiration. None or 0
+        (never expires) stops scheduling it.
+        """
+        self._due.pop(vm_hostname, None)
+        if expiration is None or expiration == 0:
+            return
+        self._push(vm_hostname, expiration - self.lead_time)
+
+    def _push(self, vm_hostname, due):
+        self._due[vm_hostname] = due
+        heapq.heappush(self._heap, (due, vm_hostname))
+
+    def next_due(self):
+        """
+        Returns when the next topup is due, or None if nothing is scheduled.
+        """
+        while len(self._heap) != 0:
+            due, vm_hostname = self._heap[0]
+            if self._due.get(vm_hostname) == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now):
+        """
+        Returns every vm_hostname due by now, unscheduling them.
+        """
+        vm_hostnames = []
+        while True:
+            due = self.next_due()
+            if due is None or due > now:
+                return vm_hostnames
+            due, vm_hostname = heapq.heappop(self._heap)
+            del self._due[vm_hostname]
+            if vm_hostname not in self._running:
+                vm_hostnames.append(vm_hostname)
+
+    def _load(self, vm_hostname):
+        machine_info = client.get_machine_info(vm_hostname)
+        if machine_info.get('state', client.CREATED) != client.CREATED:
+            # Still launching, resume() deals with those.
+            self.schedule(vm_hostname, None)
+            return None
+        expiration = machine_info.get('expiration')
+        if expiration is None:
+            message = '{} has no expiration saved, top it up once by hand.'
+            logging.warning(message.format(vm_hostname))
+        self.schedule(vm_hostname, expiration)
+        return expiration
+
+    def refresh(self):
+        """
+        Picks up new, changed and deleted machines if the machine store
+        has changed since last time. Returns True if it had.
+        """
+        machines = client.machine_store()
+        generation = (machines.name, machines.generation())
+        if generation == self._generation:
+            return False
+        self._generation = generation
+
+        since = None
+        if self._position is not None and self._position[0] == machines.name:
+            since = self._position[1]
+        changed, position = machines.changes(since)
+        self._position = (machines.name, position)
+        # Changed without a word in the index (say, written by hand) means
+        # looking at everything.
+        if changed is not None and len(changed) != 0:
+            for vm_hostname in changed:
+                if machines.exists(vm_hostname):
+                    # Not known, so a full look reads it again.
+                    self._versions[vm_hostname] = None
+                    self._reload(vm_hostname)
+                else:
+                    self._versions.pop(vm_hostname, None)
+                    self.schedule(vm_hostname, None)
+            return True
+
+        versions = machines.versions()
+        for vm_hostname, version in versions.items():
+            if self._versions.get(vm_hostname) == version:
+                continue
+            self._versions[vm_hostname] = version
+            self._reload(vm_hostname)
+        for vm_hostname in set(self._versions) - set(versions):
+            del self._versions[vm_hostname]
+            self.schedule(vm_hostname, None)
+        return True
+
+    def _reload(self, vm_hostname):
+        try:
+            self._load(vm_hostname)
+        except Exception as e:
+            logging.warning('Skipping {}: {}'.format(vm_hostname, e))
+
+    def _topup_one(self, vm_hostname):
+        # Someone else may have topped it up since we last looked.
+        expiration = client.get_machine_info(vm_hostname).get('expiration')
+        if expiration is not None and expiration - self.lead_time > time():
+            logging.info('{} was already topped up.'.format(vm_hostname))
+            return expiration
+        logging.info('Topping up {}.'.format(vm_hostname))
+        return self.topup(vm_hostname)
+
+    def _finish(self, vm_hostname, future):
+        self._running.discard(vm_hostname)
+        output = {'vm_hostname': vm_hostname}
+        try:
+            expiration = future.result()
+        except Exception as e:
+            output['error'] = str(e)
+            self._push(vm_hostname, time() + self.retry_delay)
+            return output
+        output['result'] = expiration
+        self.schedule(vm_hostname, expiration)
+        return output
+
+    def run(self, once=False):
+        """
+        Tops machines up as they come due, workers at a time. Yields an
+        output per topup as client.sweep() does.
+
+        Runs forever, unless once, in which case it returns after topping
+        up whatever was due.
+        """
+        finished = queue.Queue()
+        last_scan = None
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                if last_scan is None or \
+                        monotonic() - last_scan >= self.rescan_interval:
+                    self.refresh()
+                    last_scan = monotonic()
+                for vm_hostname in self.pop_due(time()):
+                    self._running.add(vm_hostname)
+                    future = executor.submit(self._topup_one, vm_hostname)
+                    future.add_done_callback(
+                        lambda future, vm_hostname=vm_hostname:
+                            finished.put((vm_hostname, future)))
+
+                if once is True:
+                    if len(self._running) == 0:
+                        return
+                    timeout = None
+                else:
+                    timeout = self.rescan_interval
+                    due = self.next_due()
+                    if due is not None:
+                        timeout = max(0, min(timeout, due - time()))
+                try:
+                    vm_hostname, future = finished.get(timeout=timeout)
+                except queue.Empty:
+                    continue
+                yield self._finish(vm_hostname, future)
@@ -0,0 +1,91 @@
+import json
+import os
+from time import time
+
+from . import autotopup
+from . import client
+
+
+def save(directory, vm_hostname, **machine_info):
+    machine_info['vm_hostname'] = vm_hostname
+    path = directory / '{}.json'.format(vm_hostname)
+    path.write_text(json.dumps(machine_info))
+
+
+def test_schedule():
+    scheduler = autotopup.Scheduler(None, lead_time=10)
+    assert scheduler.next_due() is None
+    scheduler.schedule('a', 100)
+    scheduler.schedule('b', 50)
+    scheduler.schedule('c', 0)
+    assert scheduler.next_due() == 40
+    # Rescheduling leaves a stale entry behind, which is skipped.
+    scheduler.schedule('b', 200)
+    assert scheduler.next_due() == 90
+    assert scheduler.pop_due(89) == []
+    assert scheduler.pop_due(1000) == ['a', 'b']
+    assert scheduler.next_due() is None
+
+
+def test_refresh(tmp_path, monkeypatch):
+    monkeypatch.setattr(client, 'machine_info_directory',
+                        lambda: str(tmp_path))
+    loaded = []
+    scheduler = autotopup.Scheduler(None, lead_time=10)
+    original_load = scheduler._load
+    monkeypatch.setattr(scheduler, '_load',
+                        lambda vm_hostname: loaded.append(vm_hostname) or
+                        original_load(vm_hostname))
+
+    save(tmp_path, 'a', expiration=100)
+    save(tmp_path, 'b', expiration=50)
+    save(tmp_path, 'c', state=client.PENDING_PAYMENT)
+    (tmp_path / 'machine_id_seed').write_text('')
+    assert scheduler.refresh() is True
+    assert sorted(loaded) == ['a', 'b', 'c']
+    assert scheduler.next_due() == 40
+
+    # Nothing changed, nothing read.
+    assert scheduler.refresh() is False
+    save(tmp_path, 'd', expiration=20)
+    os.remove(str(tmp_path / 'b.json'))
+    # Make sure the directory looks changed, whatever the mtime resolution.
+    os.utime(str(tmp_path), ns=(0, 0))
+    assert scheduler.refresh() is True
+    assert sorted(loaded) == ['a', 'b', 'c', 'd']
+    assert scheduler.pop_due(1000) == ['d', 'a']
+
+    # Saved and deleted as usual, only those named in the index are read.
+    monkeypatch.setattr(client.machine_store(), 'versions', None)
+    client.save_machine_info({'vm_hostname': 'e', 'expiration': 30})
+    client.delete_machine_info('c')
+    assert scheduler.refresh() is True
+    assert sorted(loaded) == ['a', 'b', 'c', 'd', 'e']
+    assert scheduler.pop_due(1000) == ['e']
+    assert 'c' not in scheduler._versions
+
+
+def test_run_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(client, 'machine_info_directory',
+                        lambda: str(tmp_path))
+    now = int(time())
+    save(tmp_path, 'due', expiration=now + 10)
+    save(tmp_path, 'broken', expiration=now + 10)
+    save(tmp_path, 'later', expiration=now + 10000)
+
+    def topup(vm_hostname):
+        if vm_hostname == 'broken':
+            raise ValueError('broken')
+        return now + 20000
+
+    scheduler = autotopup.Scheduler(topup, lead_time=100, workers=2)
+    outputs = sorted(scheduler.run(once=True),
+                     key=lambda output: output['vm_hostname'])
+    assert outputs == [{'vm_hostname': 'broken', 'error': 'broken'},
+                       {'vm_hostname': 'due', 'result': now + 20000}]
+    # Failures are tried again after retry_delay.
+    assert scheduler._due['broken'] > now + autotopup.RETRY_DELAY - 10
+    assert scheduler._due['due'] == now + 20000 - 100
+    assert scheduler._due['later'] == now + 10000 - 100
+    # Nothing is due any more.
+    assert list(scheduler.run(once=True)) == []
@@ -0,0 +1,127 @@
+"""
+Response cache for api_client's read-only calls.
+
+Entries are keyed by (target, host, machine_id), expire after a per
+target TTL and the least recently used entry is evicted once there are
+max_entries. With a path, the cache is also kept in a JSON file so it
+survives between CLI invocations.
+"""
+
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from time import time
+
+# Seconds each target's responses stay fresh.
+DEFAULT_TTLS = {'exists': 30,
+                'status': 10,
+                'info': 30,
+                'sshhostname': 300,
+                'host_info': 60}
+
+MAX_ENTRIES = 1024
+
+
+class ResponseCache:
+    def __init__(self, ttls=None, max_entries=MAX_ENTRIES, path=None):
+        """
+        ttls: dict of target -> seconds. Targets not in it are not cached.
+        path: Optional JSON file to load from and save to.
+        """
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1.')
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        # (target, host, machine_id) -> (expires, value)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None:
+            self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, target, host, machine_id):
+        """
+        Returns (True, value) on a fresh hit, (False, None) otherwise.
+        """
+        key = (target, host, machine_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time():
+                self._entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses = self.misses + 1
+            return False, None
+
+    def set(self, target, host, machine_id, value):
+        if target not in self.ttls:
+            return
+        # Only JSON responses, raw bytes are left alone.
+        if not isinstance(value, (dict, list, bool, int, str)):
+            return
+        key = (target, host, machine_id)
+        with self._lock:
+            self._entries[key] = (time() + self.ttls[target], value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def invalidate(self, machine_id, host=None):
+        """
+        Drops everything cached about machine_id, and host's host_info.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if key[2] == machine_id:
+                    del self._entries[key]
+                elif host is not None and key == ('host_info', host, None):
+                    del self._entries[key]
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.path) as fp:
+                entries = json.load(fp)
+        except (OSError, ValueError):
+            return
+        now = time()
+        for key, expires, value in entries:
+            if expires > now:
+                self._entries[tuple(key)] = (expires, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _save(self):
+        """
+        Writes to a temporary file and renames it over path, so another
+        process never reads half a cache.
+        """
+        if self.path is None:
+            return
+        entries = [[list(key), expires, value]
+                   for key, (expires, value) in self._entries.items()]
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temporary_path = tempfile.mkstemp(dir=directory,
+                                              prefix='.cache-')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(entries, fp)
+            os.replace(temporary_path, self.path)
+        except Exception:
+            os.unlink(temporary_path)
+            raise
@@ -0,0 +1,61 @@
+import pytest
+
+from . import cache
+
+
+def test_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, 'time', lambda: now[0])
+    response_cache = cache.ResponseCache(ttls={'info': 10})
+    assert response_cache.get('info', 'host', 'id') == (False, None)
+    response_cache.set('info', 'host', 'id', {'a': 1})
+    assert response_cache.get('info', 'host', 'id') == (True, {'a': 1})
+    now[0] = 1011.0
+    assert response_cache.get('info', 'host', 'id') == (False, None)
+    # Not in ttls, not cached.
+    response_cache.set('status', 'host', 'id', 'started')
+    assert response_cache.get('status', 'host', 'id') == (False, None)
+    assert response_cache.hits == 1
+    assert response_cache.misses == 3
+
+
+def test_lru():
+    response_cache = cache.ResponseCache(max_entries=2)
+    response_cache.set('info', 'host', 'a', {})
+    response_cache.set('info', 'host', 'b', {})
+    response_cache.get('info', 'host', 'a')
+    response_cache.set('info', 'host', 'c', {})
+    assert len(response_cache) == 2
+    assert response_cache.get('info', 'host', 'b') == (False, None)
+    assert response_cache.get('info', 'host', 'a')[0] is True
+    with pytest.raises(ValueError):
+        cache.ResponseCache(max_entries=0)
+
+
+def test_invalidate():
+    response_cache = cache.ResponseCache()
+    response_cache.set('info', 'host', 'a', {})
+    response_cache.set('status', 'host', 'a', 'started')
+    response_cache.set('info', 'host', 'b', {})
+    response_cache.set('host_info', 'host', None, {})
+    response_cache.set('host_info', 'other', None, {})
+    response_cache.invalidate('a', host='host')
+    assert response_cache.get('info', 'host', 'a')[0] is False
+    assert response_cache.get('status', 'host', 'a')[0] is False
+    assert response_cache.get('host_info', 'host', None)[0] is False
+    assert response_cache.get('info', 'host', 'b')[0] is True
+    assert response_cache.get('host_info', 'other', None)[0] is True
+
+
+def test_disk(tmp_path):
+    path = str(tmp_path / 'cache.json')
+    response_cache = cache.ResponseCache(path=path)
+    response_cache.set('info', 'host', 'a', {'a': 1})
+    response_cache.set('sshhostname', 'host', 'a', b'not json')
+    reloaded = cache.ResponseCache(path=path)
+    assert reloaded.get('info', 'host', 'a') == (True, {'a': 1})
+    assert len(reloaded) == 1
+    reloaded.invalidate('a')
+    assert len(cache.ResponseCache(path=path)) == 0
+    (tmp_path / 'broken.json').write_text('{')
+    assert len(cache.ResponseCache(path=str(tmp_path / 'broken.json'))) == 0
@@ -0,0 +1,121 @@
+"""
+Per endpoint circuit breaker for api_client.
+
+After failure_threshold failures in a row to one endpoint (scheme://host
+from api_client.session_key), its circuit opens and calls to it fail
+straight away with CircuitOpenError. Once reset_timeout seconds have
+passed the circuit is half-open: a few trial calls are let through, and
+the first result decides whether it closes again or stays open.
+
+api_client waits for an open circuit to be half-open, like a Retry-After,
+when its retry policy allows another attempt.
+"""
+
+import threading
+from time import monotonic
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an endpoint whose circuit is open.
+
+    retry_in is how many seconds until it's half-open, or None if it's
+    half-open already and waiting on a trial call.
+    """
+
+    def __init__(self, message, retry_in=None):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    def __init__(self,
+                 failure_threshold=5,
+                 reset_timeout=30,
+                 half_open_max_calls=1):
+        if failure_threshold < 1:
+            raise ValueError('failure_threshold must be at least 1.')
+        if half_open_max_calls < 1:
+            raise ValueError('half_open_max_calls must be at least 1.')
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        # key -> [state, failures in a row, opened_at, trial calls]
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def _circuit(self, key):
+        if key not in self._circuits:
+            self._circuits[key] = [CLOSED, 0, None, 0]
+        return self._circuits[key]
+
+    def state(self, key):
+        with self._lock:
+            circuit = self._circuit(key)
+            if circuit[0] == OPEN:
+                if monotonic() - circuit[2] >= self.reset_timeout:
+                    return HALF_OPEN
+            return circuit[0]
+
+    def before_call(self, key):
+        """
+        Raises CircuitOpenError if key should not be called right now.
+        """
+        with self._lock:
+            circuit = self._circuit(key)
+            if circuit[0] == CLOSED:
+                return
+            if circuit[0] == OPEN:
+                waited = monotonic() - circuit[2]
+                if waited < self.reset_timeout:
+                    message = 'Circuit for {} is open, retry in {:.0f}s.'
+                    remaining = self.reset_timeout - waited
+                    raise CircuitOpenError(message.format(key, remaining),
+                                           retry_in=remaining)
+                circuit[0] = HALF_OPEN
+                circuit[3] = 0
+            if circuit[3] >= self.half_open_max_calls:
+                message = 'Circuit for {} is half-open, trial in progress.'
+                raise CircuitOpenError(message.format(key))
+            circuit[3] = circuit[3] + 1
+
+    def release(self, key):
+        """
+        Gives back the trial call before_call() let through, for a call
+        that ended without a result either way.
+        """
+        with self._lock:
+            circuit = self._circuit(key)
+            if circuit[0] == HALF_OPEN and circuit[3] > 0:
+                circuit[3] = circuit[3] - 1
+
+    def success(self, key):
+        with self._lock:
+            circuit = self._circuit(key)
+            circuit[0] = CLOSED
+            circuit[1] = 0
+            circuit[3] = 0
+
+    def failure(self, key):
+        with self._lock:
+            circuit = self._circuit(key)
+            circuit[1] = circuit[1] + 1
+            if circuit[0] == HALF_OPEN or \
+                    circuit[1] >= self.failure_threshold:
+                circuit[0] = OPEN
+                circuit[2] = monotonic()
+                circuit[3] = 0
+
+    def reset(self, key=None):
+        """
+        Closes key's circuit, or every circuit if key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._circuits.clear()
+            else:
+                self._circuits.pop(key, None)
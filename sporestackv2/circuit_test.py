@@ -0,0 +1,46 @@
+import pytest
+
+from . import circuit
+
+
+def test_circuit_breaker(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit, 'monotonic', lambda: now[0])
+    breaker = circuit.CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    assert breaker.state('a') == circuit.CLOSED
+    breaker.before_call('a')
+    breaker.failure('a')
+    breaker.success('a')
+    breaker.failure('a')
+    assert breaker.state('a') == circuit.CLOSED
+    breaker.failure('a')
+    assert breaker.state('a') == circuit.OPEN
+    with pytest.raises(circuit.CircuitOpenError) as error:
+        breaker.before_call('a')
+    assert error.value.retry_in == 10
+    # Other endpoints are unaffected.
+    breaker.before_call('b')
+
+    now[0] = 1010.0
+    assert breaker.state('a') == circuit.HALF_OPEN
+    breaker.before_call('a')
+    # Only one trial call at a time.
+    with pytest.raises(circuit.CircuitOpenError) as error:
+        breaker.before_call('a')
+    assert error.value.retry_in is None
+    # Unless it's given back.
+    breaker.release('a')
+    breaker.before_call('a')
+    breaker.failure('a')
+    assert breaker.state('a') == circuit.OPEN
+
+    now[0] = 1020.0
+    breaker.before_call('a')
+    breaker.success('a')
+    assert breaker.state('a') == circuit.CLOSED
+    breaker.before_call('a')
+
+    breaker.failure('a')
+    breaker.failure('a')
+    breaker.reset('a')
+    assert breaker.state('a') == circuit.CLOSED
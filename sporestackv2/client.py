@@ -4,26 +4,87 @@
 Cleaner interface into api_client, for the most part.
 """
 
-import json
+import hmac
+import inspect
+import queue
 import sys
+import tempfile
 # FUTURE PYTHON 3.6: import secrets
 import os
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from hashlib import sha256
-from time import sleep
-
-import aaargh
-import pyqrcode
-from walkingliberty import WalkingLiberty
+from time import monotonic, sleep
 
 from . import api_client
+from . import cache
+from . import codec
+from . import commands
+from . import payments
+from . import store
+from . import validate
+from .manifest import load as load_manifest
 
-cli = aaargh.App()
-
-logging.basicConfig(level=logging.INFO)
+cli = commands.App()
 
 API_ENDPOINT = 'https://api.sporestack.com'
 
+# Payments and builds usually finish within seconds, so poll quickly at
+# first and back off towards POLL_CEILING.
+POLL_INITIAL = 1
+POLL_FACTOR = 1.5
+POLL_CEILING = 15
+# Seconds to wait for a payment to go through and for a server to build.
+PAYMENT_WAIT = 3600
+BUILD_WAIT = 120
+
+# what -> {'waits', 'confirmed', 'polls', 'total_seconds', 'max_seconds'}
+_wait_stats = {}
+_wait_stats_lock = threading.Lock()
+
+# Secret for derive_machine_id(), kept in machine_info_directory().
+MACHINE_ID_SEED_FILE = 'machine_id_seed'
+
+# Launch job states, saved as 'state' in the machine info. Machines saved
+# before there were jobs have no state and count as created.
+PENDING_PAYMENT = 'pending-payment'
+PAID = 'paid'
+BUILDING = 'building'
+CREATED = 'created'
+# payment_sent while a launch job is paying, before we know it went out.
+PAYMENT_SENDING = 'sending'
+
+STORE_BACKENDS = ('json', 'sqlite')
+# Output formats for list and query.
+INVENTORY_FORMATS = ('table', 'json', 'ndjson')
+# (backend, directory) -> store, see machine_store().
+_stores = {}
+_stores_lock = threading.Lock()
+
+# Default number of requests in flight for the *_all sweeps.
+SWEEP_WORKERS = 32
+# Default number of launches in flight for launch-batch.
+BATCH_WORKERS = 10
+
+# client functions the batch command can run.
+BATCH_COMMANDS = ('exists',
+                  'info',
+                  'status',
+                  'start',
+                  'stop',
+                  'topup',
+                  'bootorder',
+                  'ipxescript',
+                  'get_attribute')
+
+# Defaults for launch-batch, matching the launch command line.
+LAUNCH_SPEC_DEFAULTS = {'disk': 5,
+                        'memory': 1,
+                        'bandwidth': 1,
+                        'ipv4': '/32',
+                        'ipv6': '/128'}
+
 
 def i_am_root():
     if os.getuid() == 0:
@@ -35,8 +96,7 @@ def i_am_root():
 def random_machine_id():
     """
     For now, make a random machine_id.
-    This can be completely deterministic
-    if we please. But, this is easier for now.
+    See derive_machine_id() for a deterministic one.
     """
     # We could also use secrets.token_hex(32),
     # this may be more secure.
@@ -46,6 +106,152 @@ def random_machine_id():
     return machine_id
 
 
+def sleep_until(seconds, deadline=None):
+    """
+    Sleeps for seconds, unless that would take us past deadline.
+
+    Raises api_client.DeadlineExceeded instead of sleeping past deadline.
+    """
+    remaining = api_client.remaining(deadline)
+    if remaining is not None and remaining < seconds:
+        # No time left to ask again afterwards.
+        raise api_client.DeadlineExceeded('Deadline exceeded.')
+    sleep(seconds)
+
+
+def poll_intervals(initial=POLL_INITIAL,
+                   factor=POLL_FACTOR,
+                   ceiling=POLL_CEILING):
+    """
+    Yields how long to sleep before each poll, forever.
+    """
+    interval = initial
+    while True:
+        yield interval
+        interval = min(ceiling, interval * factor)
+
+
+def _record_wait(what, seconds, polls, confirmed):
+    with _wait_stats_lock:
+        stats = _wait_stats.setdefault(what, {'waits': 0,
+                                              'confirmed': 0,
+                                              'polls': 0,
+                                              'total_seconds': 0.0,
+                                              'max_seconds': 0.0})
+        stats['waits'] = stats['waits'] + 1
+        if confirmed is True:
+            stats['confirmed'] = stats['confirmed'] + 1
+        stats['polls'] = stats['polls'] + polls
+        stats['total_seconds'] = stats['total_seconds'] + seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+
+def wait_stats():
+    """
+    Returns stats on every wait_for() so far, by what was waited for.
+    """
+    with _wait_stats_lock:
+        return {what: dict(stats) for what, stats in _wait_stats.items()}
+
+
+def wait_for(probe, done, what, timeout, deadline=None, intervals=None):
+    """
+    Calls probe() until done(result) is true, sleeping per intervals
+    (poll_intervals() by default) in between.
+
+    Returns the last result, even if we gave up after timeout seconds.
+    Raises api_client.DeadlineExceeded if deadline comes first.
+    """
+    if timeout <= 0:
+        raise ValueError('timeout must be positive.')
+    if intervals is None:
+        intervals = poll_intervals()
+    started = monotonic()
+    polls = 0
+    result = None
+    confirmed = False
+    for interval in intervals:
+        waited = monotonic() - started
+        if waited >= timeout:
+            break
+        logging.info('Waiting for {}...'.format(what))
+        sleep_until(min(interval, timeout - waited), deadline)
+        result = probe()
+        polls = polls + 1
+        if done(result):
+            confirmed = True
+            break
+    seconds = monotonic() - started
+    _record_wait(what, seconds, polls, confirmed)
+    if confirmed is True:
+        message = 'Done waiting for {} after {:.1f}s and {} polls.'
+    else:
+        message = 'Gave up waiting for {} after {:.1f}s and {} polls.'
+    logging.info(message.format(what, seconds, polls))
+    return result
+
+
+def machine_id_seed():
+    """
+    Returns the secret seed for derive_machine_id(), making one the first
+    time. Copy it (machine_id_seed in machine_info_directory()) to every
+    worker that should derive the same machine_ids.
+    """
+    directory = machine_info_directory()
+    path = os.path.join(directory, MACHINE_ID_SEED_FILE)
+    try:
+        return _read_machine_id_seed(path)
+    except FileNotFoundError:
+        pass
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    seed = os.urandom(32).hex()
+    # Written in full before it appears, so nobody reads half a seed.
+    fd, temporary_path = tempfile.mkstemp(dir=directory,
+                                          prefix='.' + MACHINE_ID_SEED_FILE,
+                                          suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(seed)
+            fp.flush()
+            os.fsync(fp.fileno())
+        try:
+            os.link(temporary_path, path)
+        except FileExistsError:
+            # Someone else just made it, use theirs.
+            return _read_machine_id_seed(path)
+    finally:
+        os.unlink(temporary_path)
+    return seed
+
+
+def _read_machine_id_seed(path):
+    with open(path) as fp:
+        seed = fp.read().strip()
+    if seed == '':
+        raise ValueError('{} is empty.'.format(path))
+    return seed
+
+
+def derive_machine_id(vm_hostname, nonce=None, seed=None):
+    """
+    Makes the same machine_id every time for the same vm_hostname, nonce
+    and seed (machine_id_seed() by default), so retried launches land on
+    the same machine instead of making a new one.
+
+    Use a new nonce to launch a new machine under an old vm_hostname.
+    """
+    if seed is None:
+        seed = machine_id_seed()
+    if seed == '':
+        raise ValueError('seed must not be empty.')
+    message = vm_hostname
+    if nonce is not None:
+        message = '{}\0{}'.format(vm_hostname, nonce)
+    return hmac.new(seed.encode('utf-8'),
+                    message.encode('utf-8'),
+                    sha256).hexdigest()
+
+
 def payment_uri(currency, address, satoshis):
     """
     Returns a payment URI from the currency, address, and satoshis.
@@ -65,13 +271,42 @@ def payment_uri(currency, address, satoshis):
     return uri
 
 
-def make_payment(currency, address, satoshis, walkingliberty_wallet=None):
+def make_payment(currency,
+                 address,
+                 satoshis,
+                 walkingliberty_wallet=None,
+                 payment_batch=None,
+                 headless=False,
+                 vm_hostname=None):
+    """
+    Pays with walkingliberty_wallet if set, or asks the user to.
+
+    payment_batch (a payments.PaymentBatch) pays wallet payments together
+    with any others made through it around the same time.
+
+    headless prints the invoice as a line of JSON for something else to
+    pay instead of asking, and returns straight away.
+    """
     if walkingliberty_wallet is not None:
-        walkingliberty = WalkingLiberty(currency)
-        txid = walkingliberty.send(private_key=walkingliberty_wallet,
-                                   address=address,
-                                   satoshis=satoshis)
-        logging.debug('WalkingLiberty txid: {}'.format(txid))
+        if payment_batch is not None:
+            payment_batch.pay(currency=currency,
+                              address=address,
+                              satoshis=satoshis,
+                              walkingliberty_wallet=walkingliberty_wallet)
+        else:
+            result, = payments.send_payments(currency,
+                                             [(address, satoshis)],
+                                             walkingliberty_wallet)
+            if isinstance(result, Exception):
+                raise result
+    elif headless is True:
+        invoice = {'uri': payment_uri(currency, address, satoshis),
+                   'address': address,
+                   'satoshis': satoshis,
+                   'currency': currency}
+        if vm_hostname is not None:
+            invoice['vm_hostname'] = vm_hostname
+        print(codec.dumps({'payment': invoice}), flush=True)
     else:
         uri = payment_uri(currency, address, satoshis)
         premessage = '''Payment URI: {}
@@ -80,6 +315,9 @@ one hour at the very most.
 Resize your terminal and try again if QR code above is not readable.
 Press ctrl+c to abort.'''
         message = premessage.format(uri)
+        # Slow to import and only needed when paying by hand.
+        import pyqrcode
+
         qr = pyqrcode.create(uri)
         print(qr.terminal(module_color='black',
                           background='white',
@@ -118,6 +356,11 @@ Press ctrl+c to abort.'''
 @cli.cmd_arg('--operating_system', type=str, default=None)
 @cli.cmd_arg('--ssh_key', type=str, default=None)
 @cli.cmd_arg('--ssh_key_file', type=str, default=None)
+@cli.cmd_arg('--deadline', type=float, default=None)
+@cli.cmd_arg('--payment_wait', type=int, default=PAYMENT_WAIT)
+@cli.cmd_arg('--deterministic', type=bool, default=False)
+@cli.cmd_arg('--nonce', type=str, default=None)
+@cli.cmd_arg('--headless', type=bool, default=False)
 def launch(vm_hostname,
            days,
            disk,
@@ -145,15 +388,30 @@ def launch(vm_hostname,
            ssh_key_file=None,
            walkingliberty_wallet=None,
            want_topup=False,
-           save=True):
+           save=True,
+           deadline=None,
+           payment_wait=PAYMENT_WAIT,
+           deterministic=False,
+           nonce=None,
+           payment_batch=None,
+           headless=False):
     """
     Attempts to launch a server.
+
+    deadline is a Unix timestamp to give up by, see api_client.deadline_in().
+    payment_wait is how many seconds to wait for payment to go through.
+    deterministic derives the machine_id from vm_hostname and nonce, see
+    derive_machine_id(), so launching again is safe from anywhere with the
+    same seed.
+    payment_batch and headless are passed on to make_payment().
     """
     ipv4 = api_client.normalize_argument(ipv4)
     ipv6 = api_client.normalize_argument(ipv6)
     bandwidth = api_client.normalize_argument(bandwidth)
     want_topup = api_client.normalize_argument(want_topup)
     ipxescript_stdin = api_client.normalize_argument(ipxescript_stdin)
+    deterministic = api_client.normalize_argument(deterministic)
+    headless = api_client.normalize_argument(headless)
 
     if machine_exists(vm_hostname):
         message = '{} already created.'.format(vm_hostname)
@@ -187,70 +445,183 @@ def launch(vm_hostname,
             if override_code is None:
                 override_code = get_override_code()
 
-    machine_id = random_machine_id()
+    if deterministic is True:
+        machine_id = derive_machine_id(vm_hostname, nonce=nonce)
+    else:
+        if nonce is not None:
+            raise ValueError('nonce only makes sense with deterministic.')
+        machine_id = random_machine_id()
+
+    job = {'vm_hostname': vm_hostname,
+           'machine_id': machine_id,
+           'api_endpoint': api_endpoint,
+           'host': host,
+           'state': PENDING_PAYMENT,
+           'payment_sent': False,
+           'launch_arguments': {'days': days,
+                                'disk': disk,
+                                'memory': memory,
+                                'ipxescript': ipxescript,
+                                'operating_system': operating_system,
+                                'ssh_key': ssh_key,
+                                'refund_address': refund_address,
+                                'cores': cores,
+                                'ipv4': ipv4,
+                                'ipv6': ipv6,
+                                'bandwidth': bandwidth,
+                                'currency': currency,
+                                'region': region,
+                                'organization': organization,
+                                'managed': managed,
+                                'override_code': override_code,
+                                'settlement_token': settlement_token,
+                                'qemuopts': qemuopts,
+                                'hostaccess': hostaccess,
+                                'want_topup': want_topup}}
+    # Held until we're done, so resume() elsewhere leaves it to us.
+    with machine_store().lock(vm_hostname, blocking=False):
+        # Saved before anything is paid for, so resume() can pick it up if
+        # we die while waiting.
+        save_machine_info(job)
+        try:
+            return run_launch_job(job,
+                                  walkingliberty_wallet=walkingliberty_wallet,
+                                  deadline=deadline,
+                                  payment_wait=payment_wait,
+                                  payment_batch=payment_batch,
+                                  headless=headless)
+        except Exception:
+            # Only here, never when resuming: a job that failed before any
+            # payment was started has nothing to resume.
+            if job['state'] == PENDING_PAYMENT and \
+                    job['payment_sent'] is False:
+                delete_machine_info(vm_hostname)
+            raise
+
+
+def _set_state(job, state):
+    logging.debug('{}: {} -> {}'.format(job['vm_hostname'],
+                                        job['state'],
+                                        state))
+    job['state'] = state
+    save_machine_info(job, overwrite=True)
+
+
+def run_launch_job(job,
+                   walkingliberty_wallet=None,
+                   deadline=None,
+                   payment_wait=PAYMENT_WAIT,
+                   payment_batch=None,
+                   headless=False,
+                   resend_payment=False):
+    """
+    Takes a launch job from whatever state it is in to created, saving
+    it at each step. Returns the machine info, as launch() does.
+
+    Payment is only ever sent once per job. If we died while sending it
+    (payment_sent is PAYMENT_SENDING), it is only sent again if
+    resend_payment.
+    """
+    machine_id = job['machine_id']
+    api_endpoint = job['api_endpoint']
+    arguments = job['launch_arguments']
+    currency = arguments['currency']
+
+    # Validated and encoded once per host, then sent as often as needed.
+    prepared = {}
 
     def create_vm(host):
-        create = api_client.launch
-        return create(host=host,
-                      machine_id=machine_id,
-                      days=days,
-                      disk=disk,
-                      memory=memory,
-                      ipxescript=ipxescript,
-                      operating_system=operating_system,
-                      ssh_key=ssh_key,
-                      refund_address=refund_address,
-                      cores=cores,
-                      ipv4=ipv4,
-                      ipv6=ipv6,
-                      bandwidth=bandwidth,
-                      currency=currency,
-                      region=region,
-                      organization=organization,
-                      managed=managed,
-                      override_code=override_code,
-                      settlement_token=settlement_token,
-                      qemuopts=qemuopts,
-                      hostaccess=hostaccess,
-                      api_endpoint=api_endpoint,
-                      want_topup=want_topup,
-                      retry=True)
-
-    created_dict = create_vm(host)
+        if host not in prepared:
+            prepared[host] = api_client.prepare_launch(
+                host=host,
+                machine_id=machine_id,
+                api_endpoint=api_endpoint,
+                **arguments)
+        return api_client.send_launch(prepared[host],
+                                      retry=True,
+                                      deadline=deadline)
+
+    created_dict = create_vm(job['host'])
     if api_endpoint is not None:
         # Adjust host to whatever it gives us.
-        host = created_dict['host']
-    # This will be false at least the first time if paying with BTC or BCH.
-    if created_dict['paid'] is False:
-        address = created_dict['payment']['address']
-        satoshis = created_dict['payment']['amount']
-
-        make_payment(currency=currency,
-                     address=address,
-                     satoshis=satoshis,
-                     walkingliberty_wallet=walkingliberty_wallet)
-
-        tries = 360
-        while tries > 0:
-            tries = tries - 1
-            logging.info('Waiting for payment to process...')
-            # FIXME: Wait one hour in a smarter way.
-            # Waiting for payment to set in.
-            sleep(10)
-            created_dict = create_vm(host)
-            if created_dict['paid'] is True:
-                break
+        job['host'] = created_dict['host']
+    host = job['host']
+
+    if job['state'] == PENDING_PAYMENT:
+        # This will be false at least the first time if paying with BTC or
+        # BCH.
+        if created_dict['paid'] is False:
+            if job['payment_sent'] == PAYMENT_SENDING and \
+                    resend_payment is True:
+                job['payment_sent'] = False
+            if job['payment_sent'] is False:
+                address = created_dict['payment']['address']
+                satoshis = created_dict['payment']['amount']
+
+                # Saved first, so if we die while paying, resume() knows a
+                # payment may already be on its way.
+                job['payment_sent'] = PAYMENT_SENDING
+                job['payment'] = {'address': address,
+                                  'satoshis': satoshis,
+                                  'currency': currency}
+                save_machine_info(job, overwrite=True)
+                make_payment(currency=currency,
+                             address=address,
+                             satoshis=satoshis,
+                             walkingliberty_wallet=walkingliberty_wallet,
+                             payment_batch=payment_batch,
+                             headless=headless,
+                             vm_hostname=job['vm_hostname'])
+                job['payment_sent'] = True
+                save_machine_info(job, overwrite=True)
+
+            created_dict = wait_for(lambda: create_vm(host),
+                                    lambda created: created['paid'] is True,
+                                    'payment',
+                                    timeout=payment_wait,
+                                    deadline=deadline)
+            if created_dict['paid'] is False:
+                if job['payment_sent'] == PAYMENT_SENDING:
+                    message = ('{}: we stopped while paying {} satoshis to '
+                               '{} and that payment has not been seen. '
+                               'Check whether it was sent, then resume with '
+                               '--resend_payment True to pay again.')
+                    raise ValueError(message.format(
+                        job['vm_hostname'],
+                        job['payment']['satoshis'],
+                        job['payment']['address']))
+                message = '{}: payment not seen yet, resume to keep waiting.'
+                raise ValueError(message.format(job['vm_hostname']))
+        _set_state(job, PAID)
+
+    if job['state'] == PAID:
+        _set_state(job, BUILDING)
 
     if created_dict['created'] is False:
-        tries = 0
-        while tries != 10:
-            logging.info('Waiting for server to build...')
-            tries = tries + 1
-            # Waiting for server to spin up.
-            sleep(10)
-            created_dict = create_vm(host)
-            if created_dict['created'] is True:
-                break
+        def vm_exists():
+            # Much lighter than sending the whole launch again, and not
+            # cached so we see the change as soon as it happens.
+            url, get_params = api_client._machine_request(
+                'exists', host, machine_id, api_endpoint=api_endpoint)
+            output = api_client.api_request(url,
+                                            get_params=get_params,
+                                            retry=True,
+                                            deadline=deadline)
+            return output['result']
+
+        wait_for(vm_exists,
+                 lambda exists: exists is True,
+                 'server to build',
+                 timeout=BUILD_WAIT,
+                 deadline=deadline)
+        created_dict = create_vm(host)
+        if created_dict['created'] is False:
+            created_dict = wait_for(
+                lambda: create_vm(host),
+                lambda created: created['created'] is True,
+                'server to build',
+                timeout=BUILD_WAIT,
+                deadline=deadline)
 
     if created_dict['created'] is False:
         # FIXME: Bad exception type.
@@ -258,13 +629,86 @@ def launch(vm_hostname,
 
     if 'host' not in created_dict:
         created_dict['host'] = host
-    created_dict['vm_hostname'] = vm_hostname
+    created_dict['vm_hostname'] = job['vm_hostname']
     created_dict['machine_id'] = machine_id
     created_dict['api_endpoint'] = api_endpoint
-    save_machine_info(created_dict)
+    created_dict['state'] = CREATED
+    # launch_arguments are dropped now, but query --region needs it.
+    region = job['launch_arguments'].get('region')
+    if region is not None and 'region' not in created_dict:
+        created_dict['region'] = region
+    save_machine_info(created_dict, overwrite=True)
     return created_dict
 
 
+def pending_jobs():
+    """
+    Yields the vm_hostname of every launch that hasn't finished.
+    """
+    for vm_hostname in machine_hostnames():
+        machine_info = get_machine_info(vm_hostname)
+        if machine_info.get('state', CREATED) != CREATED:
+            yield vm_hostname
+
+
+@cli.cmd
+@cli.cmd_arg('--vm_hostname', type=str, default=None)
+@cli.cmd_arg('--walkingliberty_wallet', type=str, default=None)
+@cli.cmd_arg('--workers', type=int, default=BATCH_WORKERS)
+@cli.cmd_arg('--deadline', type=float, default=None)
+@cli.cmd_arg('--payment_wait', type=int, default=PAYMENT_WAIT)
+@cli.cmd_arg('--batch_payments', type=bool, default=True)
+@cli.cmd_arg('--headless', type=bool, default=False)
+@cli.cmd_arg('--resend_payment', type=bool, default=False)
+def resume(vm_hostname=None,
+           walkingliberty_wallet=None,
+           workers=BATCH_WORKERS,
+           deadline=None,
+           payment_wait=PAYMENT_WAIT,
+           batch_payments=True,
+           headless=False,
+           resend_payment=False):
+    """
+    Picks up launches that were interrupted, or just vm_hostname.
+    Prints NDJSON as each one finishes.
+
+    batch_payments pays for them together, see payments.PaymentBatch.
+    headless prints invoices as JSON instead of asking, see make_payment().
+    resend_payment pays again for jobs that stopped while paying, once
+    you've checked the first payment never went out.
+    """
+    batch_payments = api_client.normalize_argument(batch_payments)
+    headless = api_client.normalize_argument(headless)
+    resend_payment = api_client.normalize_argument(resend_payment)
+    payment_batch = None
+    if batch_payments is True and vm_hostname is None:
+        payment_batch = payments.PaymentBatch()
+
+    def resume_one(vm_hostname):
+        # Fails straight away if another process is already on it, so
+        # nothing is paid for twice.
+        with machine_store().lock(vm_hostname, blocking=False):
+            job = get_machine_info(vm_hostname)
+            if job.get('state', CREATED) == CREATED:
+                message = '{} is already created.'
+                raise ValueError(message.format(vm_hostname))
+            return run_launch_job(job,
+                                  walkingliberty_wallet=walkingliberty_wallet,
+                                  deadline=deadline,
+                                  payment_wait=payment_wait,
+                                  payment_batch=payment_batch,
+                                  headless=headless,
+                                  resend_payment=resend_payment)
+
+    if vm_hostname is None:
+        vm_hostnames = list(pending_jobs())
+    else:
+        vm_hostnames = [vm_hostname]
+    return print_ndjson(sweep(resume_one,
+                              vm_hostnames=vm_hostnames,
+                              workers=workers))
+
+
 @cli.cmd
 @cli.cmd_arg('vm_hostname')
 @cli.cmd_arg('--override_code', type=str, default=None)
@@ -274,6 +718,9 @@ def launch(vm_hostname,
 @cli.cmd_arg('--refund_address', type=str, default=None)
 @cli.cmd_arg('--walkingliberty_wallet', type=str, default=None)
 @cli.cmd_arg('--api_endpoint', type=str, default=None)
+@cli.cmd_arg('--deadline', type=float, default=None)
+@cli.cmd_arg('--payment_wait', type=int, default=PAYMENT_WAIT)
+@cli.cmd_arg('--headless', type=bool, default=False)
 def topup(vm_hostname,
           days,
           currency,
@@ -281,10 +728,19 @@ def topup(vm_hostname,
           override_code=None,
           settlement_token=None,
           walkingliberty_wallet=None,
-          api_endpoint=None):
+          api_endpoint=None,
+          deadline=None,
+          payment_wait=PAYMENT_WAIT,
+          payment_batch=None,
+          headless=False):
     """
     tops up an existing vm.
+
+    deadline is a Unix timestamp to give up by, see api_client.deadline_in().
+    payment_wait is how many seconds to wait for payment to go through.
+    payment_batch and headless are passed on to make_payment().
     """
+    headless = api_client.normalize_argument(headless)
 
     if not machine_exists(vm_hostname):
         message = '{} does not exist.'.format(vm_hostname)
@@ -312,7 +768,8 @@ def topup(vm_hostname,
                                 override_code=override_code,
                                 api_endpoint=api_endpoint,
                                 settlement_token=settlement_token,
-                                retry=True)
+                                retry=True,
+                                deadline=deadline)
 
     topped_dict = topup_vm()
     # This will be false at least the first time if paying with BTC or BCH.
@@ -323,24 +780,87 @@ def topup(vm_hostname,
         make_payment(currency=currency,
                      address=address,
                      satoshis=satoshis,
-                     walkingliberty_wallet=walkingliberty_wallet)
-
-        tries = 360
-        while tries > 0:
-            logging.info('Waiting for payment to process...')
-            tries = tries - 1
-            # FIXME: Wait one hour in a smarter way.
-            # Waiting for payment to set in.
-            sleep(10)
-            topped_dict = topup_vm()
-            if topped_dict['paid'] is True:
-                break
-
-    machine_info['expiration'] = topped_dict['expiration']
-    save_machine_info(machine_info, overwrite=True)
+                     walkingliberty_wallet=walkingliberty_wallet,
+                     payment_batch=payment_batch,
+                     headless=headless,
+                     vm_hostname=vm_hostname)
+
+        topped_dict = wait_for(topup_vm,
+                               lambda topped: topped['paid'] is True,
+                               'payment',
+                               timeout=payment_wait,
+                               deadline=deadline)
+
+    def set_expiration(machine_info):
+        # Another topup may have finished first with a later expiration.
+        expiration = machine_info.get('expiration')
+        if expiration is None or topped_dict['expiration'] > expiration:
+            machine_info['expiration'] = topped_dict['expiration']
+
+    machine_info = update_machine_info(vm_hostname, set_expiration)
     return machine_info['expiration']
 
 
+@cli.cmd
+@cli.cmd_arg('--days', type=int, required=True)
+@cli.cmd_arg('--currency', type=str, default=None, required=True)
+@cli.cmd_arg('--lead_time', type=int, default=None)
+@cli.cmd_arg('--workers', type=int, default=None)
+@cli.cmd_arg('--once', type=bool, default=False)
+@cli.cmd_arg('--override_code', type=str, default=None)
+@cli.cmd_arg('--settlement_token', type=str, default=None)
+@cli.cmd_arg('--walkingliberty_wallet', type=str, default=None)
+@cli.cmd_arg('--payment_wait', type=int, default=PAYMENT_WAIT)
+@cli.cmd_arg('--batch_payments', type=bool, default=True)
+@cli.cmd_arg('--headless', type=bool, default=False)
+def autotopup(days,
+              currency,
+              lead_time=None,
+              workers=None,
+              once=False,
+              override_code=None,
+              settlement_token=None,
+              walkingliberty_wallet=None,
+              payment_wait=PAYMENT_WAIT,
+              batch_payments=True,
+              headless=False):
+    """
+    Tops up every local VM by days when it gets within lead_time seconds
+    of expiring. Runs until killed, or once. Prints NDJSON per topup.
+
+    batch_payments pays for topups due together in one go, see
+    payments.PaymentBatch. headless prints invoices as JSON instead of
+    asking, see make_payment().
+    """
+    from . import autotopup as scheduler
+
+    once = api_client.normalize_argument(once)
+    batch_payments = api_client.normalize_argument(batch_payments)
+    payment_batch = None
+    if batch_payments is True:
+        payment_batch = payments.PaymentBatch()
+    if lead_time is None:
+        lead_time = scheduler.LEAD_TIME
+    if workers is None:
+        workers = scheduler.WORKERS
+
+    def topup_one(vm_hostname):
+        return topup(vm_hostname,
+                     days=days,
+                     currency=currency,
+                     override_code=override_code,
+                     settlement_token=settlement_token,
+                     walkingliberty_wallet=walkingliberty_wallet,
+                     payment_wait=payment_wait,
+                     payment_batch=payment_batch,
+                     headless=headless)
+
+    topups = scheduler.Scheduler(topup_one,
+                                 lead_time=lead_time,
+                                 workers=workers)
+    return print_ndjson(topups.run(once=once))
+
+
 def machine_info_directory():
     if i_am_root():
         directory = '/etc/sporestackv2'
@@ -349,22 +869,58 @@ def machine_info_directory():
     return directory
 
 
+def machine_store(backend=None):
+    """
+    Returns where machines are saved, a store.JSONStore or
+    store.SQLiteStore in machine_info_directory().
+
+    backend is 'json' or 'sqlite'. By default it's $SPORESTACKV2_STORE,
+    or else sqlite if there is a database (see migrate-store), or json.
+    """
+    directory = machine_info_directory()
+    if backend is None:
+        backend = os.getenv('SPORESTACKV2_STORE')
+    if not backend:
+        if os.path.exists(os.path.join(directory, store.SQLITE_NAME)):
+            backend = 'sqlite'
+        else:
+            backend = 'json'
+    if backend not in STORE_BACKENDS:
+        message = 'Store must be one of: {}'
+        raise ValueError(message.format(', '.join(STORE_BACKENDS)))
+    key = (backend, directory)
+    with _stores_lock:
+        if key not in _stores:
+            if backend == 'sqlite':
+                path = os.path.join(directory, store.SQLITE_NAME)
+                _stores[key] = store.SQLiteStore(path)
+            else:
+                _stores[key] = store.JSONStore(directory)
+        return _stores[key]
+
+
 def save_machine_info(machine_info, overwrite=False):
     """
     Save info to disk.
     """
-    if overwrite is True:
-        mode = 'w'
-    else:
-        mode = 'x'
-    os.umask(0o0077)
-    directory = machine_info_directory()
-    if not os.path.exists(directory):
-        os.mkdir(directory)
-    vm_hostname = machine_info['vm_hostname']
-    json_path = os.path.join(directory, '{}.json'.format(vm_hostname))
-    with open(json_path, mode) as json_file:
-        json.dump(machine_info, json_file)
+    machine_store().save(machine_info, overwrite=overwrite)
+    return True
+
+
+def update_machine_info(vm_hostname, function):
+    """
+    Saves function(machine_info) (or machine_info, changed in place)
+    without losing changes saved by others at the same time. Returns what
+    was saved. See the store's update().
+    """
+    return machine_store().update(vm_hostname, function)
+
+
+def delete_machine_info(vm_hostname):
+    """
+    Forgets a machine.
+    """
+    machine_store().delete(vm_hostname)
     return True
 
 
@@ -372,28 +928,233 @@ def get_machine_info(vm_hostname):
     """
     Get info from disk.
     """
-    directory = machine_info_directory()
-    if not machine_exists(vm_hostname):
-        msg = '{} does not exist in {}'.format(vm_hostname, directory)
-        raise ValueError(msg)
-    json_path = os.path.join(directory, '{}.json'.format(vm_hostname))
-    with open(json_path) as json_file:
-        machine_info = json.load(json_file)
-    if machine_info['vm_hostname'] != vm_hostname:
-        raise ValueError('vm_hostname does not match filename.')
-    return machine_info
+    return machine_store().get(vm_hostname)
 
 
 def machine_exists(vm_hostname):
     """
     Check if the VM exists locally in /etc/sporestackv2 or ~/.sporestackv2
     """
+    return machine_store().exists(vm_hostname)
+
+
+@cli.cmd(name='migrate-store')
+@cli.cmd_arg('--to', type=str, required=True)
+@cli.cmd_arg('--overwrite', type=bool, default=False)
+def migrate_store(to, overwrite=False):
+    """
+    Copies every saved machine into the json or sqlite store. Moving to
+    sqlite leaves the JSON files behind as a backup. Moving to json
+    replaces them with what's in the database, then renames the database
+    aside, so the JSON files are used again.
+
+    overwrite only matters when moving to sqlite with a database that
+    already has some of the machines.
+    """
+    overwrite = api_client.normalize_argument(overwrite)
+    backends = [backend for backend in STORE_BACKENDS if backend != to]
+    if len(backends) != 1:
+        message = 'Store must be one of: {}'
+        raise ValueError(message.format(', '.join(STORE_BACKENDS)))
     directory = machine_info_directory()
-    file_path = os.path.join(directory, '{}.json'.format(vm_hostname))
-    if os.path.exists(file_path):
-        return True
+    database = os.path.join(directory, store.SQLITE_NAME)
+    if to == 'json':
+        if not os.path.exists(database):
+            message = 'There is no {} to migrate from.'
+            raise ValueError(message.format(database))
+        source = machine_store('sqlite')
+        destination = machine_store('json')
+        # The database is what's been used, so the JSON files left from
+        # moving to it are out of date.
+        count = store.migrate(source, destination, overwrite=True)
+        kept = set(source.hostnames())
+        for vm_hostname in list(destination.hostnames()):
+            if vm_hostname not in kept:
+                destination.delete(vm_hostname)
+        with _stores_lock:
+            _stores.pop(('sqlite', directory), None)
+        source.close()
+        os.replace(database, database + '.migrated')
+    elif os.path.exists(database):
+        count = store.migrate(machine_store('json'), machine_store('sqlite'),
+                              overwrite=overwrite)
     else:
-        return False
+        count = _migrate_to_new_database(database)
+    logging.info('Copied {} machines to {}.'.format(count, to))
+    return True
+
+
+def _migrate_to_new_database(database):
+    """
+    Copies every JSON machine into a new database, made under another
+    name and only put in place once it's complete, as machine_store()
+    uses the database as soon as it exists. Returns how many.
+    """
+    os.makedirs(os.path.dirname(database), mode=0o700, exist_ok=True)
+    descriptor, path = tempfile.mkstemp(dir=os.path.dirname(database),
+                                        prefix='.' + store.SQLITE_NAME,
+                                        suffix='.tmp')
+    os.close(descriptor)
+    destination = store.SQLiteStore(path)
+    try:
+        count = store.migrate(machine_store('json'), destination)
+        destination.close()
+        try:
+            # Not os.replace(), in case someone else made one meanwhile.
+            os.link(path, database)
+        except FileExistsError:
+            message = '{} was made while migrating, try again.'
+            raise ValueError(message.format(database))
+    finally:
+        destination.close()
+        for leftover in [path, path + '-wal', path + '-shm']:
+            try:
+                os.remove(leftover)
+            except FileNotFoundError:
+                pass
+    return count
+
+
+@cli.cmd(name='migrate-layout')
+@cli.cmd_arg('--to', type=str, required=True)
+def migrate_layout(to):
+    """
+    Moves JSON machine files into the sharded or flat layout. Safe to run
+    while other sporestackv2 commands are using them.
+    """
+    machines = machine_store()
+    if machines.name != 'json':
+        raise ValueError('Only the json store has layouts.')
+    moved = machines.migrate_layout(to)
+    logging.info('Moved {} machines to the {} layout.'.format(moved, to))
+    return True
+
+
+def _sort_rows(rows, sort):
+    """
+    Sorts rows by the comma separated fields in sort, - first for
+    descending. Rows missing a field go last.
+    """
+    for name in reversed(sort.split(',')):
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        present = [row for row in rows if row.get(name) is not None]
+        missing = [row for row in rows if row.get(name) is None]
+        present.sort(key=lambda row: row[name], reverse=descending)
+        rows = present + missing
+    return rows
+
+
+def inventory(sort='vm_hostname', fields=None, **filters):
+    """
+    Returns saved machines matching filters (see store.matches()), from
+    the store's index.
+
+    Each is a dict of fields, a list or comma separated string, which is
+    store.INDEX_FIELDS by default. Records are only read for fields that
+    aren't in the index. sort is as for _sort_rows().
+    """
+    if fields is None:
+        fields = store.INDEX_FIELDS
+    elif isinstance(fields, str):
+        fields = fields.split(',')
+    wanted = set(fields)
+    if sort:
+        wanted.update(name.lstrip('-') for name in sort.split(','))
+    machines = machine_store()
+    rows = list(machines.query(**filters))
+    if not wanted.issubset(store.INDEX_FIELDS):
+        rows = [dict(machines.get(row['vm_hostname']), **row)
+                for row in rows]
+    if sort:
+        rows = _sort_rows(rows, sort)
+    return [{field: row.get(field) for field in fields} for row in rows]
+
+
+def format_inventory(rows, fields, format='table'):
+    """
+    Returns rows from inventory() as a table, a JSON list or NDJSON.
+    """
+    if format == 'json':
+        return codec.dumps(rows)
+    elif format == 'ndjson':
+        return '\n'.join(codec.dumps(row) for row in rows)
+    elif format != 'table':
+        message = 'format must be one of: {}'
+        raise ValueError(message.format(', '.join(INVENTORY_FORMATS)))
+    cells = [list(fields)]
+    for row in rows:
+        cells.append(['' if row[field] is None else str(row[field])
+                      for field in fields])
+    widths = [max(len(line[column]) for line in cells)
+              for column in range(len(fields))]
+    return '\n'.join('  '.join(cell.ljust(width)
+                               for cell, width in zip(line, widths)).rstrip()
+                     for line in cells)
+
+
+@cli.cmd
+@cli.cmd_arg('--host', type=str, default=None)
+@cli.cmd_arg('--region', type=str, default=None)
+@cli.cmd_arg('--api_endpoint', type=str, default=None)
+@cli.cmd_arg('--state', type=str, default=None)
+@cli.cmd_arg('--expires_before', type=int, default=None)
+@cli.cmd_arg('--expires_after', type=int, default=None)
+@cli.cmd_arg('--sort', type=str, default='vm_hostname')
+@cli.cmd_arg('--fields', type=str, default=None)
+@cli.cmd_arg('--format', type=str, default='table')
+def query(host=None,
+          region=None,
+          api_endpoint=None,
+          state=None,
+          expires_before=None,
+          expires_after=None,
+          sort='vm_hostname',
+          fields=None,
+          format='table'):
+    """
+    Lists saved VMs matching every filter given. expires_before and
+    expires_after are Unix timestamps. fields is comma separated, sort
+    too (-field for descending). format is table, json or ndjson.
+    """
+    if fields is None:
+        fields = store.INDEX_FIELDS
+    else:
+        fields = fields.split(',')
+    rows = inventory(sort=sort,
+                     fields=fields,
+                     host=host,
+                     region=region,
+                     api_endpoint=api_endpoint,
+                     state=state,
+                     expires_before=expires_before,
+                     expires_after=expires_after)
+    output = format_inventory(rows, fields, format=format)
+    if output != '':
+        print(output)
+    return True
+
+
+@cli.cmd(name='list')
+@cli.cmd_arg('--sort', type=str, default='vm_hostname')
+@cli.cmd_arg('--fields', type=str, default=None)
+@cli.cmd_arg('--format', type=str, default='table')
+def list_command(sort='vm_hostname', fields=None, format='table'):
+    """
+    Lists every saved VM. See query.
+    """
+    return query(sort=sort, fields=fields, format=format)
+
+
+@cli.cmd
+def reindex():
+    """
+    Rebuilds the index list and query use, for if records were changed
+    by hand.
+    """
+    count = machine_store().reindex()
+    logging.info('Indexed {} machines.'.format(count))
+    return True
 
 
 @cli.cmd
@@ -545,6 +1306,314 @@ def bootorder(vm_hostname, bootorder, api_endpoint=None):
                                 api_endpoint=api_endpoint)
 
 
+def machine_hostnames():
+    """
+    Yields the vm_hostname of every machine saved locally.
+    """
+    return machine_store().hostnames()
+
+
+def sweep(function, vm_hostnames=None, workers=SWEEP_WORKERS):
+    """
+    Runs function(vm_hostname) for every local machine, workers at a time.
+
+    Yields {'vm_hostname': ..., 'result': ...} or
+    {'vm_hostname': ..., 'error': ...} as each call completes.
+    """
+    if vm_hostnames is None:
+        vm_hostnames = machine_hostnames()
+    if workers < 1:
+        raise ValueError('workers must be at least 1.')
+    # Make sure every worker can keep its own connection alive.
+    if workers > api_client.SESSION_POOL_SIZE:
+        api_client.configure_sessions(pool_size=workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(function, vm_hostname): vm_hostname
+                   for vm_hostname in vm_hostnames}
+        for future in as_completed(futures):
+            output = {'vm_hostname': futures[future]}
+            try:
+                output['result'] = future.result()
+            except Exception as e:
+                output['error'] = str(e)
+            yield output
+
+
+def status_all(workers=SWEEP_WORKERS):
+    """
+    status for every local machine. See sweep().
+    """
+    return sweep(status, workers=workers)
+
+
+def info_all(workers=SWEEP_WORKERS):
+    """
+    info for every local machine. See sweep().
+    """
+    return sweep(info, workers=workers)
+
+
+def exists_all(workers=SWEEP_WORKERS):
+    """
+    exists for every local machine. See sweep().
+    """
+    return sweep(exists, workers=workers)
+
+
+def print_ndjson(outputs):
+    """
+    Prints each output as a line of JSON as soon as we have it.
+
+    Returns False if any output has an error, True otherwise.
+    """
+    success = True
+    for output in outputs:
+        if 'error' in output:
+            success = False
+        print(codec.dumps(output), flush=True)
+    return success
+
+
+@cli.cmd(name='status-all')
+@cli.cmd_arg('--workers', type=int, default=SWEEP_WORKERS)
+def status_all_command(workers=SWEEP_WORKERS):
+    """
+    Checks if every local VM is started or stopped. Prints NDJSON.
+    """
+    return print_ndjson(status_all(workers=workers))
+
+
+@cli.cmd(name='info-all')
+@cli.cmd_arg('--workers', type=int, default=SWEEP_WORKERS)
+def info_all_command(workers=SWEEP_WORKERS):
+    """
+    Info on every local VM. Prints NDJSON.
+    """
+    return print_ndjson(info_all(workers=workers))
+
+
+@cli.cmd(name='exists-all')
+@cli.cmd_arg('--workers', type=int, default=SWEEP_WORKERS)
+def exists_all_command(workers=SWEEP_WORKERS):
+    """
+    Checks if every local VM still exists. Prints NDJSON.
+    """
+    return print_ndjson(exists_all(workers=workers))
+
+
+def validate_launch_spec(spec, walkingliberty_wallet=None, headless=False):
+    """
+    Checks launch() arguments as far as we can without launching.
+
+    Returns the full arguments, with defaults filled in and key and iPXE
+    files read in.
+    """
+    parameters = inspect.signature(launch).parameters
+    # launch_batch() passes its own payment_batch.
+    unknown = sorted(set(spec) - (set(parameters) - {'payment_batch'}))
+    if len(unknown) != 0:
+        raise ValueError('Unknown arguments: {}'.format(', '.join(unknown)))
+    arguments = dict(LAUNCH_SPEC_DEFAULTS)
+    if walkingliberty_wallet is not None:
+        arguments['walkingliberty_wallet'] = walkingliberty_wallet
+    if headless is True:
+        arguments['headless'] = True
+    arguments.update(spec)
+    for name, parameter in parameters.items():
+        if parameter.default is parameter.empty and name not in arguments:
+            raise ValueError('{} must be set.'.format(name))
+
+    vm_hostname = arguments['vm_hostname']
+    if not isinstance(vm_hostname, str) or vm_hostname == '':
+        raise ValueError('vm_hostname must be a non-empty string.')
+    if machine_exists(vm_hostname):
+        raise ValueError('{} already created.'.format(vm_hostname))
+    if arguments.get('host') is None and \
+            arguments.get('api_endpoint', API_ENDPOINT) is None:
+        raise ValueError('host and/or api_endpoint must be set.')
+    if arguments.get('ipxescript_stdin') not in [False, None]:
+        raise ValueError('ipxescript_stdin is not possible in a batch.')
+    if arguments.get('walkingliberty_wallet') is None and \
+            arguments.get('settlement_token') is None and \
+            arguments.get('override_code') is None and \
+            arguments.get('headless') is not True:
+        raise ValueError('Batch launches need walkingliberty_wallet, '
+                         'settlement_token, override_code or headless to '
+                         'pay.')
+
+    if arguments.get('ssh_key_file') is not None:
+        if arguments.get('ssh_key') is not None:
+            raise ValueError('Only ssh_key or ssh_key_file can be set.')
+        with open(arguments.pop('ssh_key_file')) as fp:
+            arguments['ssh_key'] = fp.read()
+    if arguments.get('ipxescript_file') is not None:
+        if arguments.get('ipxescript') is not None:
+            raise ValueError('Only set one of ipxescript, ipxescript_file')
+        with open(arguments.pop('ipxescript_file')) as fp:
+            arguments['ipxescript'] = fp.read()
+
+    validate.days(arguments['days'])
+    # Runs every check api_client.launch() will.
+    request_parameters = inspect.signature(api_client._launch_request)
+    request_arguments = {name: value for name, value in arguments.items()
+                         if name in request_parameters.parameters}
+    request_arguments.setdefault('currency', parameters['currency'].default)
+    # Stand-in, the real one is made at launch.
+    request_arguments['machine_id'] = '0' * 64
+    api_client._launch_request(**request_arguments)
+    return arguments
+
+
+def launch_batch(specs,
+                 workers=BATCH_WORKERS,
+                 walkingliberty_wallet=None,
+                 batch_payments=True,
+                 headless=False):
+    """
+    Launches every spec (launch() arguments) in parallel, workers at a
+    time.
+
+    Every spec is validated before anything is launched, and a ValueError
+    listing every problem is raised if any are invalid. Then yields an
+    output per VM as it is created, as sweep() does.
+
+    batch_payments pays for them together, see payments.PaymentBatch.
+    headless prints invoices as JSON instead of asking, see make_payment().
+    """
+    arguments = {}
+    problems = []
+    for number, spec in enumerate(specs, start=1):
+        vm_hostname = spec.get('vm_hostname')
+        try:
+            if vm_hostname in arguments:
+                raise ValueError('Duplicate vm_hostname.')
+            arguments[vm_hostname] = validate_launch_spec(
+                spec,
+                walkingliberty_wallet=walkingliberty_wallet,
+                headless=headless)
+        except Exception as e:
+            message = 'Entry {} ({}): {}'
+            problems.append(message.format(number, vm_hostname, e))
+    if len(problems) != 0:
+        raise ValueError('\n'.join(problems))
+
+    payment_batch = None
+    if batch_payments is True:
+        payment_batch = payments.PaymentBatch()
+
+    def launch_one(vm_hostname):
+        return launch(payment_batch=payment_batch, **arguments[vm_hostname])
+
+    return sweep(launch_one, vm_hostnames=list(arguments), workers=workers)
+
+
+@cli.cmd(name='launch-batch')
+@cli.cmd_arg('manifest')
+@cli.cmd_arg('--workers', type=int, default=BATCH_WORKERS)
+@cli.cmd_arg('--walkingliberty_wallet', type=str, default=None)
+@cli.cmd_arg('--batch_payments', type=bool, default=True)
+@cli.cmd_arg('--headless', type=bool, default=False)
+def launch_batch_command(manifest,
+                         workers=BATCH_WORKERS,
+                         walkingliberty_wallet=None,
+                         batch_payments=True,
+                         headless=False):
+    """
+    Launches every VM in a JSON, NDJSON or YAML manifest (- for stdin).
+    Prints NDJSON as each one finishes.
+    """
+    specs = load_manifest(manifest)
+    outputs = launch_batch(specs,
+                           workers=workers,
+                           walkingliberty_wallet=walkingliberty_wallet,
+                           batch_payments=api_client.normalize_argument(
+                               batch_payments),
+                           headless=api_client.normalize_argument(headless))
+    return print_ndjson(outputs)
+
+
+def _batch_call(entry):
+    """
+    Returns (function, arguments) for a batch entry, or raises ValueError.
+    """
+    arguments = dict(entry)
+    arguments.pop('id', None)
+    command = arguments.pop('command', None)
+    if command not in BATCH_COMMANDS:
+        message = 'command must be one of: {}'
+        raise ValueError(message.format(', '.join(BATCH_COMMANDS)))
+    function = globals()[command]
+    try:
+        inspect.signature(function).bind(**arguments)
+    except TypeError as e:
+        raise ValueError('{}: {}'.format(command, e))
+    return function, arguments
+
+
+def run_batch(entries, workers=BATCH_WORKERS, ordered=True):
+    """
+    Runs every entry, {"command": name, ...arguments}, workers at a time.
+    command is one of BATCH_COMMANDS. An "id" is passed through to the
+    output if set.
+
+    ordered runs the entries for each vm_hostname one at a time, in the
+    order given, while different machines still run in parallel.
+
+    Yields {"line": n, ..., "result": ...} or {"line": n, ..., "error": ...}
+    as each entry completes.
+    """
+    if workers < 1:
+        raise ValueError('workers must be at least 1.')
+    # Entries run one after another within a lane, lanes run in parallel.
+    lanes = {}
+    for number, entry in enumerate(entries, start=1):
+        if ordered is True and 'vm_hostname' in entry:
+            key = ('vm_hostname', entry['vm_hostname'])
+        else:
+            key = ('line', number)
+        lanes.setdefault(key, []).append((number, entry))
+
+    outputs = queue.Queue()
+
+    def run_lane(lane):
+        for number, entry in lane:
+            output = {'line': number}
+            for name in ['id', 'command', 'vm_hostname']:
+                if name in entry:
+                    output[name] = entry[name]
+            try:
+                function, arguments = _batch_call(entry)
+                output['result'] = function(**arguments)
+            except Exception as e:
+                output['error'] = str(e)
+            outputs.put(output)
+
+    total = sum(len(lane) for lane in lanes.values())
+    if workers > api_client.SESSION_POOL_SIZE:
+        api_client.configure_sessions(pool_size=workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for lane in lanes.values():
+            executor.submit(run_lane, lane)
+        for _ in range(total):
+            yield outputs.get()
+
+
+@cli.cmd
+@cli.cmd_arg('path', nargs='?', default='-')
+@cli.cmd_arg('--workers', type=int, default=BATCH_WORKERS)
+@cli.cmd_arg('--ordered', type=bool, default=True)
+def batch(path='-', workers=BATCH_WORKERS, ordered=True):
+    """
+    Runs NDJSON commands ({"command": "status", "vm_hostname": ...}) from
+    a file or stdin in one process. Prints NDJSON as each one finishes.
+    """
+    entries = load_manifest(path, format='ndjson')
+    return print_ndjson(run_batch(entries,
+                                  workers=workers,
+                                  ordered=api_client.normalize_argument(
+                                      ordered)))
+
+
 def api_endpoint_to_host(api_endpoint):
     """
     Returns a likely workable host from just the endpoint.
@@ -572,7 +1641,38 @@ def serialconsole(vm_hostname):
     return api_client.serialconsole(host, machine_id)
 
 
+@cli.cmd
+@cli.cmd_arg('--socket_path', type=str, default=None)
+@cli.cmd_arg('--cache', type=bool, default=False)
+def serve(socket_path=None, cache=False):
+    """
+    Runs commands for other sporestackv2 invocations over a Unix socket,
+    keeping connections warm. Ctrl + c to stop.
+
+    --cache True keeps read-only responses between commands for a few
+    seconds, as $SPORESTACKV2_CACHE does.
+    """
+    from . import daemon
+
+    cache = api_client.normalize_argument(cache)
+    return daemon.serve(socket_path, cache_responses=cache)
+
+
 def main():
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 1 and os.getenv('SPORESTACKV2_NO_DAEMON') is None:
+        from . import daemon
+
+        if sys.argv[1] in daemon.FORWARDED:
+            code = daemon.forward(sys.argv[1:])
+            if code is not None:
+                exit(code)
+    codec_name = os.getenv('SPORESTACKV2_CODEC')
+    if codec_name:
+        codec.set_codec(codec_name)
+    cache_path = os.getenv('SPORESTACKV2_CACHE')
+    if cache_path:
+        api_client.set_response_cache(cache.ResponseCache(path=cache_path))
     output = cli.run()
     if output is True:
         exit(0)
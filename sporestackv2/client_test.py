@@ -1,3 +1,10 @@
+import functools
+import os
+import subprocess
+import sys
+
+import pytest
+
 from . import client
 
 
@@ -16,3 +23,377 @@ def test_random_machine_id():
 def test_api_endpoint_to_host():
     assert client.api_endpoint_to_host('http://foo.bar') == 'foo.bar'
     assert client.api_endpoint_to_host('https://foo.bar') == 'foo.bar'
+
+
+def test_sweep(tmp_path, monkeypatch):
+    monkeypatch.setattr(client, 'machine_info_directory',
+                        lambda: str(tmp_path))
+    assert list(client.machine_hostnames()) == []
+    for vm_hostname in ['a', 'b', 'c']:
+        (tmp_path / '{}.json'.format(vm_hostname)).write_text('{}')
+    (tmp_path / 'not_a_machine').write_text('')
+    assert sorted(client.machine_hostnames()) == ['a', 'b', 'c']
+
+    def function(vm_hostname):
+        if vm_hostname == 'b':
+            raise ValueError('broken')
+        return vm_hostname.upper()
+
+    outputs = sorted(client.sweep(function, workers=2),
+                     key=lambda output: output['vm_hostname'])
+    assert outputs == [{'vm_hostname': 'a', 'result': 'A'},
+                       {'vm_hostname': 'b', 'error': 'broken'},
+                       {'vm_hostname': 'c', 'result': 'C'}]
+
+
+def test_sleep_until(monkeypatch):
+    slept = []
+    monkeypatch.setattr(client, 'sleep', slept.append)
+    client.sleep_until(10)
+    client.sleep_until(10, client.api_client.deadline_in(60))
+    assert slept == [10, 10]
+    with pytest.raises(client.api_client.DeadlineExceeded):
+        client.sleep_until(10, client.api_client.deadline_in(5))
+    assert slept == [10, 10]
+
+
+def test_lazy_imports():
+    code = ('import sys, sporestackv2.client; '
+            'print(sorted(sys.modules))')
+    output = subprocess.run([sys.executable, '-c', code],
+                            check=True,
+                            stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    for module in ['aaargh', 'paramiko', 'pyqrcode', 'sshpubkeys',
+                   'walkingliberty']:
+        assert "'{}'".format(module) not in output
+
+
+def test_cli_commands():
+    names = client.cli.commands()
+    assert names['launch'] is client.launch
+    assert names['status-all'] is client.status_all_command
+    app = client.cli.build()
+    with pytest.raises(SystemExit):
+        app.run(['--help'])
+
+
+def test_poll_intervals():
+    intervals = client.poll_intervals(initial=1, factor=2, ceiling=5)
+    assert [next(intervals) for _ in range(5)] == [1, 2, 4, 5, 5]
+
+
+def test_wait_for(monkeypatch):
+    now = [0.0]
+
+    def fake_sleep(seconds):
+        now[0] = now[0] + seconds
+
+    monkeypatch.setattr(client, 'sleep', fake_sleep)
+    monkeypatch.setattr(client, 'monotonic', lambda: now[0])
+    probes = iter([False, False, True])
+    result = client.wait_for(lambda: next(probes),
+                             lambda paid: paid is True,
+                             'test payment',
+                             timeout=100)
+    assert result is True
+    # 1 + 1.5 + 2.25 seconds of polling.
+    assert now[0] == 4.75
+    stats = client.wait_stats()['test payment']
+    assert stats['confirmed'] == 1
+    assert stats['polls'] == 3
+    assert stats['max_seconds'] == 4.75
+
+    now[0] = 0.0
+    result = client.wait_for(lambda: False,
+                             lambda paid: paid is True,
+                             'test payment',
+                             timeout=30)
+    assert result is False
+    assert now[0] == 30
+    stats = client.wait_stats()['test payment']
+    assert stats['waits'] == 2
+    assert stats['confirmed'] == 1
+    with pytest.raises(ValueError):
+        client.wait_for(lambda: True, bool, 'nothing', timeout=0)
+
+
+def test_launch_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(client, 'machine_info_directory',
+                        lambda: str(tmp_path))
+    (tmp_path / 'taken.json').write_text('{}')
+    launched = []
+
+    @functools.wraps(client.launch)
+    def fake_launch(**arguments):
+        launched.append(arguments['vm_hostname'])
+        return {'vm_hostname': arguments['vm_hostname']}
+
+    monkeypatch.setattr(client, 'launch', fake_launch)
+    good = {'vm_hostname': 'a', 'days': 1, 'settlement_token': 'x',
+            'operating_system': 'debian-9'}
+    specs = [good,
+             dict(good, vm_hostname='b', memory=0),
+             dict(good, vm_hostname='taken'),
+             dict(good, vm_hostname='c', color='blue'),
+             dict(good, vm_hostname='d', settlement_token=None),
+             dict(good)]
+    with pytest.raises(ValueError) as e:
+        list(client.launch_batch(specs))
+    problems = str(e.value).splitlines()
+    assert len(problems) == 5
+    assert problems[0].startswith('Entry 2 (b)')
+    assert 'already created' in problems[1]
+    assert 'color' in problems[2]
+    assert 'Duplicate' in problems[4]
+    assert launched == []
+
+    specs = [good,
+             dict(good, vm_hostname='b'),
+             {'vm_hostname': 'c', 'days': 2}]
+    outputs = list(client.launch_batch(specs, walkingliberty_wallet='w'))
+    assert sorted(launched) == ['a', 'b', 'c']
+    assert all('result' in output for output in outputs)
+
+
+def test_resumable_launch(tmp_path, monkeypatch):
+    monkeypatch.setattr(client, 'machine_info_directory',
+                        lambda: str(tmp_path))
+    now = [0.0]
+
+    def fake_sleep(seconds):
+        now[0] = now[0] + seconds
+
+    monkeypatch.setattr(client, 'sleep', fake_sleep)
+    monkeypatch.setattr(client, 'monotonic', lambda: now[0])
+    paid = [False]
+    payments = []
+    seen_ids = set()
+
+    def fake_send_launch(prepared, **kwargs):
+        seen_ids.add(prepared.machine_id)
+        return {'paid': paid[0],
+                'created': paid[0],
+                'host': 'host.example',
+                'payment': {'address': 'address', 'amount': 1000}}
+
+    def fake_make_payment(**kwargs):
+        payments.append(kwargs)
+
+    monkeypatch.setattr(client.api_client, 'send_launch', fake_send_launch)
+    monkeypatch.setattr(client, 'make_payment', fake_make_payment)
+    with pytest.raises(ValueError):
+        client.launch('vm', days=1, disk=5, memory=1, ipv4='/32',
+                      ipv6='/128', bandwidth=1, payment_wait=1,
+                      walkingliberty_wallet='wallet', region='eu')
+    job = client.get_machine_info('vm')
+    assert job['state'] == client.PENDING_PAYMENT
+    assert job['payment_sent'] is True
+    assert job['host'] == 'host.example'
+    assert list(client.pending_jobs()) == ['vm']
+    assert len(payments) == 1
+
+    paid[0] = True
+    assert client.resume(walkingliberty_wallet='wallet') is True
+    machine_info = client.get_machine_info('vm')
+    assert machine_info['state'] == client.CREATED
+    assert machine_info['machine_id'] == job['machine_id']
+    assert 'launch_arguments' not in machine_info
+    assert machine_info['region'] == 'eu'
+    assert [entry['vm_hostname']
+            for entry in client.machine_store().query(region='eu')] == ['vm']
+    assert list(client.pending_jobs()) == []
+    # Paid once, one machine_id.
+    assert len(payments) == 1
+    assert seen_ids == {job['machine_id']}
+
+
+def test_resume_after_dying_while_paying(tmp_path, monkeypatch):
+    monkeypatch.setattr(client, 'machine_info_directory',
+                        lambda: str(tmp_path))
+    now = [0.0]
+
+    def fake_sleep(seconds):
+        now[0] = now[0] + seconds
+
+    monkeypatch.setattr(client, 'sleep', fake_sleep)
+    monkeypatch.setattr(client, 'monotonic', lambda: now[0])
+    paid = [False]
+    payments = []
+
+    def fake_send_launch(prepared, **kwargs):
+        return {'paid': paid[0],
+                'created': paid[0],
+                'host': 'host.example',
+                'payment': {'address': 'address', 'amount': 1000}}
+
+    def dying_make_payment(**kwargs):
+        payments.append(kwargs)
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(client.api_client, 'send_launch', fake_send_launch)
+    monkeypatch.setattr(client, 'make_payment', dying_make_payment)
+    with pytest.raises(KeyboardInterrupt):
+        client.launch('vm', days=1, disk=5, memory=1, ipv4='/32',
+                      ipv6='/128', bandwidth=1, payment_wait=1,
+                      walkingliberty_wallet='wallet')
+    job = client.get_machine_info('vm')
+    assert job['payment_sent'] == client.PAYMENT_SENDING
+    assert job['payment'] == {'address': 'address', 'satoshis': 1000,
+                              'currency': 'bch'}
+
+    # Not paid again unless asked to.
+    monkeypatch.setattr(client, 'make_payment',
+                        lambda **kw: payments.append(kw))
+    assert client.resume(walkingliberty_wallet='wallet',
+                         payment_wait=1) is False
+    assert len(payments) == 1
+    assert client.resume(walkingliberty_wallet='wallet', payment_wait=1,
+                         resend_payment=True) is False
+    assert len(payments) == 2
+    assert client.get_machine_info('vm')['payment_sent'] is True
+    paid[0] = True
+    assert client.resume(walkingliberty_wallet='wallet') is True
+    assert len(payments) == 2
+
+
+def test_launch_forgets_unpaid_failures(tmp_path, monkeypatch):
+    monkeypatch.setattr(client, 'machine_info_directory',
+                        lambda: str(tmp_path))
+
+    def fake_send_launch(prepared, **kwargs):
+        raise ValueError('No such region.')
+
+    monkeypatch.setattr(client.api_client, 'send_launch', fake_send_launch)
+    with pytest.raises(ValueError):
+        client.launch('vm', days=1, disk=5, memory=1, ipv4='/32',
+                      ipv6='/128', bandwidth=1, settlement_token='token')
+    assert client.machine_exists('vm') is False
+
+    # Resuming never forgets the job, whatever goes wrong.
+    job = {'vm_hostname': 'vm', 'machine_id': '0' * 64, 'host': None,
+           'api_endpoint': client.API_ENDPOINT,
+           'state': client.PENDING_PAYMENT, 'payment_sent': False,
+           'launch_arguments': {'currency': 'bch', 'days': 1}}
+    client.save_machine_info(job)
+    assert client.resume(vm_hostname='vm') is False
+    assert client.get_machine_info('vm') == job
+
+
+def test_derive_machine_id(tmp_path, monkeypatch):
+    directory = tmp_path / 'sporestackv2'
+    monkeypatch.setattr(client, 'machine_info_directory',
+                        lambda: str(directory))
+    seed = client.machine_id_seed()
+    assert len(seed) == 64
+    assert client.machine_id_seed() == seed
+    assert list(client.machine_hostnames()) == []
+
+    machine_id = client.derive_machine_id('vm')
+    client.validate.machine_id(machine_id)
+    assert client.derive_machine_id('vm') == machine_id
+    assert client.derive_machine_id('vm', nonce='1') != machine_id
+    assert client.derive_machine_id('vm', nonce='1') == \
+        client.derive_machine_id('vm', nonce='1')
+    assert client.derive_machine_id('vm', seed='other') != machine_id
+    assert client.derive_machine_id('vm2') != machine_id
+
+    # Only the whole seed ever appears, and an empty one is refused.
+    assert os.listdir(str(directory)) == [client.MACHINE_ID_SEED_FILE]
+    (directory / client.MACHINE_ID_SEED_FILE).write_text('')
+    with pytest.raises(ValueError):
+        client.derive_machine_id('vm')
+    with pytest.raises(ValueError):
+        client.derive_machine_id('vm', seed='')
+
+
+def test_headless_payment(tmp_path, capsys, monkeypatch):
+    monkeypatch.setattr(client, 'machine_info_directory',
+                        lambda: str(tmp_path))
+    monkeypatch.setitem(sys.modules, 'pyqrcode', None)
+    monkeypatch.setattr('builtins.input', None)
+    client.make_payment('bch', 'aaaa', 1000, headless=True, vm_hostname='vm')
+    line = capsys.readouterr().out
+    assert line.count('\n') == 1
+    assert client.codec.loads(line) == {
+        'payment': {'uri': 'bitcoincash:aaaa?amount=0.00001000',
+                    'address': 'aaaa',
+                    'satoshis': 1000,
+                    'currency': 'bch',
+                    'vm_hostname': 'vm'}}
+
+    spec = {'vm_hostname': 'vm', 'days': 1, 'operating_system': 'debian-9'}
+    with pytest.raises(ValueError):
+        client.validate_launch_spec(spec)
+    arguments = client.validate_launch_spec(spec, headless=True)
+    assert arguments['headless'] is True
+
+
+def test_run_batch(monkeypatch):
+    calls = []
+
+    def fake_status(vm_hostname, api_endpoint=None):
+        calls.append(('status', vm_hostname))
+        if vm_hostname == 'b':
+            raise ValueError('b does not exist')
+        return 'started'
+
+    def fake_stop(vm_hostname, api_endpoint=None):
+        calls.append(('stop', vm_hostname))
+        return True
+
+    monkeypatch.setattr(client, 'status', fake_status)
+    monkeypatch.setattr(client, 'stop', fake_stop)
+    entries = [{'command': 'stop', 'vm_hostname': 'a', 'id': 1},
+               {'command': 'status', 'vm_hostname': 'a'},
+               {'command': 'status', 'vm_hostname': 'b'},
+               {'command': 'launch', 'vm_hostname': 'c'},
+               {'command': 'status', 'vm_hostname': 'c', 'color': 'blue'}]
+    outputs = sorted(client.run_batch(entries, workers=4),
+                     key=lambda output: output['line'])
+    assert outputs[0] == {'line': 1, 'id': 1, 'command': 'stop',
+                          'vm_hostname': 'a', 'result': True}
+    assert outputs[1]['result'] == 'started'
+    assert outputs[2]['error'] == 'b does not exist'
+    assert 'command must be one of' in outputs[3]['error']
+    assert 'color' in outputs[4]['error']
+    # a's commands ran in the order given.
+    assert [call for call in calls if call[1] == 'a'] == [('stop', 'a'),
+                                                          ('status', 'a')]
+    assert len(list(client.run_batch(entries, ordered=False))) == 5
+
+
+def test_query(tmp_path, capsys, monkeypatch):
+    monkeypatch.setattr(client, 'machine_info_directory',
+                        lambda: str(tmp_path))
+    monkeypatch.delenv('SPORESTACKV2_STORE', raising=False)
+    client.save_machine_info({'vm_hostname': 'a', 'host': 'h1',
+                              'expiration': 200, 'machine_id': 'x'})
+    client.save_machine_info({'vm_hostname': 'b', 'host': 'h2',
+                              'expiration': 100, 'machine_id': 'y'})
+    client.save_machine_info({'vm_hostname': 'c', 'host': 'h1',
+                              'machine_id': 'z'})
+    rows = client.inventory(sort='expiration', fields='vm_hostname,host')
+    assert rows == [{'vm_hostname': 'b', 'host': 'h2'},
+                    {'vm_hostname': 'a', 'host': 'h1'},
+                    {'vm_hostname': 'c', 'host': 'h1'}]
+    rows = client.inventory(sort='-expiration', fields=['machine_id'],
+                            host='h1')
+    assert rows == [{'machine_id': 'x'}, {'machine_id': 'z'}]
+
+    assert client.query(host='h1', fields='vm_hostname,expiration',
+                        format='ndjson') is True
+    lines = capsys.readouterr().out.splitlines()
+    assert [client.codec.loads(line) for line in lines] == [
+        {'vm_hostname': 'a', 'expiration': 200},
+        {'vm_hostname': 'c', 'expiration': None}]
+    client.list_command(fields='vm_hostname,expiration', sort='-vm_hostname')
+    assert capsys.readouterr().out.splitlines() == [
+        'vm_hostname  expiration',
+        'c',
+        'b            100',
+        'a            200']
+    client.query(expires_before=0, format='json')
+    assert capsys.readouterr().out == '[]\n'
+    with pytest.raises(ValueError):
+        client.query(format='yaml')
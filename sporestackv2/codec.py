@@ -0,0 +1,99 @@
+"""
+JSON encoding and decoding, with optional faster backends.
+
+The standard library json module is used unless set_codec() picks
+another. orjson and ujson are used if installed and asked for, 'auto'
+picks the fastest one available.
+"""
+
+import json
+
+# Fastest first.
+BACKENDS = ('orjson', 'ujson', 'json')
+
+_name = 'json'
+_loads = json.loads
+_dumps = json.dumps
+
+
+def _import(name):
+    if name == 'orjson':
+        import orjson
+
+        def dumps(obj):
+            return orjson.dumps(obj).decode('utf-8')
+
+        return orjson.loads, dumps
+    elif name == 'ujson':
+        import ujson
+        return ujson.loads, ujson.dumps
+    elif name == 'json':
+        return json.loads, json.dumps
+    else:
+        raise ValueError('codec must be one of: {}'.format(BACKENDS))
+
+
+def available_backends():
+    """
+    Returns the backends that can be imported, fastest first.
+    """
+    available = []
+    for name in BACKENDS:
+        try:
+            _import(name)
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+
+def set_codec(name):
+    """
+    Switches to backend name, or the fastest installed one for 'auto'.
+
+    Raises ImportError if name is not installed.
+    """
+    global _name
+    global _loads
+    global _dumps
+    if name == 'auto':
+        name = available_backends()[0]
+    _loads, _dumps = _import(name)
+    _name = name
+
+
+def get_codec():
+    return _name
+
+
+def loads(data):
+    """
+    Decodes JSON from str or bytes. Raises ValueError if it's not JSON.
+    """
+    return _loads(data)
+
+
+def dumps(obj):
+    """
+    Encodes obj as a JSON str.
+    """
+    return _dumps(obj)
+
+
+def load(fp):
+    return _loads(fp.read())
+
+
+def dump(obj, fp):
+    fp.write(_dumps(obj))
+
+
+def is_json(content_type):
+    """
+    Whether a Content-Type header says the body is JSON. None (no header)
+    counts, since we can't tell without trying.
+    """
+    if content_type is None:
+        return True
+    media_type = content_type.split(';', 1)[0].strip().lower()
+    return media_type == 'application/json' or media_type.endswith('+json')
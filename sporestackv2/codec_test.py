@@ -0,0 +1,36 @@
+import io
+
+import pytest
+
+from . import codec
+
+
+def test_codecs():
+    assert codec.available_backends()[-1] == 'json'
+    try:
+        for name in codec.available_backends() + ['auto']:
+            codec.set_codec(name)
+            assert codec.loads(b'{"a": [1, true, null]}') == \
+                {'a': [1, True, None]}
+            assert codec.loads(codec.dumps({'a': 'b'})) == {'a': 'b'}
+            assert isinstance(codec.dumps({}), str)
+            fp = io.StringIO()
+            codec.dump({'a': 1}, fp)
+            fp.seek(0)
+            assert codec.load(fp) == {'a': 1}
+            with pytest.raises(ValueError):
+                codec.loads(b'<html>')
+        with pytest.raises(ValueError):
+            codec.set_codec('pickle')
+    finally:
+        codec.set_codec('json')
+    assert codec.get_codec() == 'json'
+
+
+def test_is_json():
+    assert codec.is_json(None) is True
+    assert codec.is_json('application/json') is True
+    assert codec.is_json('Application/JSON; charset=utf-8') is True
+    assert codec.is_json('application/problem+json') is True
+    assert codec.is_json('text/html') is False
+    assert codec.is_json('text/plain; charset=utf-8') is False
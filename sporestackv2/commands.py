@@ -0,0 +1,63 @@
+"""
+Stand-in for aaargh.App that doesn't import aaargh (and argparse)
+until the command line is actually parsed.
+
+Use it exactly like aaargh.App: @cli.cmd, @cli.cmd_arg, cli.run().
+"""
+
+_NO_FUNC = object()
+
+
+class App:
+    def __init__(self, *args, **kwargs):
+        self._app_args = args
+        self._app_kwargs = kwargs
+        # (func, cmd args, cmd kwargs, [(cmd_arg args, cmd_arg kwargs)])
+        self._commands = []
+        self._pending_args = []
+
+    def cmd(self, _func=_NO_FUNC, *args, **kwargs):
+        if _func is not _NO_FUNC:
+            # Used as @cli.cmd without parentheses.
+            return self.cmd()(_func)
+
+        def wrapper(func):
+            self._commands.append((func, args, kwargs, self._pending_args))
+            self._pending_args = []
+            return func
+
+        return wrapper
+
+    def cmd_arg(self, *args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            raise TypeError('cmd_arg() decorator requires arguments, '
+                            'but none were supplied')
+        self._pending_args.append((args, kwargs))
+        return lambda func: func
+
+    def commands(self):
+        """
+        Returns {command name: function}.
+        """
+        names = {}
+        for func, args, kwargs, cmd_args in self._commands:
+            names[kwargs.get('name') or func.__name__] = func
+        return names
+
+    def build(self):
+        """
+        Returns a real aaargh.App with every command registered.
+        """
+        import aaargh
+
+        app = aaargh.App(*self._app_args, **self._app_kwargs)
+        for func, args, kwargs, cmd_args in self._commands:
+            for arg_args, arg_kwargs in cmd_args:
+                app.cmd_arg(*arg_args, **arg_kwargs)
+            app.cmd(*args, **kwargs)(func)
+        return app
+
+    def run(self, args=None, namespace=None):
+        if self._pending_args:
+            raise TypeError('cmd_arg() called without matching cmd()')
+        return self.build().run(args=args, namespace=namespace)
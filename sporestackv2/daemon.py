@@ -0,0 +1,235 @@
+"""
+Runs client commands in a long lived process, over a Unix socket.
+
+`sporestackv2 serve` keeps the api_client session pool warm between
+commands, and a response cache too if asked for one. While it's running,
+client.main() hands the commands in FORWARDED to it instead of running
+them itself.
+
+Each connection carries one command. The request is a line of JSON,
+{"argv": [...]}. The reply is lines of JSON: {"stdout": text} and
+{"stderr": text} as the command prints, then {"exit": code}.
+"""
+
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+from . import api_client
+from . import cache
+from . import client
+from . import codec
+
+# Only commands that never prompt or read stdin.
+FORWARDED = frozenset(['exists',
+                       'info',
+                       'status',
+                       'start',
+                       'stop',
+                       'bootorder',
+                       'get_attribute',
+                       'list',
+                       'query',
+                       'status-all',
+                       'info-all',
+                       'exists-all'])
+
+SOCKET_NAME = 'daemon.sock'
+
+_local = threading.local()
+
+
+def socket_path():
+    """
+    Where serve listens: $SPORESTACKV2_SOCKET, or daemon.sock in
+    client.machine_info_directory().
+    """
+    path = os.getenv('SPORESTACKV2_SOCKET')
+    if path:
+        return path
+    return os.path.join(client.machine_info_directory(), SOCKET_NAME)
+
+
+def _send(fp, message):
+    fp.write((codec.dumps(message) + '\n').encode('utf-8'))
+    fp.flush()
+
+
+class _ThreadOutput:
+    """
+    Stands in for sys.stdout or sys.stderr, sending what a request thread
+    prints back to its client instead.
+    """
+
+    def __init__(self, stream, name):
+        self._stream = stream
+        self._name = name
+
+    def write(self, text):
+        reply = getattr(_local, 'reply', None)
+        if reply is None:
+            return self._stream.write(text)
+        if text != '':
+            reply({self._name: text})
+        return len(text)
+
+    def flush(self):
+        if getattr(_local, 'reply', None) is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def run_command(app, argv):
+    """
+    Runs a command line with app as client.main() would. Returns the exit
+    code.
+    """
+    try:
+        output = app.run(argv)
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            return e.code
+        return 1
+    except Exception as e:
+        logging.exception('{} failed.'.format(argv))
+        print('{}: {}'.format(type(e).__name__, e), file=sys.stderr)
+        return 1
+    if output is True:
+        return 0
+    elif output is False:
+        return 1
+    print(output)
+    return 0
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if line == b'':
+            # Just checking if we're here, see _in_use().
+            return
+        try:
+            request = codec.loads(line)
+            argv = request['argv']
+        except (ValueError, KeyError, TypeError):
+            _send(self.wfile, {'stderr': 'Bad request.\n'})
+            _send(self.wfile, {'exit': 2})
+            return
+        lock = threading.Lock()
+
+        def reply(message):
+            with lock:
+                _send(self.wfile, message)
+
+        _local.reply = reply
+        try:
+            code = run_command(self.server.app, argv)
+        finally:
+            _local.reply = None
+        reply({'exit': code})
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, app):
+        self.app = app
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+
+
+def _in_use(path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        return False
+    finally:
+        probe.close()
+    return True
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def serve(path=None, app=None, cache_responses=False):
+    """
+    Serves commands on path (socket_path() by default) until interrupted
+    or killed.
+
+    cache_responses keeps read-only responses in memory between commands,
+    so forwarded status, exists and info can be a little stale. Off by
+    default, so they answer as they would without serve. A cache set by
+    $SPORESTACKV2_CACHE is used either way.
+    """
+    if path is None:
+        path = socket_path()
+    if app is None:
+        app = client.cli.build()
+    if os.path.exists(path):
+        if _in_use(path):
+            raise ValueError('Already serving on {}.'.format(path))
+        # Left behind by one that died.
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)),
+                mode=0o700,
+                exist_ok=True)
+
+    if cache_responses is True and api_client.get_response_cache() is None:
+        api_client.set_response_cache(cache.ResponseCache())
+
+    stdout = sys.stdout
+    stderr = sys.stderr
+    sys.stdout = _ThreadOutput(stdout, 'stdout')
+    sys.stderr = _ThreadOutput(stderr, 'stderr')
+    server = Server(path, app)
+    if threading.current_thread() is threading.main_thread():
+        # Stop cleanly when killed, as on ctrl + c.
+        signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        os.chmod(path, 0o600)
+        logging.info('Serving on {}'.format(path))
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        sys.stdout = stdout
+        sys.stderr = stderr
+        api_client.close_sessions()
+    return True
+
+
+def forward(argv, path=None):
+    """
+    Runs argv in the serve process if it is running.
+
+    Returns the exit code, or None if there is nothing serving on path.
+    """
+    if path is None:
+        path = socket_path()
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        connection.close()
+        return None
+    with connection, connection.makefile('rwb') as fp:
+        _send(fp, {'argv': list(argv)})
+        for line in fp:
+            message = codec.loads(line)
+            if 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'])
+            elif 'exit' in message:
+                sys.stdout.flush()
+                return message['exit']
+    raise ConnectionError('serve went away before finishing.')
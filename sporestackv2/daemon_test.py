@@ -0,0 +1,60 @@
+import sys
+import threading
+
+import pytest
+
+from . import commands
+from . import daemon
+
+
+def make_app():
+    app = commands.App()
+
+    @app.cmd
+    @app.cmd_arg('name')
+    def hello(name):
+        print('working...')
+        return 'hello {}'.format(name)
+
+    @app.cmd
+    def fine():
+        return True
+
+    @app.cmd
+    def broken():
+        raise ValueError('No such machine.')
+
+    return app.build()
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / 'test.sock')
+    # As serve() does, on top of capsys.
+    monkeypatch.setattr(sys, 'stdout',
+                        daemon._ThreadOutput(sys.stdout, 'stdout'))
+    monkeypatch.setattr(sys, 'stderr',
+                        daemon._ThreadOutput(sys.stderr, 'stderr'))
+    server = daemon.Server(path, make_app())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+
+
+def test_forward(server, capsys):
+    assert daemon.forward(['hello', 'world'], server) == 0
+    assert capsys.readouterr().out == 'working...\nhello world\n'
+    assert daemon.forward(['fine'], server) == 0
+    assert daemon.forward(['broken'], server) == 1
+    assert 'No such machine.' in capsys.readouterr().err
+    # Bad arguments exit as argparse would, with the usage on stderr.
+    assert daemon.forward(['hello'], server) == 2
+    assert 'usage' in capsys.readouterr().err
+    with pytest.raises(ValueError):
+        daemon.serve(server, make_app())
+
+
+def test_forward_nothing_serving(tmp_path):
+    assert daemon.forward(['fine'], str(tmp_path / 'nothing.sock')) is None
@@ -0,0 +1,91 @@
+"""
+Loads manifests: lists of dicts, each one the arguments for a call.
+
+JSON (a list, or {"machines": [...]}), NDJSON (one object per line) and
+YAML (if PyYAML is installed) are supported. The format is picked by
+file extension, or sniffed for anything else (like stdin).
+"""
+
+import sys
+
+from . import codec
+
+
+def _from_json(text):
+    data = codec.loads(text)
+    if isinstance(data, dict) and 'machines' in data:
+        data = data['machines']
+    return data
+
+
+def _from_ndjson(text):
+    entries = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        try:
+            entries.append(codec.loads(line))
+        except ValueError as e:
+            raise ValueError('Line {}: {}'.format(number, e))
+    return entries
+
+
+def _from_yaml(text):
+    try:
+        import yaml
+    except ImportError:
+        raise ImportError('YAML manifests need PyYAML: pip install pyyaml')
+    data = yaml.safe_load(text)
+    if isinstance(data, dict) and 'machines' in data:
+        data = data['machines']
+    return data
+
+
+def parse(text, format=None):
+    """
+    Parses a manifest. format is 'json', 'ndjson', 'yaml' or None to guess.
+    """
+    if format == 'json':
+        entries = _from_json(text)
+    elif format == 'ndjson':
+        entries = _from_ndjson(text)
+    elif format == 'yaml':
+        entries = _from_yaml(text)
+    elif format is None:
+        try:
+            entries = _from_json(text)
+        except ValueError:
+            entries = _from_ndjson(text)
+    else:
+        raise ValueError('format must be one of: json, ndjson, yaml')
+
+    if not isinstance(entries, list):
+        raise ValueError('Manifest must be a list of entries.')
+    for number, entry in enumerate(entries, start=1):
+        if not isinstance(entry, dict):
+            raise ValueError('Entry {} must be an object.'.format(number))
+    return entries
+
+
+def _format_of(path):
+    if path.endswith('.json'):
+        return 'json'
+    elif path.endswith('.ndjson') or path.endswith('.jsonl'):
+        return 'ndjson'
+    elif path.endswith('.yaml') or path.endswith('.yml'):
+        return 'yaml'
+    return None
+
+
+def load(path, format=None):
+    """
+    Loads the manifest at path, or stdin if path is '-'. format is as for
+    parse(), guessed from the extension if None.
+    """
+    if path == '-':
+        return parse(sys.stdin.read(), format=format)
+    if format is None:
+        format = _format_of(path)
+    with open(path) as fp:
+        return parse(fp.read(), format=format)
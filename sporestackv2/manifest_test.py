@@ -0,0 +1,38 @@
+import pytest
+
+from . import manifest
+
+
+def test_parse():
+    entries = [{'vm_hostname': 'a'}, {'vm_hostname': 'b'}]
+    assert manifest.parse('[{"vm_hostname": "a"}, {"vm_hostname": "b"}]') \
+        == entries
+    assert manifest.parse('{"machines": [{"vm_hostname": "a"}, '
+                          '{"vm_hostname": "b"}]}') == entries
+    ndjson = '{"vm_hostname": "a"}\n\n# comment\n{"vm_hostname": "b"}\n'
+    assert manifest.parse(ndjson) == entries
+    assert manifest.parse(ndjson, format='ndjson') == entries
+    with pytest.raises(ValueError):
+        manifest.parse('{"vm_hostname": "a"}\nnope\n')
+    with pytest.raises(ValueError):
+        manifest.parse('[1, 2]')
+    with pytest.raises(ValueError):
+        manifest.parse('{"vm_hostname": "a"}', format='json')
+    with pytest.raises(ValueError):
+        manifest.parse('[]', format='xml')
+
+
+def test_yaml():
+    pytest.importorskip('yaml')
+    text = 'machines:\n  - vm_hostname: a\n    days: 1\n'
+    assert manifest.parse(text, format='yaml') == [{'vm_hostname': 'a',
+                                                   'days': 1}]
+
+
+def test_load(tmp_path):
+    path = tmp_path / 'machines.jsonl'
+    path.write_text('{"vm_hostname": "a"}\n')
+    assert manifest.load(str(path)) == [{'vm_hostname': 'a'}]
+    path = tmp_path / 'machines.json'
+    path.write_text('[{"vm_hostname": "a"}]')
+    assert manifest.load(str(path)) == [{'vm_hostname': 'a'}]
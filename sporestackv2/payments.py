@@ -0,0 +1,118 @@
+"""
+Pays many invoices from a WalkingLiberty wallet at once.
+
+PaymentBatch collects the invoices that launch and topup workers want to
+pay within a short window and sends them together, as one multi-output
+transaction when the installed WalkingLiberty can (it has send_many()),
+or one send per invoice when it can't.
+"""
+
+import logging
+import threading
+
+# Seconds to wait for more invoices after the first one in a batch.
+BATCH_WINDOW = 5
+# Most invoices to pay in one transaction.
+BATCH_MAX_OUTPUTS = 50
+
+
+def send_payments(currency, invoices, walkingliberty_wallet):
+    """
+    Pays every (address, satoshis) in invoices from walkingliberty_wallet.
+
+    Returns, for each invoice in order, its txid or the exception paying it
+    raised. Sent one by one, a failed invoice doesn't stop the rest or
+    take back those already paid. Sent together, they all succeed or fail.
+    """
+    # Slow to import and only needed when paying.
+    from walkingliberty import WalkingLiberty
+
+    walkingliberty = WalkingLiberty(currency)
+    send_many = getattr(walkingliberty, 'send_many', None)
+    if send_many is not None and len(invoices) > 1:
+        try:
+            txid = send_many(private_key=walkingliberty_wallet,
+                             outputs=list(invoices))
+        except Exception as e:
+            return [e] * len(invoices)
+        logging.debug('WalkingLiberty txid: {} for {} invoices'.format(
+            txid, len(invoices)))
+        return [txid] * len(invoices)
+    results = []
+    for address, satoshis in invoices:
+        try:
+            txid = walkingliberty.send(private_key=walkingliberty_wallet,
+                                       address=address,
+                                       satoshis=satoshis)
+        except Exception as e:
+            logging.warning('Paying {} failed: {}'.format(address, e))
+            results.append(e)
+            continue
+        logging.debug('WalkingLiberty txid: {}'.format(txid))
+        results.append(txid)
+    return results
+
+
+class _Batch:
+    def __init__(self):
+        self.invoices = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        # A txid or exception per invoice.
+        self.results = None
+        # Set if the batch couldn't be sent at all.
+        self.error = None
+
+
+class PaymentBatch:
+    def __init__(self, window=BATCH_WINDOW, max_outputs=BATCH_MAX_OUTPUTS):
+        if max_outputs < 1:
+            raise ValueError('max_outputs must be at least 1.')
+        self.window = window
+        self.max_outputs = max_outputs
+        # (currency, walkingliberty_wallet) -> _Batch still taking invoices
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def pay(self, currency, address, satoshis, walkingliberty_wallet):
+        """
+        Pays an invoice along with any others that come in within window
+        seconds from the same wallet. Blocks until it's sent and returns
+        the txid, or raises ValueError if this invoice wasn't paid.
+        """
+        key = (currency, walkingliberty_wallet)
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader is True:
+                batch = _Batch()
+                self._open[key] = batch
+            index = len(batch.invoices)
+            batch.invoices.append((address, satoshis))
+            if len(batch.invoices) >= self.max_outputs:
+                del self._open[key]
+                batch.full.set()
+
+        if leader is True:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+            try:
+                batch.results = send_payments(currency,
+                                              batch.invoices,
+                                              walkingliberty_wallet)
+            except Exception as e:
+                batch.error = e
+            batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            message = 'Batched payment of {} invoices failed: {}'
+            raise ValueError(message.format(len(batch.invoices), batch.error))
+        result = batch.results[index]
+        if isinstance(result, Exception):
+            message = 'Payment of {} satoshis to {} failed: {}'
+            raise ValueError(message.format(satoshis, address, result))
+        return result
@@ -0,0 +1,145 @@
+import sys
+import threading
+import types
+
+import pytest
+
+from . import payments
+
+
+class FakeWalkingLiberty:
+    sent = []
+
+    def __init__(self, currency):
+        self.currency = currency
+
+    def send(self, private_key, address, satoshis):
+        self.sent.append((self.currency, private_key, [(address, satoshis)]))
+        return 'tx{}'.format(len(self.sent))
+
+
+class FakeWalkingLibertyMany(FakeWalkingLiberty):
+    def send_many(self, private_key, outputs):
+        self.sent.append((self.currency, private_key, outputs))
+        return 'tx{}'.format(len(self.sent))
+
+
+def fake_walkingliberty(monkeypatch, cls):
+    cls.sent = []
+    module = types.ModuleType('walkingliberty')
+    module.WalkingLiberty = cls
+    monkeypatch.setitem(sys.modules, 'walkingliberty', module)
+    return cls.sent
+
+
+def test_send_payments(monkeypatch):
+    invoices = [('a', 1), ('b', 2)]
+    sent = fake_walkingliberty(monkeypatch, FakeWalkingLiberty)
+    assert payments.send_payments('bch', invoices, 'w') == ['tx1', 'tx2']
+    assert sent == [('bch', 'w', [('a', 1)]), ('bch', 'w', [('b', 2)])]
+
+    sent = fake_walkingliberty(monkeypatch, FakeWalkingLibertyMany)
+    assert payments.send_payments('bch', invoices, 'w') == ['tx1', 'tx1']
+    assert sent == [('bch', 'w', invoices)]
+
+    class Broken(FakeWalkingLiberty):
+        def send(self, private_key, address, satoshis):
+            if address == 'a':
+                raise ValueError('Bad address.')
+            return super().send(private_key, address, satoshis)
+
+    sent = fake_walkingliberty(monkeypatch, Broken)
+    results = payments.send_payments('bch', invoices, 'w')
+    assert isinstance(results[0], ValueError)
+    assert results[1] == 'tx1'
+
+
+def pay_all(batch, invoices):
+    txids = {}
+    threads = []
+    for currency, address, wallet in invoices:
+        def pay(currency=currency, address=address, wallet=wallet):
+            txids[address] = batch.pay(currency, address, 1, wallet)
+        threads.append(threading.Thread(target=pay))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return txids
+
+
+def test_payment_batch(monkeypatch):
+    sent = fake_walkingliberty(monkeypatch, FakeWalkingLibertyMany)
+    batch = payments.PaymentBatch(window=1, max_outputs=3)
+    txids = pay_all(batch, [('bch', 'a', 'w'),
+                            ('bch', 'b', 'w'),
+                            ('bch', 'c', 'w'),
+                            ('bch', 'd', 'w'),
+                            ('btc', 'e', 'w'),
+                            ('bch', 'f', 'other')])
+    assert sorted(txids) == ['a', 'b', 'c', 'd', 'e', 'f']
+    # a-d split into a full batch of 3 and a batch of 1.
+    sizes = sorted(len(outputs) for currency, wallet, outputs in sent)
+    assert sizes == [1, 1, 1, 3]
+    assert len(set(txids.values())) == 4
+
+    with pytest.raises(ValueError):
+        payments.PaymentBatch(max_outputs=0)
+
+
+def test_payment_batch_failure(monkeypatch):
+    class Broken(FakeWalkingLibertyMany):
+        def send_many(self, private_key, outputs):
+            raise ValueError('Insufficient funds.')
+
+    fake_walkingliberty(monkeypatch, Broken)
+    batch = payments.PaymentBatch(window=0.5)
+    # A lone invoice is sent on its own.
+    assert batch.pay('bch', 'a', 1, 'w') == 'tx1'
+
+    errors = []
+
+    def pay(address):
+        try:
+            batch.pay('bch', address, 1, 'w')
+        except ValueError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=pay, args=(address,))
+               for address in ['a', 'b']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 2
+    assert all('Insufficient funds.' in error for error in errors)
+
+
+def test_payment_batch_partial_failure(monkeypatch):
+    class Broken(FakeWalkingLiberty):
+        def send(self, private_key, address, satoshis):
+            if address == 'b':
+                raise ValueError('Bad address.')
+            return super().send(private_key, address, satoshis)
+
+    fake_walkingliberty(monkeypatch, Broken)
+    batch = payments.PaymentBatch(window=0.5)
+    txids = {}
+    errors = {}
+
+    def pay(address):
+        try:
+            txids[address] = batch.pay('bch', address, 1, 'w')
+        except ValueError as e:
+            errors[address] = str(e)
+
+    threads = [threading.Thread(target=pay, args=(address,))
+               for address in ['a', 'b', 'c']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Only the invoice that failed says so.
+    assert sorted(txids) == ['a', 'c']
+    assert list(errors) == ['b']
+    assert 'Bad address.' in errors['b']
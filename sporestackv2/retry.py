@@ -0,0 +1,163 @@
+"""
+Retry policies for api_client.
+
+A RetryPolicy decides whether a failed request gets another attempt and
+how long to wait first: exponential backoff with full jitter, capped by
+max_attempts, an overall deadline, Retry-After and a per endpoint retry
+budget.
+"""
+
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from time import monotonic, time
+
+
+def retry_after_seconds(retry_after):
+    """
+    Returns the seconds asked for by a Retry-After header, or None.
+
+    Retry-After can be delay-seconds or an HTTP-date.
+    """
+    if retry_after is None:
+        return None
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return int(retry_after)
+    try:
+        when = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if when is None:
+        return None
+    return max(0, when.timestamp() - time())
+
+
+class RetryBudget:
+    """
+    Token bucket that stops retries to an endpoint that keeps failing.
+
+    Every failure takes a token and every success gives back token_ratio
+    tokens. Retries are only allowed while more than half the tokens are
+    left, so a struggling endpoint sees at most about token_ratio retries
+    per successful request instead of a retry storm.
+    """
+
+    def __init__(self, max_tokens=10, token_ratio=0.1):
+        if max_tokens <= 0:
+            raise ValueError('max_tokens must be positive.')
+        if token_ratio <= 0:
+            raise ValueError('token_ratio must be positive.')
+        self.max_tokens = max_tokens
+        self.token_ratio = token_ratio
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def tokens(self, key):
+        with self._lock:
+            return self._tokens.get(key, self.max_tokens)
+
+    def success(self, key):
+        with self._lock:
+            tokens = self._tokens.get(key, self.max_tokens)
+            tokens = min(self.max_tokens, tokens + self.token_ratio)
+            self._tokens[key] = tokens
+
+    def failure(self, key):
+        """
+        Records a failure. Returns True if a retry is still allowed.
+        """
+        with self._lock:
+            tokens = self._tokens.get(key, self.max_tokens)
+            tokens = max(0, tokens - 1)
+            self._tokens[key] = tokens
+            return tokens > self.max_tokens / 2
+
+
+class RetryPolicy:
+    """
+    max_attempts: Total tries, including the first. None for no limit.
+    base_delay: Backoff before the second attempt, in seconds.
+    max_delay: Ceiling for a single backoff, in seconds.
+    deadline: Give up once this many seconds have passed since the first
+              attempt. None for no limit.
+    budget: RetryBudget shared by every call using this policy, or None.
+    """
+
+    def __init__(self,
+                 max_attempts=10,
+                 base_delay=1,
+                 max_delay=30,
+                 deadline=600,
+                 budget=None):
+        if max_attempts is not None and max_attempts < 1:
+            raise ValueError('max_attempts must be at least 1.')
+        if base_delay < 0 or max_delay < 0:
+            raise ValueError('delays must not be negative.')
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.budget = budget
+
+    def backoff(self, attempt):
+        """
+        Full jitter: anywhere from 0 up to the exponential backoff.
+
+        attempt is the number of attempts made so far.
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def success(self, key):
+        if self.budget is not None:
+            self.budget.success(key)
+
+    def next_delay(self, key, attempt, started, retry_after=None):
+        """
+        Called after a failed attempt. Returns how long to sleep before
+        trying again, or None if we should give up.
+
+        key: Endpoint the retry budget is tracked by.
+        attempt: Number of attempts made so far.
+        started: monotonic() when the first attempt was made.
+        retry_after: Seconds the server asked us to wait, if any.
+        """
+        if self.budget is not None:
+            if not self.budget.failure(key):
+                return None
+        if self.max_attempts is not None and attempt >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if self.deadline is not None:
+            remaining = started + self.deadline - monotonic()
+            if delay >= remaining:
+                return None
+        return delay
+
+
+NO_RETRY = RetryPolicy(max_attempts=1)
+
+# What retry=True uses. launch and topup rely on it to ride out API
+# errors while waiting for a payment that has already been sent, so it has
+# no RetryBudget, which would give up after a few failures. Pass a
+# RetryPolicy with a budget to opt in to one.
+DEFAULT_RETRY_POLICY = RetryPolicy(max_attempts=20, deadline=600)
+
+
+def get_policy(retry):
+    """
+    Turns api_client's retry argument into a RetryPolicy.
+
+    retry can be False, True (DEFAULT_RETRY_POLICY) or a RetryPolicy.
+    """
+    if retry is False or retry is None:
+        return NO_RETRY
+    elif retry is True:
+        return DEFAULT_RETRY_POLICY
+    elif isinstance(retry, RetryPolicy):
+        return retry
+    else:
+        raise TypeError('retry must be a boolean or a RetryPolicy.')
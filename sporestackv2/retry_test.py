@@ -0,0 +1,69 @@
+from email.utils import formatdate
+from time import monotonic, time
+
+import pytest
+
+from . import retry
+
+
+def test_retry_after_seconds():
+    assert retry.retry_after_seconds(None) is None
+    assert retry.retry_after_seconds('120') == 120
+    assert retry.retry_after_seconds('garbage') is None
+    seconds = retry.retry_after_seconds(formatdate(time() + 60, usegmt=True))
+    assert 55 < seconds <= 60
+    assert retry.retry_after_seconds(formatdate(0, usegmt=True)) == 0
+
+
+def test_backoff():
+    policy = retry.RetryPolicy(base_delay=1, max_delay=8)
+    for attempt in range(1, 10):
+        ceiling = min(8, 2 ** (attempt - 1))
+        assert 0 <= policy.backoff(attempt) <= ceiling
+
+
+def test_next_delay():
+    policy = retry.RetryPolicy(max_attempts=3, deadline=None)
+    started = monotonic()
+    assert policy.next_delay('key', 1, started) is not None
+    assert policy.next_delay('key', 2, started) is not None
+    assert policy.next_delay('key', 3, started) is None
+
+    assert retry.NO_RETRY.next_delay('key', 1, started) is None
+
+    policy = retry.RetryPolicy(max_attempts=None, deadline=10)
+    assert policy.next_delay('key', 1, started, retry_after=5) >= 5
+    # Retry-After beyond the deadline means we give up.
+    assert policy.next_delay('key', 1, started, retry_after=20) is None
+    assert policy.next_delay('key', 1, started - 10) is None
+
+
+def test_retry_budget():
+    budget = retry.RetryBudget(max_tokens=4, token_ratio=0.5)
+    policy = retry.RetryPolicy(max_attempts=None, deadline=None,
+                               budget=budget)
+    started = monotonic()
+    assert policy.next_delay('a', 1, started) is not None
+    assert policy.next_delay('a', 1, started) is None
+    # Budgets are per key.
+    assert policy.next_delay('b', 1, started) is not None
+    policy.success('a')
+    policy.success('a')
+    assert budget.tokens('a') == 3
+    assert policy.next_delay('a', 1, started) is None
+    with pytest.raises(ValueError):
+        retry.RetryBudget(max_tokens=0)
+
+
+def test_get_policy():
+    assert retry.get_policy(False) is retry.NO_RETRY
+    assert retry.get_policy(True) is retry.DEFAULT_RETRY_POLICY
+    # Retries up to max_attempts however many calls fail.
+    started = monotonic()
+    for _ in range(50):
+        assert retry.DEFAULT_RETRY_POLICY.next_delay('key', 1,
+                                                     started) is not None
+    policy = retry.RetryPolicy()
+    assert retry.get_policy(policy) is policy
+    with pytest.raises(TypeError):
+        retry.get_policy('yes')
@@ -1,6 +1,70 @@
+import threading
+
 from paramiko import SSHClient, AutoAddPolicy
 from .paramiko_interactive import interactive_shell
 
+# (hostname, port) -> connected SSHClient, see reuse_connections().
+_connections = {}
+_connections_lock = threading.Lock()
+_reuse = False
+
+
+def reuse_connections(enabled=True):
+    """
+    Keeps connections open between non-interactive ssh() calls, for long
+    running processes like serve.
+    """
+    global _reuse
+    _reuse = enabled
+    if enabled is False:
+        close_connections()
+
+
+def close_connections():
+    """
+    Closes and forgets every kept connection.
+    """
+    with _connections_lock:
+        for ssh_client in _connections.values():
+            ssh_client.close()
+        _connections.clear()
+
+
+def _connect(ssh_client, hostname, port):
+    ssh_client.set_missing_host_key_policy(AutoAddPolicy())
+    ssh_client.connect(hostname=hostname,
+                       port=port,
+                       username='vmmanagement',
+                       password='',
+                       allow_agent=False,
+                       look_for_keys=False)
+
+
+def _connection(hostname, port):
+    key = (hostname, port)
+    with _connections_lock:
+        ssh_client = _connections.get(key)
+        if ssh_client is not None:
+            transport = ssh_client.get_transport()
+            if transport is not None and transport.is_active():
+                return ssh_client
+            ssh_client.close()
+        ssh_client = SSHClient()
+        _connect(ssh_client, hostname, port)
+        _connections[key] = ssh_client
+        return ssh_client
+
+
+def _run(ssh_client, command, stdin=None):
+    ssh_stdin, stdout, stderr = ssh_client.exec_command(command)
+    if stdin is not None:
+        ssh_stdin.write(stdin)
+        ssh_stdin.flush()
+        ssh_stdin.channel.shutdown_write()
+    # Kinda hacky, but works.
+    return_code = ssh_stdin.channel.recv_exit_status()
+    return stdout.read(), stderr.read(), return_code
+
 
 def ssh(hostname, command, stdin=None, interactive=False, port=1060):
     """
@@ -11,23 +75,12 @@ def ssh(hostname, command, stdin=None, interactive=False, port=1060):
         raise TypeError('hostname must be string')
     if stdin is not None and interactive is True:
         raise ValueError('Cannot use stdin with interactive.')
+    if interactive is False and _reuse is True:
+        return _run(_connection(hostname, port), command, stdin)
     with SSHClient() as ssh_client:
-        ssh_client.set_missing_host_key_policy(AutoAddPolicy())
-        ssh_client.connect(hostname=hostname,
-                           port=port,
-                           username='vmmanagement',
-                           password='',
-                           allow_agent=False,
-                           look_for_keys=False)
+        _connect(ssh_client, hostname, port)
         if interactive is False:
-            ssh_stdin, stdout, stderr = ssh_client.exec_command(command)
-            if stdin is not None:
-                ssh_stdin.write(stdin)
-                ssh_stdin.flush()
-                ssh_stdin.channel.shutdown_write()
-            # Kinda hacky, but works.
-            return_code = ssh_stdin.channel.recv_exit_status()
-            return stdout.read(), stderr.read(), return_code
+            return _run(ssh_client, command, stdin)
         else:
             channel = ssh_client.get_transport().open_session()
             channel.get_pty()
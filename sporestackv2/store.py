@@ -0,0 +1,969 @@
+"""
+Where saved machines live.
+
+JSONStore keeps one {vm_hostname}.json file per machine, as we always
+have. SQLiteStore keeps them all in one SQLite database, with the fields
+we look machines up by (host, api_endpoint, expiration) in indexed
+columns, so questions about the whole fleet don't mean reading every
+record.
+
+JSONStore's records are either all in the machine directory (the flat
+layout), or spread over SHARDS_NAME/a/b/ below it by a hash of
+vm_hostname (the sharded layout), which keeps directories small for very
+large fleets. migrate_layout() moves between the two while the store is
+in use, and records are looked for in both.
+
+JSONStore also keeps recently read records in memory (RecordCache), and
+hands them out again for as long as a stat says the file hasn't changed.
+
+Both keep a summary of every machine (INDEX_FIELDS) to answer query()
+from. JSONStore appends to an NDJSON index file on every save and
+delete, and only reads what was appended since it last looked.
+
+Any number of processes can share a store. Writes to a machine hold its
+RecordLocks lock (an flock on its own lock file), so they don't get in
+each other's way unless they're for the same machine, and update() reads,
+changes and saves a machine under it so concurrent updates aren't lost.
+JSONStore writes to a temporary file and renames it into place, so
+readers never see half a record and need no lock.
+
+Both have the same methods, and client.machine_store() picks one.
+"""
+
+import copy
+import fcntl
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import sha256
+
+from . import codec
+
+# Name of the database in the machine directory.
+SQLITE_NAME = 'machines.sqlite3'
+
+# Name of JSONStore's index in the machine directory.
+INDEX_NAME = 'index.ndjson'
+# Rewrite the index once it has this many more lines than machines.
+INDEX_SLACK = 1000
+
+LAYOUTS = ('flat', 'sharded')
+# Says which layout JSONStore saves records in. Flat if there isn't one.
+LAYOUT_NAME = 'layout'
+# Sharded records are in SHARDS_NAME/a/b/{vm_hostname}.json, with
+# SHARD_LEVELS directories of SHARD_WIDTH hex digits of sha256(vm_hostname).
+# 256 directories keep 100k machines a few hundred per directory, and
+# listing them all as quick as flat. Wider shards make listing slower.
+SHARDS_NAME = 'shards'
+SHARD_LEVELS = 2
+SHARD_WIDTH = 1
+
+# Lock files, in SHARDS_NAME style directories whatever the layout.
+LOCKS_NAME = 'locks'
+# Taken shared to append to the index, exclusive to rewrite it.
+INDEX_LOCK_NAME = 'index.lock'
+
+# Records JSONStore keeps in memory.
+RECORD_CACHE_SIZE = 4096
+
+# Record fields copied into their own columns.
+COLUMNS = ('host', 'api_endpoint', 'expiration', 'region', 'state')
+# What query() returns about each machine.
+INDEX_FIELDS = ('vm_hostname',) + COLUMNS
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS machines (
+    vm_hostname TEXT PRIMARY KEY,
+    host TEXT,
+    api_endpoint TEXT,
+    expiration INTEGER,
+    region TEXT,
+    state TEXT,
+    version INTEGER NOT NULL,
+    machine_info TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS machines_host ON machines (host);
+CREATE INDEX IF NOT EXISTS machines_api_endpoint ON machines (api_endpoint);
+CREATE INDEX IF NOT EXISTS machines_expiration ON machines (expiration);
+CREATE TABLE IF NOT EXISTS generation (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO generation (id, value) VALUES (0, 0);
+'''
+
+
+def _columns(machine_info):
+    """
+    Returns the indexed fields of machine_info, in COLUMNS order.
+    """
+    region = machine_info.get('region')
+    if region is None:
+        region = machine_info.get('launch_arguments', {}).get('region')
+    return (machine_info.get('host'),
+            machine_info.get('api_endpoint'),
+            machine_info.get('expiration'),
+            region,
+            machine_info.get('state'))
+
+
+def summary(machine_info):
+    """
+    Returns the INDEX_FIELDS of machine_info.
+    """
+    return dict(zip(INDEX_FIELDS,
+                    (machine_info['vm_hostname'],) + _columns(machine_info)))
+
+
+def matches(summary, host=None, region=None, api_endpoint=None,
+            state=None, expires_before=None, expires_after=None):
+    """
+    Whether summary matches every filter that isn't None. Expiration
+    bounds are exclusive, and machines with no expiration never match
+    them.
+    """
+    for field, value in [('host', host),
+                         ('region', region),
+                         ('api_endpoint', api_endpoint),
+                         ('state', state)]:
+        if value is not None and summary[field] != value:
+            return False
+    expiration = summary['expiration']
+    if expires_before is not None:
+        if expiration is None or expiration >= expires_before:
+            return False
+    if expires_after is not None:
+        if expiration is None or expiration <= expires_after:
+            return False
+    return True
+
+
+class RecordCache:
+    """
+    Decoded records keyed by path, each good for as long as the file's
+    (st_ino, st_mtime_ns, st_size) stays the same. The least recently
+    used is evicted once there are max_entries.
+    """
+
+    def __init__(self, max_entries=RECORD_CACHE_SIZE):
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1.')
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # path -> (stamp, record)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path, stamp):
+        """
+        Returns a copy of path's record if it was cached at stamp, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != stamp:
+                self.misses = self.misses + 1
+                return None
+            self._entries.move_to_end(path)
+            self.hits = self.hits + 1
+            record = entry[1]
+        # Callers change what they get, so nobody gets the cached one.
+        return copy.deepcopy(record)
+
+    def set(self, path, stamp, record):
+        record = copy.deepcopy(record)
+        with self._lock:
+            self._entries[path] = (stamp, record)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _stamp(stat):
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def shard(vm_hostname):
+    """
+    Returns the directories vm_hostname's record is in when sharded.
+    """
+    digest = sha256(vm_hostname.encode('utf-8')).hexdigest()
+    return [digest[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH]
+            for level in range(SHARD_LEVELS)]
+
+
+def _makedirs(directory):
+    """
+    os.makedirs(), but every directory it makes is private, not just the
+    last one.
+    """
+    if os.path.isdir(directory):
+        return
+    parent = os.path.dirname(directory)
+    if parent != directory:
+        _makedirs(parent)
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+
+
+def _lock_file(path, operation, blocking=True):
+    """
+    Opens path (making it and its directory if need be) and flocks it.
+    Returns the file descriptor, which holds the lock until closed.
+
+    Raises BlockingIOError if not blocking and it's already locked.
+    """
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    except FileNotFoundError:
+        _makedirs(os.path.dirname(path))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    if blocking is False:
+        operation = operation | fcntl.LOCK_NB
+    try:
+        fcntl.flock(fd, operation)
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
+
+@contextmanager
+def _locked(path, operation):
+    fd = _lock_file(path, operation)
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+
+class RecordLocks:
+    """
+    Exclusive advisory locks per vm_hostname, shared by every process
+    using directory. A thread can take a lock it already holds again.
+
+    Lock files are left in place, removing them safely would need a lock
+    of its own.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._local = threading.local()
+
+    def path(self, vm_hostname):
+        parts = [self.directory, LOCKS_NAME] + shard(vm_hostname)
+        return os.path.join(*(parts + ['{}.lock'.format(vm_hostname)]))
+
+    @contextmanager
+    def lock(self, vm_hostname, blocking=True):
+        """
+        Holds vm_hostname's lock. Raises ValueError if not blocking and
+        someone else has it.
+        """
+        held = getattr(self._local, 'held', None)
+        if held is None:
+            held = self._local.held = {}
+        if vm_hostname in held:
+            held[vm_hostname] = held[vm_hostname] + 1
+            try:
+                yield
+            finally:
+                held[vm_hostname] = held[vm_hostname] - 1
+            return
+        try:
+            fd = _lock_file(self.path(vm_hostname),
+                            fcntl.LOCK_EX,
+                            blocking=blocking)
+        except BlockingIOError:
+            message = '{} is locked, something else is working on it.'
+            raise ValueError(message.format(vm_hostname))
+        held[vm_hostname] = 1
+        try:
+            yield
+        finally:
+            del held[vm_hostname]
+            os.close(fd)
+
+
+class _Store:
+    """
+    What JSONStore and SQLiteStore have in common.
+    """
+
+    def lock(self, vm_hostname, blocking=True):
+        """
+        Keeps everyone else from saving or deleting vm_hostname while
+        held, see RecordLocks.lock().
+        """
+        return self.locks.lock(vm_hostname, blocking=blocking)
+
+    def update(self, vm_hostname, function):
+        """
+        Saves function(machine_info), or machine_info if that returns
+        None, with vm_hostname locked from reading to saving so no
+        concurrent update is lost. Returns what was saved.
+        """
+        with self.lock(vm_hostname):
+            machine_info = self.get(vm_hostname)
+            updated = function(machine_info)
+            if updated is None:
+                updated = machine_info
+            if updated['vm_hostname'] != vm_hostname:
+                raise ValueError('vm_hostname can not be changed.')
+            self.save(updated, overwrite=True)
+        return updated
+
+    def changes(self, since=None):
+        """
+        Returns (vm_hostnames, position): the machines saved or deleted
+        after since, a position from an earlier call, and where this call
+        leaves off. vm_hostnames is None when that isn't known, and
+        everything in versions() should be looked at instead, as is
+        always the case here.
+        """
+        return None, None
+
+
+def _json_files(directory, levels=0):
+    """
+    Yields (vm_hostname, os.DirEntry) for every record in directory, or
+    levels of directories below it.
+    """
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if levels == 0:
+            if entry.name.endswith('.json') and entry.is_file():
+                yield entry.name[:-len('.json')], entry
+        elif entry.is_dir():
+            for record in _json_files(entry.path, levels - 1):
+                yield record
+
+
+class JSONStore(_Store):
+    """
+    One {vm_hostname}.json file per machine in directory, or below it
+    when sharded.
+    """
+    name = 'json'
+
+    def __init__(self, directory, record_cache_size=RECORD_CACHE_SIZE):
+        self.directory = directory
+        self.locks = RecordLocks(directory)
+        self.records = RecordCache(record_cache_size)
+        # Where records are looked for first. Updated when saving, and
+        # when a record turns up in the other layout.
+        self._layout = self.layout()
+        # How much of which index file (st_dev, st_ino) is in _index.
+        self._index = {}
+        self._index_file = None
+        self._index_offset = 0
+        self._index_lines = 0
+        self._index_lock = threading.Lock()
+
+    def layout(self):
+        """
+        Returns the layout new records are saved in.
+        """
+        try:
+            with open(os.path.join(self.directory, LAYOUT_NAME)) as fp:
+                layout = fp.read().strip()
+        except FileNotFoundError:
+            return 'flat'
+        if layout not in LAYOUTS:
+            raise ValueError('Unknown layout: {}'.format(layout))
+        return layout
+
+    def _layout_path(self, vm_hostname, layout):
+        name = '{}.json'.format(vm_hostname)
+        if layout == 'sharded':
+            parts = [self.directory, SHARDS_NAME] + shard(vm_hostname)
+            return os.path.join(*(parts + [name]))
+        return os.path.join(self.directory, name)
+
+    def _paths(self, vm_hostname):
+        """
+        Returns where vm_hostname's record should be, then where it may
+        be if it hasn't been migrated yet.
+        """
+        other = LAYOUTS[1 - LAYOUTS.index(self._layout)]
+        return (self._layout_path(vm_hostname, self._layout),
+                self._layout_path(vm_hostname, other))
+
+    def _stat(self, vm_hostname):
+        """
+        Returns (path, os.stat()) of vm_hostname's record. Raises
+        FileNotFoundError if there isn't one.
+        """
+        path, other = self._paths(vm_hostname)
+        try:
+            return path, os.stat(path)
+        except FileNotFoundError:
+            pass
+        stat = os.stat(other)
+        # Only left there by, or moved there by, migrate_layout().
+        self._layout = self.layout()
+        return other, stat
+
+    def _index_path(self):
+        return os.path.join(self.directory, INDEX_NAME)
+
+    def _index_lock_path(self):
+        return os.path.join(self.directory, INDEX_LOCK_NAME)
+
+    def _index_append(self, entry):
+        """
+        Appends entry to the index, in one write so concurrent appends
+        don't interleave. If there is no index yet, query() builds one
+        from scratch instead.
+        """
+        line = (codec.dumps(entry) + '\n').encode('utf-8')
+        # Shared, so appends only wait for the index being rewritten.
+        with _locked(self._index_lock_path(), fcntl.LOCK_SH):
+            try:
+                fd = os.open(self._index_path(), os.O_WRONLY | os.O_APPEND)
+            except FileNotFoundError:
+                return
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    def save(self, machine_info, overwrite=False):
+        """
+        Writes machine_info to a temporary file and renames it into
+        place. Raises FileExistsError if it's already saved, unless
+        overwrite.
+        """
+        vm_hostname = machine_info['vm_hostname']
+        data = codec.dumps(machine_info).encode('utf-8')
+        with self.lock(vm_hostname):
+            self._layout = self.layout()
+            path, other = self._paths(vm_hostname)
+            if overwrite is not True and os.path.exists(other):
+                raise FileExistsError(other)
+            self.records.invalidate(path)
+            self.records.invalidate(other)
+            self._write(path, data, overwrite=overwrite)
+            if overwrite is True:
+                # Don't leave an older copy for migrate_layout() to move
+                # back.
+                try:
+                    os.remove(other)
+                except FileNotFoundError:
+                    pass
+            self._index_append(summary(machine_info))
+
+    def _write(self, path, data, overwrite):
+        directory = os.path.dirname(path)
+        prefix = '.{}.'.format(os.path.basename(path))
+        try:
+            fd, temporary_path = tempfile.mkstemp(dir=directory,
+                                                  prefix=prefix,
+                                                  suffix='.tmp')
+        except FileNotFoundError:
+            _makedirs(directory)
+            fd, temporary_path = tempfile.mkstemp(dir=directory,
+                                                  prefix=prefix,
+                                                  suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+                fp.flush()
+                # So a crash can't leave an empty record behind.
+                os.fsync(fp.fileno())
+            if overwrite is True:
+                os.replace(temporary_path, path)
+            else:
+                # Fails if path exists, unlike a rename.
+                os.link(temporary_path, path)
+        finally:
+            try:
+                os.unlink(temporary_path)
+            except FileNotFoundError:
+                pass
+
+    def get(self, vm_hostname):
+        """
+        Takes one stat if we've read vm_hostname since it last changed.
+        """
+        try:
+            path, stat = self._stat(vm_hostname)
+        except FileNotFoundError:
+            msg = '{} does not exist in {}'.format(vm_hostname,
+                                                   self.directory)
+            raise ValueError(msg)
+        machine_info = self.records.get(path, _stamp(stat))
+        if machine_info is not None:
+            return machine_info
+        with open(path) as fp:
+            machine_info = codec.load(fp)
+            # From the file we read, in case it was replaced since.
+            stamp = _stamp(os.fstat(fp.fileno()))
+        if machine_info['vm_hostname'] != vm_hostname:
+            raise ValueError('vm_hostname does not match filename.')
+        self.records.set(path, stamp, machine_info)
+        return machine_info
+
+    def exists(self, vm_hostname):
+        try:
+            self._stat(vm_hostname)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def delete(self, vm_hostname):
+        with self.lock(vm_hostname):
+            path, other = self._paths(vm_hostname)
+            self.records.invalidate(path)
+            self.records.invalidate(other)
+            deleted = False
+            for candidate in [path, other]:
+                try:
+                    os.remove(candidate)
+                except FileNotFoundError:
+                    continue
+                deleted = True
+            if deleted is False:
+                raise FileNotFoundError(path)
+            self._index_append({'vm_hostname': vm_hostname,
+                                'deleted': True})
+
+    def _json_files(self, layout=None):
+        """
+        Yields (vm_hostname, os.DirEntry) for every record in layout, or
+        in both.
+        """
+        if layout in [None, 'flat']:
+            for record in _json_files(self.directory):
+                yield record
+        if layout in [None, 'sharded']:
+            shards = os.path.join(self.directory, SHARDS_NAME)
+            for record in _json_files(shards, SHARD_LEVELS):
+                yield record
+
+    def hostnames(self):
+        seen = set()
+        for vm_hostname, entry in self._json_files():
+            if vm_hostname not in seen:
+                seen.add(vm_hostname)
+                yield vm_hostname
+
+    def migrate_layout(self, layout):
+        """
+        Moves every record into layout, one at a time, while others keep
+        using the store. Returns how many were moved.
+
+        Saves go to the new layout as soon as this starts, and lookups
+        check both, so nothing goes missing on the way.
+        """
+        if layout not in LAYOUTS:
+            message = 'layout must be one of: {}'
+            raise ValueError(message.format(', '.join(LAYOUTS)))
+        _makedirs(self.directory)
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory,
+                                              prefix='.layout-')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(layout + '\n')
+        os.replace(temporary_path,
+                   os.path.join(self.directory, LAYOUT_NAME))
+        self._layout = layout
+        other = LAYOUTS[1 - LAYOUTS.index(layout)]
+
+        moved = 0
+        while True:
+            # Again, in case someone saved the old way while we were busy.
+            records = list(self._json_files(other))
+            for vm_hostname, entry in records:
+                with self.lock(vm_hostname):
+                    self._move(entry.path,
+                               self._layout_path(vm_hostname, layout))
+            moved = moved + len(records)
+            if len(records) == 0:
+                break
+        if layout == 'flat':
+            self._remove_empty_shards()
+        if not os.path.exists(self._index_path()):
+            # generation() relies on it once sharded.
+            self.reindex()
+        return moved
+
+    def _move(self, source, destination):
+        """
+        Moves source to destination, unless destination is newer.
+        """
+        self.records.invalidate(source)
+        self.records.invalidate(destination)
+        directory = os.path.dirname(destination)
+        if not os.path.isdir(directory):
+            _makedirs(directory)
+        try:
+            os.link(source, destination)
+        except FileNotFoundError:
+            # Deleted, or saved over in the new layout, since we looked.
+            return
+        except FileExistsError:
+            # Saved in both places, keep the newest.
+            try:
+                if os.stat(source).st_mtime_ns > \
+                        os.stat(destination).st_mtime_ns:
+                    os.replace(source, destination)
+                    return
+            except FileNotFoundError:
+                # Changed under us, the next pass will see.
+                return
+        try:
+            os.remove(source)
+        except FileNotFoundError:
+            pass
+
+    def _remove_empty_shards(self):
+        shards = os.path.join(self.directory, SHARDS_NAME)
+        for root, directories, files in os.walk(shards, topdown=False):
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+
+    def reindex(self):
+        """
+        Rebuilds the index from every record. Returns how many there are.
+        """
+        _makedirs(self.directory)
+        # Saves wait, so none is appended to the index we're replacing.
+        with _locked(self._index_lock_path(), fcntl.LOCK_EX):
+            summaries = [summary(self.get(vm_hostname))
+                         for vm_hostname in self.hostnames()]
+            fd, temporary_path = tempfile.mkstemp(dir=self.directory,
+                                                  prefix='.index-')
+            try:
+                with os.fdopen(fd, 'w') as fp:
+                    for entry in summaries:
+                        fp.write(codec.dumps(entry) + '\n')
+                os.replace(temporary_path, self._index_path())
+            except Exception:
+                os.unlink(temporary_path)
+                raise
+        return len(summaries)
+
+    def _read_index(self):
+        """
+        Brings self._index up to date with the index file, reading only
+        what was appended since last time.
+        """
+        path = self._index_path()
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.reindex()
+            stat = os.stat(path)
+        index_file = (stat.st_dev, stat.st_ino)
+        if index_file != self._index_file or \
+                stat.st_size < self._index_offset:
+            # Rewritten since we last looked.
+            self._index = {}
+            self._index_file = index_file
+            self._index_offset = 0
+            self._index_lines = 0
+        if stat.st_size == self._index_offset:
+            return
+        with open(path, 'rb') as fp:
+            fp.seek(self._index_offset)
+            data = fp.read()
+        # Leave a line that is still being written for next time.
+        data = data[:data.rfind(b'\n') + 1]
+        # One decode for every line is much quicker than one per line.
+        entries = codec.loads(b'[' + b','.join(data.splitlines()) + b']')
+        for entry in entries:
+            if entry.get('deleted') is True:
+                self._index.pop(entry['vm_hostname'], None)
+            else:
+                self._index[entry['vm_hostname']] = entry
+        self._index_lines = self._index_lines + len(entries)
+        self._index_offset = self._index_offset + len(data)
+        if self._index_lines > len(self._index) + INDEX_SLACK:
+            self.reindex()
+
+    def changes(self, since=None):
+        """
+        Reads what was appended to the index after since, so only the
+        machines named there need looking at. Not known the first time,
+        or if the index was rewritten since.
+        """
+        path = self._index_path()
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.reindex()
+            stat = os.stat(path)
+        index_file = (stat.st_dev, stat.st_ino)
+        if since is None or since[0] != index_file or \
+                stat.st_size < since[1]:
+            # Taken before the caller looks at everything, so anything
+            # saved meanwhile turns up next time.
+            return None, (index_file, stat.st_size)
+        if stat.st_size == since[1]:
+            return set(), since
+        with open(path, 'rb') as fp:
+            fp.seek(since[1])
+            data = fp.read()
+        data = data[:data.rfind(b'\n') + 1]
+        try:
+            entries = codec.loads(b'[' + b','.join(data.splitlines()) + b']')
+        except ValueError:
+            return None, (index_file, stat.st_size)
+        vm_hostnames = set(entry['vm_hostname'] for entry in entries)
+        return vm_hostnames, (index_file, since[1] + len(data))
+
+    def query(self, **filters):
+        """
+        Yields the summary of every machine matching filters, see
+        matches(), from the index.
+        """
+        with self._index_lock:
+            self._read_index()
+            summaries = list(self._index.values())
+        for entry in summaries:
+            if matches(entry, **filters):
+                yield entry
+
+    def find(self, **filters):
+        """
+        Yields every machine matching filters, see matches().
+        """
+        for entry in self.query(**filters):
+            yield self.get(entry['vm_hostname'])
+
+    def generation(self):
+        """
+        Changes whenever a machine is saved or deleted, as far as we can
+        cheaply tell: the directory changes when flat records come and
+        go, and the index whenever we save one. None if there's nothing
+        saved yet.
+        """
+        if not os.path.isdir(self.directory):
+            return None
+        try:
+            index = _stamp(os.stat(self._index_path()))
+        except FileNotFoundError:
+            # Sharded records don't change the directory, and changes()
+            # needs it anyway.
+            self.reindex()
+            index = _stamp(os.stat(self._index_path()))
+        # After making the index, which changes it.
+        directory = os.stat(self.directory).st_mtime_ns
+        return (directory, index)
+
+    def versions(self):
+        """
+        Returns {vm_hostname: version}, where version changes whenever
+        that machine is saved.
+        """
+        versions = {}
+        for vm_hostname, entry in self._json_files():
+            versions[vm_hostname] = entry.stat().st_mtime_ns
+        return versions
+
+
+class SQLiteStore(_Store):
+    """
+    Every machine in one SQLite database at path.
+
+    Each thread gets its own connection. Every write is one transaction.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self.locks = RecordLocks(os.path.dirname(os.path.abspath(path)))
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Only needed by those who use it.
+            import sqlite3
+
+            directory = os.path.dirname(os.path.abspath(self.path))
+            _makedirs(directory)
+            connection = sqlite3.connect(self.path,
+                                         timeout=30,
+                                         isolation_level=None)
+            os.chmod(self.path, 0o600)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        """
+        Closes this thread's connection, if it has one.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _write(self, write):
+        """
+        Runs write(connection, version) in one transaction, where version
+        is the store's new generation.
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('UPDATE generation SET value = value + 1')
+            version = connection.execute(
+                'SELECT value FROM generation').fetchone()[0]
+            write(connection, version)
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def save(self, machine_info, overwrite=False):
+        with self.lock(machine_info['vm_hostname']):
+            self.save_many([machine_info], overwrite=overwrite)
+
+    def save_many(self, machine_infos, overwrite=False):
+        """
+        Saves every machine_info in one transaction, without taking their
+        locks.
+        """
+        import sqlite3
+
+        sql = 'INSERT INTO machines VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+        if overwrite is True:
+            sql = sql.replace('INSERT', 'INSERT OR REPLACE')
+
+        def write(connection, version):
+            connection.executemany(
+                sql,
+                [(machine_info['vm_hostname'],) + _columns(machine_info) +
+                 (version, codec.dumps(machine_info))
+                 for machine_info in machine_infos])
+
+        try:
+            self._write(write)
+        except sqlite3.IntegrityError as e:
+            # Same as open(..., 'x') in JSONStore.
+            raise FileExistsError(str(e))
+
+    def get(self, vm_hostname):
+        row = self._connection().execute(
+            'SELECT machine_info FROM machines WHERE vm_hostname = ?',
+            (vm_hostname,)).fetchone()
+        if row is None:
+            msg = '{} does not exist in {}'.format(vm_hostname, self.path)
+            raise ValueError(msg)
+        return codec.loads(row[0])
+
+    def exists(self, vm_hostname):
+        row = self._connection().execute(
+            'SELECT 1 FROM machines WHERE vm_hostname = ?',
+            (vm_hostname,)).fetchone()
+        return row is not None
+
+    def delete(self, vm_hostname):
+        with self.lock(vm_hostname):
+            if not self.exists(vm_hostname):
+                raise FileNotFoundError(vm_hostname)
+            self._write(lambda connection, version: connection.execute(
+                'DELETE FROM machines WHERE vm_hostname = ?',
+                (vm_hostname,)))
+
+    def hostnames(self):
+        rows = self._connection().execute(
+            'SELECT vm_hostname FROM machines')
+        for row in rows.fetchall():
+            yield row[0]
+
+    def _select(self, what, host=None, region=None, api_endpoint=None,
+                state=None, expires_before=None, expires_after=None):
+        where = []
+        parameters = []
+        for column, value in [('host', host),
+                              ('region', region),
+                              ('api_endpoint', api_endpoint),
+                              ('state', state)]:
+            if value is not None:
+                where.append('{} = ?'.format(column))
+                parameters.append(value)
+        if expires_before is not None:
+            where.append('expiration < ?')
+            parameters.append(expires_before)
+        if expires_after is not None:
+            where.append('expiration > ?')
+            parameters.append(expires_after)
+        sql = 'SELECT {} FROM machines'.format(what)
+        if len(where) != 0:
+            sql = sql + ' WHERE ' + ' AND '.join(where)
+        return self._connection().execute(sql, parameters).fetchall()
+
+    def reindex(self):
+        """
+        Nothing to do, SQLite keeps its indexes up to date. Returns how
+        many machines there are.
+        """
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM machines').fetchone()[0]
+
+    def query(self, **filters):
+        """
+        Yields the summary of every machine matching filters, see
+        matches(), using the indexes.
+        """
+        for row in self._select(', '.join(INDEX_FIELDS), **filters):
+            yield dict(zip(INDEX_FIELDS, row))
+
+    def find(self, **filters):
+        """
+        Yields every machine matching filters, see matches().
+        """
+        for row in self._select('machine_info', **filters):
+            yield codec.loads(row[0])
+
+    def generation(self):
+        return self._connection().execute(
+            'SELECT value FROM generation').fetchone()[0]
+
+    def versions(self):
+        rows = self._connection().execute(
+            'SELECT vm_hostname, version FROM machines')
+        return dict(rows.fetchall())
+
+
+def migrate(source, destination, overwrite=False):
+    """
+    Copies every machine from source to destination. Returns how many.
+
+    Machines already in destination are left alone unless overwrite.
+    """
+    machine_infos = []
+    for vm_hostname in source.hostnames():
+        if overwrite is False and destination.exists(vm_hostname):
+            continue
+        machine_infos.append(source.get(vm_hostname))
+    if hasattr(destination, 'save_many'):
+        destination.save_many(machine_infos, overwrite=overwrite)
+    else:
+        for machine_info in machine_infos:
+            destination.save(machine_info, overwrite=overwrite)
+    return len(machine_infos)
@@ -0,0 +1,308 @@
+import os
+import threading
+
+import pytest
+
+from . import client
+from . import store
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def machines(request, tmp_path):
+    if request.param == 'sqlite':
+        return store.SQLiteStore(str(tmp_path / store.SQLITE_NAME))
+    return store.JSONStore(str(tmp_path / 'machines'))
+
+
+def test_store(machines):
+    assert list(machines.hostnames()) == []
+    assert machines.exists('a') is False
+    with pytest.raises(ValueError):
+        machines.get('a')
+    generation = machines.generation()
+
+    machines.save({'vm_hostname': 'a', 'host': 'h1', 'expiration': 100})
+    with pytest.raises(FileExistsError):
+        machines.save({'vm_hostname': 'a'})
+    machines.save({'vm_hostname': 'b', 'host': 'h2', 'expiration': 50,
+                   'api_endpoint': 'https://api.example'})
+    machines.save({'vm_hostname': 'c', 'host': 'h1'})
+    assert machines.exists('a') is True
+    assert machines.get('a')['expiration'] == 100
+    assert sorted(machines.hostnames()) == ['a', 'b', 'c']
+    assert machines.generation() != generation
+    versions = machines.versions()
+    assert sorted(versions) == ['a', 'b', 'c']
+
+    def found(**filters):
+        return sorted(machine_info['vm_hostname']
+                      for machine_info in machines.find(**filters))
+
+    assert found(host='h1') == ['a', 'c']
+    assert found(api_endpoint='https://api.example') == ['b']
+    assert found(expires_before=75) == ['b']
+    assert found(host='h1', expires_before=200) == ['a']
+
+    machines.save({'vm_hostname': 'a', 'host': 'h2'}, overwrite=True)
+    assert found(host='h2') == ['a', 'b']
+    machines.delete('b')
+    with pytest.raises(FileNotFoundError):
+        machines.delete('b')
+    assert sorted(machines.versions()) == ['a', 'c']
+
+
+def test_migrate(tmp_path, monkeypatch):
+    monkeypatch.setattr(client, 'machine_info_directory',
+                        lambda: str(tmp_path))
+    monkeypatch.delenv('SPORESTACKV2_STORE', raising=False)
+    for vm_hostname in ['a', 'b']:
+        client.save_machine_info({'vm_hostname': vm_hostname,
+                                  'host': 'host.example'})
+    assert client.machine_store().name == 'json'
+
+    # A failed migration leaves no database behind to be used.
+    (tmp_path / 'bad.json').write_text('{')
+    with pytest.raises(ValueError):
+        client.migrate_store('sqlite')
+    assert client.machine_store().name == 'json'
+    assert sorted(os.listdir(str(tmp_path))) == [
+        'a.json', 'b.json', 'bad.json', store.INDEX_LOCK_NAME,
+        store.LOCKS_NAME]
+    os.remove(str(tmp_path / 'bad.json'))
+
+    assert client.migrate_store('sqlite') is True
+    assert client.machine_store().name == 'sqlite'
+    assert sorted(client.machine_hostnames()) == ['a', 'b']
+    client.save_machine_info({'vm_hostname': 'c'})
+    client.update_machine_info('a', lambda machine_info:
+                               machine_info.update(expiration=999))
+    client.delete_machine_info('b')
+    # The JSON files are still there, but no longer used.
+    assert os.path.exists(str(tmp_path / 'a.json'))
+    assert client.machine_store('json').exists('c') is False
+
+    assert client.migrate_store('json') is True
+    assert client.machine_store().name == 'json'
+    # What changed while on sqlite is kept.
+    assert sorted(client.machine_hostnames()) == ['a', 'c']
+    assert client.get_machine_info('a')['expiration'] == 999
+    with pytest.raises(ValueError):
+        client.migrate_store('json')
+    with pytest.raises(ValueError):
+        client.migrate_store('yaml')
+
+
+def test_query(machines):
+    machines.save({'vm_hostname': 'a', 'host': 'h1', 'expiration': 100,
+                   'launch_arguments': {'region': 'eu'}})
+    machines.save({'vm_hostname': 'b', 'host': 'h2', 'expiration': 50,
+                   'region': 'us'})
+    machines.save({'vm_hostname': 'c', 'host': 'h1', 'state': 'building'})
+
+    def queried(**filters):
+        return sorted(entry['vm_hostname']
+                      for entry in machines.query(**filters))
+
+    assert queried() == ['a', 'b', 'c']
+    assert queried(region='eu') == ['a']
+    assert queried(state='building') == ['c']
+    assert queried(expires_after=50) == ['a']
+    assert queried(expires_after=10, expires_before=200) == ['a', 'b']
+    entry = next(machines.query(region='us'))
+    assert entry == {'vm_hostname': 'b', 'host': 'h2', 'api_endpoint': None,
+                     'expiration': 50, 'region': 'us', 'state': None}
+
+    machines.save({'vm_hostname': 'b', 'host': 'h1'}, overwrite=True)
+    machines.delete('c')
+    assert queried(host='h1') == ['a', 'b']
+
+
+def test_index(tmp_path, monkeypatch):
+    machines = store.JSONStore(str(tmp_path))
+    machines.save({'vm_hostname': 'a'})
+    # Made from the records the first time it's needed.
+    assert not os.path.exists(str(tmp_path / store.INDEX_NAME))
+    assert [entry['vm_hostname'] for entry in machines.query()] == ['a']
+    machines.save({'vm_hostname': 'b'})
+    machines.delete('a')
+
+    # Only what was appended is read.
+    monkeypatch.setattr(machines, 'get', None)
+    offset = machines._index_offset
+    assert [entry['vm_hostname'] for entry in machines.query()] == ['b']
+    assert machines._index_offset > offset
+    # Another process sees the same.
+    other = store.JSONStore(str(tmp_path))
+    assert [entry['vm_hostname'] for entry in other.query()] == ['b']
+
+    # Rewritten once it's mostly stale lines.
+    monkeypatch.undo()
+    monkeypatch.setattr(store, 'INDEX_SLACK', 3)
+    for _ in range(4):
+        machines.save({'vm_hostname': 'b', 'host': 'h'}, overwrite=True)
+    assert [entry['host'] for entry in machines.query()] == ['h']
+    with open(str(tmp_path / store.INDEX_NAME)) as fp:
+        assert len(fp.readlines()) == 1
+
+
+def test_record_cache(tmp_path, monkeypatch):
+    machines = store.JSONStore(str(tmp_path), record_cache_size=2)
+    for vm_hostname in ['a', 'b', 'c']:
+        machines.save({'vm_hostname': vm_hostname, 'expiration': 1})
+    assert machines.get('a')['expiration'] == 1
+    assert machines.records.misses == 1
+
+    # Cached: one stat, no open.
+    opened = []
+    real_open = open
+    monkeypatch.setattr('builtins.open',
+                        lambda *args, **kwargs: opened.append(args) or
+                        real_open(*args, **kwargs))
+    machine_info = machines.get('a')
+    assert opened == []
+    assert machines.records.hits == 1
+    # Changing what we got doesn't change the cache.
+    machine_info['expiration'] = 2
+    assert machines.get('a')['expiration'] == 1
+
+    # Saving drops it, and the new one is read.
+    machines.save(machine_info, overwrite=True)
+    assert len(machines.records) == 0
+    assert machines.get('a')['expiration'] == 2
+    # So is a change made by someone else.
+    path = tmp_path / 'a.json'
+    path.write_text('{"vm_hostname": "a", "expiration": 30}')
+    assert machines.get('a')['expiration'] == 30
+
+    machines.get('b')
+    machines.get('c')
+    assert len(machines.records) == 2
+    machines.delete('c')
+    assert len(machines.records) == 1
+    with pytest.raises(ValueError):
+        machines.get('c')
+
+
+def test_sharded_layout(tmp_path):
+    machines = store.JSONStore(str(tmp_path))
+    assert machines.layout() == 'flat'
+    for vm_hostname in ['a', 'b', 'c']:
+        machines.save({'vm_hostname': vm_hostname, 'expiration': 1})
+    machines.get('a')
+    # Someone else's view of the same directory.
+    other = store.JSONStore(str(tmp_path))
+    other.get('b')
+
+    assert machines.migrate_layout('sharded') == 3
+    assert machines.layout() == 'sharded'
+    assert sorted(os.listdir(str(tmp_path))) == [store.INDEX_LOCK_NAME,
+                                                 store.INDEX_NAME,
+                                                 store.LAYOUT_NAME,
+                                                 store.LOCKS_NAME,
+                                                 store.SHARDS_NAME]
+    path = os.path.join(str(tmp_path), store.SHARDS_NAME,
+                        *(store.shard('a') + ['a.json']))
+    assert os.path.exists(path)
+    # Found where they went, cached or not.
+    for vm_hostname in ['a', 'b', 'c']:
+        assert other.get(vm_hostname)['vm_hostname'] == vm_hostname
+        assert other.exists(vm_hostname) is True
+    assert other._layout == 'sharded'
+    assert sorted(other.hostnames()) == ['a', 'b', 'c']
+    assert sorted(other.versions()) == ['a', 'b', 'c']
+    with pytest.raises(FileExistsError):
+        other.save({'vm_hostname': 'a'})
+
+    # A straggler saved the old way is moved too, if it's newer.
+    (tmp_path / 'a.json').write_text('{"vm_hostname": "a", '
+                                     '"expiration": 2}')
+    generation = machines.generation()
+    machines.save({'vm_hostname': 'd'})
+    assert machines.generation() != generation
+    assert machines.migrate_layout('sharded') == 1
+    assert machines.get('a')['expiration'] == 2
+    assert not os.path.exists(str(tmp_path / 'a.json'))
+
+    machines.delete('d')
+    assert machines.migrate_layout('flat') == 3
+    assert sorted(os.listdir(str(tmp_path))) == ['a.json', 'b.json',
+                                                 'c.json',
+                                                 store.INDEX_LOCK_NAME,
+                                                 store.INDEX_NAME,
+                                                 store.LAYOUT_NAME,
+                                                 store.LOCKS_NAME]
+    assert sorted(entry['vm_hostname'] for entry in machines.query()) == \
+        ['a', 'b', 'c']
+    with pytest.raises(ValueError):
+        machines.migrate_layout('deep')
+
+
+def test_concurrent_updates(machines):
+    machines.save({'vm_hostname': 'a', 'count': 0})
+    machines.save({'vm_hostname': 'b', 'count': 0})
+
+    def increment(vm_hostname):
+        def add_one(machine_info):
+            machine_info['count'] = machine_info['count'] + 1
+
+        for _ in range(10):
+            machines.update(vm_hostname, add_one)
+
+    threads = [threading.Thread(target=increment, args=(vm_hostname,))
+               for vm_hostname in ['a', 'b'] * 4]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert machines.get('a')['count'] == 40
+    assert machines.get('b')['count'] == 40
+    with pytest.raises(ValueError):
+        machines.update('a', lambda machine_info: {'vm_hostname': 'c'})
+
+
+def test_record_locks(machines):
+    errors = []
+    with machines.lock('a'):
+        # Taking it again in the same thread is fine.
+        with machines.lock('a', blocking=False):
+            machines.save({'vm_hostname': 'a'})
+
+        def try_lock(vm_hostname):
+            try:
+                with machines.lock(vm_hostname, blocking=False):
+                    pass
+            except ValueError as e:
+                errors.append((vm_hostname, str(e)))
+
+        for vm_hostname in ['a', 'b']:
+            thread = threading.Thread(target=try_lock, args=(vm_hostname,))
+            thread.start()
+            thread.join()
+    assert len(errors) == 1
+    assert errors[0][0] == 'a'
+    assert 'locked' in errors[0][1]
+    with machines.lock('a', blocking=False):
+        pass
+
+
+def test_atomic_save(tmp_path):
+    umask = os.umask(0o022)
+    try:
+        machines = store.JSONStore(str(tmp_path / 'machines'))
+        machines.save({'vm_hostname': 'a', 'expiration': 1})
+        # The process umask is left alone.
+        assert os.umask(0o022) == 0o022
+    finally:
+        os.umask(umask)
+    path = tmp_path / 'machines' / 'a.json'
+    assert os.stat(str(path)).st_mode & 0o777 == 0o600
+    assert os.stat(str(tmp_path / 'machines')).st_mode & 0o777 == 0o700
+    inode = os.stat(str(path)).st_ino
+    machines.save({'vm_hostname': 'a', 'expiration': 2}, overwrite=True)
+    # Replaced, not written over.
+    assert os.stat(str(path)).st_ino != inode
+    with pytest.raises(FileExistsError):
+        machines.save({'vm_hostname': 'a'})
+    assert machines.get('a')['expiration'] == 2
+    assert sorted(os.listdir(str(tmp_path / 'machines'))) == [
+        'a.json', store.INDEX_LOCK_NAME, store.LOCKS_NAME]
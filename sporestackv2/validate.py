@@ -5,8 +5,16 @@ All functions return True if valid, or raise an exception.
 """
 
 import string
+import threading
+from collections import OrderedDict
+from hashlib import sha256
 
-from sshpubkeys import SSHKey
+# How many valid SSH keys ssh_key() remembers.
+SSH_KEY_CACHE_SIZE = 256
+
+# sha256 digest of SSH keys that passed ssh_key(), oldest first.
+_valid_ssh_keys = OrderedDict()
+_valid_ssh_keys_lock = threading.Lock()
 
 
 def machine_id(machine_id):
@@ -51,12 +59,23 @@ def operating_system(operating_system):
 def ssh_key(ssh_key):
     """
     Validates an ssh_key argument.
+
+    Keys that pass are remembered (by digest) so they aren't parsed again.
     """
     if ssh_key is None:
         return True
     if not isinstance(ssh_key, str):
         raise TypeError('ssh_key must be null or a string.')
 
+    digest = sha256(ssh_key.encode('utf-8')).digest()
+    with _valid_ssh_keys_lock:
+        if digest in _valid_ssh_keys:
+            _valid_ssh_keys.move_to_end(digest)
+            return True
+
+    # Slow to import and only needed here.
+    from sshpubkeys import SSHKey
+
     ssh_key_object = SSHKey(ssh_key,
                             skip_option_parsing=True,
                             disallow_options=True)
@@ -65,6 +84,10 @@ def ssh_key(ssh_key):
     except Exception as e:
         raise ValueError("Invalid SSH key: {}".format(e))
 
+    with _valid_ssh_keys_lock:
+        _valid_ssh_keys[digest] = True
+        while len(_valid_ssh_keys) > SSH_KEY_CACHE_SIZE:
+            _valid_ssh_keys.popitem(last=False)
     return True
 
 
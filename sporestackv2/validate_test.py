@@ -1,4 +1,5 @@
 import string
+import sys
 
 import pytest
 
@@ -155,6 +156,25 @@ def test_ssh_key():
         validate.ssh_key('ssh-rsa')
 
 
+def test_ssh_key_cache(monkeypatch):
+    monkeypatch.setattr(validate, 'SSH_KEY_CACHE_SIZE', 1)
+    validate._valid_ssh_keys.clear()
+    assert validate.ssh_key(valid_ssh_key) is True
+    assert len(validate._valid_ssh_keys) == 1
+    # Served from the cache, so must not need sshpubkeys.
+    monkeypatch.setitem(sys.modules, 'sshpubkeys', None)
+    assert validate.ssh_key(valid_ssh_key) is True
+    with pytest.raises(ImportError):
+        validate.ssh_key(valid_ssh_key_with_comment)
+    monkeypatch.delitem(sys.modules, 'sshpubkeys')
+    assert validate.ssh_key(valid_ssh_key_with_comment) is True
+    # Bounded, invalid keys never cached.
+    assert len(validate._valid_ssh_keys) == 1
+    with pytest.raises(ValueError):
+        validate.ssh_key('ssh-rsa')
+    assert len(validate._valid_ssh_keys) == 1
+
+
 def test_ipxescript():
     assert validate.ipxescript(None) is True
     assert validate.ipxescript('#!ipxe') is True